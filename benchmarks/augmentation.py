@@ -0,0 +1,127 @@
+"""
+Benchmark the per-batch latency of the training augmentations.
+
+Compares apply_augs, which builds new spatial and color pipelines on every
+call, with an AugmentationEngine built once, on batches shaped like the
+training batches. Both run the augmentations selected in the configuration,
+with every transform applied and with a random subset per batch.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.augmentation configs.<config> [--batches <num>]
+"""
+
+import argparse
+import importlib
+import random
+import time
+
+import kornia.augmentation as K
+import torch
+
+from utils.transforms import (
+    AugmentationEngine,
+    apply_augs,
+    create_augmentation_pipelines,
+)
+
+MODEL_DEVICE = (
+    "cuda"
+    if torch.cuda.is_available()
+    else "mps" if torch.backends.mps.is_available() else "cpu"
+)
+
+
+def synchronize() -> None:
+    """
+    Wait for pending work on the model device.
+    """
+    if MODEL_DEVICE == "cuda":
+        torch.cuda.synchronize()
+    elif MODEL_DEVICE == "mps":
+        torch.mps.synchronize()
+
+
+def ms_per_batch(augment, image, mask, batches: int) -> float:
+    """
+    Return the mean time in milliseconds to augment a batch.
+    """
+    random.seed(0)
+    torch.manual_seed(0)
+    augment(image, mask)
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(batches):
+        augment(image, mask)
+    synchronize()
+    return (time.perf_counter() - start) / batches * 1000
+
+
+def build_ms(spatial_augs, color_augs, repeats: int = 200) -> float:
+    """
+    Return the mean time in milliseconds apply_augs spends building pipelines.
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        K.AugmentationSequential(
+            *spatial_augs, data_keys=["image", "mask"], same_on_batch=False
+        )
+        K.AugmentationSequential(
+            *color_augs, data_keys=["image"], same_on_batch=False
+        )
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main(config, batches: int, channels: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        config: configuration module
+        batches: number of batches augmented per variant
+        channels: number of image channels
+    """
+    image = torch.rand(
+        config.BATCH_SIZE, channels, config.PATCH_SIZE, config.PATCH_SIZE
+    ).to(MODEL_DEVICE)
+    mask = torch.randint(
+        0,
+        config.NUM_CLASSES,
+        (config.BATCH_SIZE, 1, config.PATCH_SIZE, config.PATCH_SIZE),
+    ).to(MODEL_DEVICE, torch.float32)
+
+    spatial_augs, color_augs = create_augmentation_pipelines(
+        config, config.SPATIAL_AUG_INDICES, config.IMAGE_AUG_INDICES
+    )
+    print(f"device: {MODEL_DEVICE}, batch: {tuple(image.shape)}")
+    print(
+        "pipeline construction per batch: "
+        f"{build_ms(spatial_augs, color_augs):.2f} ms"
+    )
+    print(f"{'mode':<8} {'apply_augs ms':>14} {'engine ms':>10}")
+    # any mode string selects a random subset, so None applies every transform
+    for name, mode in (("every", None), ("random", "random")):
+        aug_config = (spatial_augs, color_augs, mode, mode)
+        legacy = ms_per_batch(
+            lambda x, y, c=aug_config: apply_augs(c, x, y),
+            image,
+            mask,
+            batches,
+        )
+        engine = AugmentationEngine(spatial_augs, color_augs, mode, mode)
+        cached = ms_per_batch(engine, image, mask, batches)
+        print(f"{name:<8} {legacy:>14.1f} {cached:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the per-batch augmentation latency."
+    )
+    parser.add_argument("config", type=str, help="Configuration module")
+    parser.add_argument(
+        "--batches", type=int, default=50, help="Batches per variant"
+    )
+    parser.add_argument(
+        "--channels", type=int, default=5, help="Image channels"
+    )
+    args = parser.parse_args()
+    main(importlib.import_module(args.config), args.batches, args.channels)
@@ -0,0 +1,198 @@
+"""
+Check that resuming a checkpoint reproduces the rest of an interrupted epoch.
+
+Trains a small model for two epochs on masks of a synthetic KaneCounty layer,
+drawn by BalancedRandomBatchGeoSampler through a DataLoader with workers and a
+DevicePrefetcher, as train.py does, and saves a checkpoint partway through the
+first epoch with save_checkpoint. A second run, built from a differently
+seeded sampler and model, restores the checkpoint with load_checkpoint and
+trains to the end. Its batches, losses and final parameters must match those
+of the uninterrupted run from the checkpoint on. Noise drawn from the global
+torch RNG on every batch, at a scale picked with Python's RNG, stands in for
+the augmentations applied on the device.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.checkpoint_resume [--batches <num>]
+    [--resume_at <num>] [--num_workers <num>]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import torch
+from rasterio.crs import CRS
+from torch.utils.data import DataLoader
+from torchgeo.datasets import stack_samples
+
+from benchmarks.kc_payload import LABELS, RES, SyntheticKaneCounty
+from data.prefetch import DevicePrefetcher
+from data.sampler import BalancedRandomBatchGeoSampler
+from utils.checkpoint import load_checkpoint, save_checkpoint
+
+BATCH_SIZE = 8
+CHIP_SIZE = 64
+EPOCHS = 2
+
+
+def build(dataset, seed: int, batches: int, num_workers: int):
+    """
+    Return a model, its optimizer and a prefetched training DataLoader.
+    """
+    torch.manual_seed(seed)
+    random.seed(seed)
+    model = torch.nn.Conv2d(1, len(LABELS), 3, padding=1)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+    sampler = BalancedRandomBatchGeoSampler(
+        config={
+            "dataset": dataset,
+            "size": CHIP_SIZE,
+            "batch_size": BATCH_SIZE,
+            "length": batches * BATCH_SIZE,
+            "generator": torch.Generator().manual_seed(seed),
+        }
+    )
+    dataloader = DataLoader(
+        dataset,
+        batch_sampler=sampler,
+        collate_fn=stack_samples,
+        num_workers=num_workers,
+        # as in train.py, the worker seeds are not drawn from the global RNG
+        generator=torch.Generator().manual_seed(seed),
+    )
+    return model, optimizer, DevicePrefetcher(dataloader, "cpu", keys=("mask",))
+
+
+def run(model, optimizer, dataloader, start_epoch=0, start=0, checkpoint=None):
+    """
+    Train to the last epoch and return the boxes and loss of every batch.
+
+    Args:
+        model: model to train
+        optimizer: optimizer updating the model parameters
+        dataloader: prefetched training DataLoader
+        start_epoch: epoch to start at
+        start: batches of the first epoch already trained on
+        checkpoint: (path, batch) to save a checkpoint after that many
+            batches of the first epoch, or None
+
+    Returns:
+        list: (epoch, batch, boxes, loss) of each batch trained on
+    """
+    history = []
+    for epoch in range(start_epoch, EPOCHS):
+        for batch, sample in enumerate(dataloader, start):
+            mask = sample["mask"].long()
+            # the augmentations on the device draw from the global RNGs,
+            # Python's picking which of them are applied
+            scale = random.choice((0.5, 1.0, 2.0))
+            noise = scale * torch.randn(mask[:, None].shape)
+            x = mask[:, None].float() + noise
+            loss = torch.nn.functional.cross_entropy(model(x), mask)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            boxes = [tuple(box) for box in sample["bbox"]]
+            history.append((epoch, batch, boxes, loss.item()))
+            if (
+                checkpoint is not None
+                and epoch == 0
+                and batch + 1 == checkpoint[1]
+            ):
+                progress = {
+                    "seed": 0,
+                    "epoch": epoch,
+                    "best_loss": None,
+                    "plateau_count": 0,
+                }
+                save_checkpoint(
+                    checkpoint[0],
+                    model,
+                    optimizer,
+                    dataloader,
+                    progress,
+                    batch + 1,
+                )
+        start = 0
+    return history
+
+
+def main(batches: int, resume_at: int, num_workers: int) -> None:
+    """
+    Run the check, print the results and exit with an error on a mismatch.
+
+    Args:
+        batches: number of batches per epoch
+        resume_at: number of batches of the first epoch before the checkpoint
+        num_workers: number of DataLoader workers
+    """
+    if not 0 < resume_at < batches:
+        raise ValueError(f"resume_at must be within the {batches} batches")
+    torch.set_num_threads(1)
+    SyntheticKaneCounty.num_polygons = 2000
+    dataset = SyntheticKaneCounty(
+        "synthetic", (None, LABELS, CHIP_SIZE, CRS.from_epsg(26916), RES)
+    )
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "checkpoint.pth")
+        model, optimizer, dataloader = build(dataset, 0, batches, num_workers)
+        full = run(model, optimizer, dataloader, checkpoint=(path, resume_at))
+        full_params = [p.detach().clone() for p in model.parameters()]
+
+        model, optimizer, dataloader = build(dataset, 1, batches, num_workers)
+        checkpoint = torch.load(path)
+        load_checkpoint(checkpoint, model, optimizer, dataloader)
+        resumed = run(
+            model,
+            optimizer,
+            dataloader,
+            checkpoint["epoch"],
+            checkpoint["batch"],
+        )
+
+    expected = full[resume_at:]
+    checks = {
+        "batches": [item[:2] for item in resumed]
+        == [item[:2] for item in expected],
+        "boxes": [item[2] for item in resumed]
+        == [item[2] for item in expected],
+        "losses": [item[3] for item in resumed]
+        == [item[3] for item in expected],
+        "parameters": all(
+            torch.equal(p, q) for p, q in zip(model.parameters(), full_params)
+        ),
+    }
+    print(
+        f"epochs: {EPOCHS}, batches: {batches}, resumed at: {resume_at}, "
+        f"workers: {num_workers}"
+    )
+    print(
+        f"{'resumed batches':<16} {len(resumed):>6} (expected {len(expected)})"
+    )
+    for name, passed in checks.items():
+        print(f"{name:<16} {'match' if passed else 'DIFFER':>6}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that a resumed checkpoint reproduces its epoch."
+    )
+    parser.add_argument(
+        "--batches", type=int, default=20, help="Batches per epoch"
+    )
+    parser.add_argument(
+        "--resume_at",
+        type=int,
+        default=7,
+        help="Batches of the first epoch before the checkpoint",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=2, help="DataLoader workers"
+    )
+    args = parser.parse_args()
+    main(args.batches, args.resume_at, args.num_workers)
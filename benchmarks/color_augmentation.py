@@ -0,0 +1,152 @@
+"""
+Benchmark the color augmentation step of the training augmentations.
+
+Compares separating the RGB and other channels, recombining them into a new
+tensor and masking the padding, as apply_color used to, with augmenting a
+view of the RGB channels in place. Each variant runs on spatially augmented
+batches with the configured color pipeline and with an identity, which
+isolates the cost of moving the channels around. Each variant runs in a fresh
+process and reports the step time and the peak memory allocated by the step:
+CUDA's allocator statistics on GPU, the growth of the peak resident set size
+on CPU.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.color_augmentation configs.<config>
+    [--batches <num>] [--channels <num>]
+"""
+
+import argparse
+import importlib
+import multiprocessing as mp
+import resource
+import time
+
+import kornia.augmentation as K
+import torch
+
+from utils.transforms import (
+    apply_color,
+    combine_channels,
+    create_augmentation_pipelines,
+    separate_channels,
+)
+
+MODEL_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+RGB_CHANNELS = [0, 1, 2]
+
+
+def legacy_apply_color(color_fn, augmented_image, rgb_channels):
+    """
+    Apply a color augmentation to new tensors, as apply_color used to.
+    """
+    rgb_mask = torch.zeros(
+        augmented_image.shape[1],
+        dtype=torch.bool,
+        device=augmented_image.device,
+    )
+    rgb_mask[rgb_channels] = True
+    rgb_only, non_rgb = separate_channels(augmented_image, rgb_channels)
+    fully_augmented_image = combine_channels(
+        color_fn(rgb_only), non_rgb, rgb_mask, augmented_image.shape
+    )
+    fully_augmented_image *= augmented_image.any(dim=1, keepdim=True)
+    return fully_augmented_image
+
+
+def peak_bytes() -> int:
+    """
+    Return the peak memory of this process on the model device.
+    """
+    if MODEL_DEVICE == "cuda":
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(config_name, step, color, batches, channels, results):
+    """
+    Time one color step and measure the peak memory it allocates.
+    """
+    config = importlib.import_module(config_name)
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    if color:
+        _, color_augs = create_augmentation_pipelines(
+            config, config.SPATIAL_AUG_INDICES, config.IMAGE_AUG_INDICES
+        )
+        color_fn = K.AugmentationSequential(
+            *color_augs, data_keys=["image"], same_on_batch=False
+        )
+    else:
+        color_fn = torch.nn.Identity()
+    color_step = legacy_apply_color if step == "legacy" else apply_color
+
+    shape = (config.BATCH_SIZE, channels, config.PATCH_SIZE, config.PATCH_SIZE)
+    spatial_output = torch.rand(shape, device=MODEL_DEVICE)
+    # a band of padding, as left by the rotations and affine transforms
+    spatial_output[:, :, : config.PATCH_SIZE // 8] = 0
+    augmented_image = spatial_output.clone()
+
+    # the first step sets the peak; large CPU buffers are unmapped when freed,
+    # so later steps reuse memory rather than raising the resident set size
+    if MODEL_DEVICE == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    baseline = peak_bytes()
+    color_step(color_fn, augmented_image, RGB_CHANNELS)
+    peak = peak_bytes() - baseline
+
+    elapsed = 0.0
+    for _ in range(batches):
+        augmented_image.copy_(spatial_output)
+        start = time.perf_counter()
+        color_step(color_fn, augmented_image, RGB_CHANNELS)
+        if MODEL_DEVICE == "cuda":
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+    results.put((elapsed / batches * 1000, peak))
+
+
+def main(config_name: str, batches: int, channels: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        config_name: name of the configuration module
+        batches: number of batches augmented per variant
+        channels: number of image channels
+    """
+    config = importlib.import_module(config_name)
+    shape = (config.BATCH_SIZE, channels, config.PATCH_SIZE, config.PATCH_SIZE)
+    print(f"device: {MODEL_DEVICE}, batch: {shape}")
+    print(f"{'color_fn':<9} {'step':<9} {'step ms':>8} {'peak MB':>8}")
+    ctx = mp.get_context("spawn")
+    for color in (False, True):
+        for step in ("legacy", "in-place"):
+            results = ctx.Queue()
+            process = ctx.Process(
+                target=run,
+                args=(config_name, step, color, batches, channels, results),
+            )
+            process.start()
+            elapsed, peak = results.get()
+            process.join()
+            color_name = "pipeline" if color else "identity"
+            print(
+                f"{color_name:<9} {step:<9} {elapsed:>8.2f} "
+                f"{peak / 2**20:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the color augmentation step."
+    )
+    parser.add_argument("config", type=str, help="Configuration module")
+    parser.add_argument(
+        "--batches", type=int, default=50, help="Batches per variant"
+    )
+    parser.add_argument(
+        "--channels", type=int, default=5, help="Image channels"
+    )
+    args = parser.parse_args()
+    main(args.config, args.batches, args.channels)
@@ -0,0 +1,148 @@
+"""
+Benchmark KaneDEM sample latency with and without the NAIP-aligned cache.
+
+Writes a synthetic DEM in a different CRS than the image grid, aligns it with
+align_dem and times random chip reads from the warped and aligned datasets.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.dem_cache [--num_queries <num>] [--workdir <dir>]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+import rasterio.warp
+from rasterio.crs import CRS
+from torchgeo.datasets import BoundingBox
+
+from data.dem import KaneDEM, align_dem
+
+DEM_CRS = CRS.from_epsg(3435)  # NAD83 / Illinois East (ftUS)
+DEM_RES = 2.5
+DEM_SIZE = 4000
+NAIP_CRS = CRS.from_epsg(26916)
+NAIP_RES = 0.6
+PATCH_SIZE = 256
+
+
+def write_synthetic_dem(path: str) -> None:
+    """
+    Write a smooth synthetic DEM tile in the DEM CRS.
+    """
+    yy, xx = np.mgrid[0:DEM_SIZE, 0:DEM_SIZE].astype(np.float32)
+    elevation = 700 + 20 * np.sin(xx / 300) + 15 * np.cos(yy / 450)
+    transform = rasterio.transform.from_origin(
+        950000, 1900000, DEM_RES, DEM_RES
+    )
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=DEM_SIZE,
+        width=DEM_SIZE,
+        count=1,
+        dtype="float32",
+        crs=DEM_CRS,
+        transform=transform,
+    ) as dst:
+        dst.write(elevation, 1)
+
+
+def make_queries(dataset, num_queries, seed=0):
+    """
+    Create chip-sized queries inside the bounds of the dataset.
+    """
+    rng = np.random.default_rng(seed)
+    size = PATCH_SIZE * NAIP_RES
+    bounds = dataset.bounds
+    queries = []
+    for _ in range(num_queries):
+        minx = rng.uniform(bounds.minx + size, bounds.maxx - 2 * size)
+        maxy = rng.uniform(bounds.miny + 2 * size, bounds.maxy - size)
+        minx = round(minx / NAIP_RES) * NAIP_RES
+        maxy = round(maxy / NAIP_RES) * NAIP_RES
+        queries.append(
+            BoundingBox(minx, minx + size, maxy - size, maxy, 0, sys.maxsize)
+        )
+    return queries
+
+
+def time_queries(dataset, queries):
+    """
+    Return the mean latency of reading each query from the dataset.
+    """
+    dataset[queries[0]]  # open the file handle
+    start = time.perf_counter()
+    for query in queries:
+        dataset[query]
+    return (time.perf_counter() - start) / len(queries)
+
+
+def main(num_queries: int, workdir: str) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        num_queries: number of chips read per dataset
+        workdir: directory for the synthetic and aligned DEMs
+    """
+    raw_root = os.path.join(workdir, "raw")
+    aligned_root = os.path.join(workdir, "aligned")
+    os.makedirs(raw_root, exist_ok=True)
+    os.makedirs(aligned_root, exist_ok=True)
+    raw_path = os.path.join(raw_root, "synthetic2017BE.tif")
+    write_synthetic_dem(raw_path)
+
+    start = time.perf_counter()
+    align_dem(
+        raw_path,
+        os.path.join(aligned_root, "synthetic2017BE.tif"),
+        NAIP_CRS,
+        NAIP_RES,
+    )
+    align_time = time.perf_counter() - start
+
+    warped = KaneDEM(raw_root, crs=NAIP_CRS, res=NAIP_RES)
+    aligned = KaneDEM(aligned_root, aligned=True)
+    queries = make_queries(aligned, num_queries)
+
+    warped_time = time_queries(warped, queries)
+    aligned_time = time_queries(aligned, queries)
+    diff = max(
+        (warped[q]["image"] - aligned[q]["image"]).abs().max().item()
+        for q in queries[:20]
+    )
+
+    print(f"one-time alignment:  {align_time:.2f} s")
+    print(f"warped on the fly:   {warped_time * 1000:.2f} ms/sample")
+    print(f"aligned cache:       {aligned_time * 1000:.2f} ms/sample")
+    print(f"max abs difference:  {diff:.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark KaneDEM reads with and without alignment."
+    )
+    parser.add_argument(
+        "--num_queries",
+        type=int,
+        default=500,
+        help="Number of chips read per dataset",
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        default=None,
+        help="Directory for the synthetic DEMs (defaults to a temp dir)",
+    )
+    args = parser.parse_args()
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            main(args.num_queries, tmp)
+    else:
+        main(args.num_queries, args.workdir)
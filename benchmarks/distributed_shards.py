@@ -0,0 +1,161 @@
+"""
+Check how the balanced samplers shard an epoch across distributed ranks.
+
+Starts a process group of CPU ranks with the gloo backend. Each rank builds
+both samplers over a synthetic KaneCounty layer, taking its rank and the
+number of replicas from the process group as train.py does. The script then
+checks two things:
+- The random batches of different ranks never share a box, and together they
+  make up a whole single-process epoch.
+- The grid windows of all ranks, without padding, concatenate in rank order
+  to the single-process grid, and every rank yields the same number.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.distributed_shards [--ranks <num> ...]
+    [--num_polygons <num>]
+"""
+
+import argparse
+import os
+import socket
+import sys
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from rasterio.crs import CRS
+
+from benchmarks.kc_payload import LABELS, PATCH_SIZE, RES, SyntheticKaneCounty
+from data.sampler import BalancedGridGeoSampler, BalancedRandomBatchGeoSampler
+
+BATCH_SIZE = 16
+SEED = 0
+
+
+def build_samplers(num_polygons: int):
+    """
+    Return the random and grid samplers over a synthetic layer.
+    """
+    SyntheticKaneCounty.num_polygons = num_polygons
+    dataset = SyntheticKaneCounty(
+        "synthetic", (None, LABELS, PATCH_SIZE, CRS.from_epsg(26916), RES)
+    )
+    random_sampler = BalancedRandomBatchGeoSampler(
+        config={
+            "dataset": dataset,
+            "size": PATCH_SIZE,
+            "batch_size": BATCH_SIZE,
+            "generator": torch.Generator().manual_seed(SEED),
+        }
+    )
+    grid_sampler = BalancedGridGeoSampler(
+        config={"dataset": dataset, "size": PATCH_SIZE, "stride": PATCH_SIZE}
+    )
+    return random_sampler, grid_sampler
+
+
+def run_rank(rank, world_size, port, num_polygons, results):
+    """
+    Draw an epoch of both samplers on one rank and report it.
+    """
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        random_sampler, grid_sampler = build_samplers(num_polygons)
+        boxes = [tuple(box) for batch in random_sampler for box in batch]
+        windows = [tuple(window) for window in grid_sampler]
+        results.put(
+            (
+                rank,
+                boxes,
+                windows[: grid_sampler.num_windows],
+                len(windows),
+            )
+        )
+    finally:
+        dist.destroy_process_group()
+
+
+def free_port() -> int:
+    """
+    Return a free local TCP port for the process group.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main(ranks, num_polygons: int) -> None:
+    """
+    Run the check, print the results and exit with an error on a failure.
+
+    Args:
+        ranks: numbers of ranks to start process groups with
+        num_polygons: number of polygons in the synthetic layer
+    """
+    random_sampler, grid_sampler = build_samplers(num_polygons)
+    epoch = len(random_sampler) * BATCH_SIZE
+    grid = [tuple(window) for window in grid_sampler]
+    print(f"single process: {epoch} random boxes, {len(grid)} grid windows")
+    print(
+        f"{'ranks':>5} {'boxes/rank':>10} {'disjoint':>8} {'epoch':>6} "
+        f"{'windows/rank':>12} {'grid':>6}"
+    )
+
+    passed = True
+    ctx = mp.get_context("spawn")
+    for world_size in ranks:
+        results = ctx.Queue()
+        context = mp.spawn(
+            run_rank,
+            args=(world_size, free_port(), num_polygons, results),
+            nprocs=world_size,
+            join=False,
+        )
+        shards = sorted(results.get() for _ in range(world_size))
+        context.join()
+
+        boxes = [box for _, rank_boxes, _, _ in shards for box in rank_boxes]
+        disjoint = len(set(boxes)) == len(boxes)
+        # each rank draws its share of whole batches of the epoch
+        whole = len(random_sampler) // world_size * world_size * BATCH_SIZE
+        covers = len(boxes) == whole and epoch - whole < world_size * BATCH_SIZE
+        windows = [
+            window
+            for _, _, rank_windows, _ in shards
+            for window in rank_windows
+        ]
+        lengths = {length for _, _, _, length in shards}
+        tiles = windows == grid and len(lengths) == 1
+        passed &= disjoint and covers and tiles
+        print(
+            f"{world_size:>5} {len(shards[0][1]):>10} "
+            f"{'yes' if disjoint else 'NO':>8} "
+            f"{'whole' if covers else 'SHORT':>6} "
+            f"{lengths.pop() if len(lengths) == 1 else 'uneven':>12} "
+            f"{'covers' if tiles else 'DIFFER':>6}"
+        )
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the sampler shards of distributed ranks."
+    )
+    parser.add_argument(
+        "--ranks",
+        type=int,
+        nargs="+",
+        default=[2, 3],
+        help="Numbers of ranks to check",
+    )
+    parser.add_argument(
+        "--num_polygons",
+        type=int,
+        default=500,
+        help="Polygons in the synthetic layer",
+    )
+    args = parser.parse_args()
+    main(args.ranks, args.num_polygons)
@@ -0,0 +1,146 @@
+"""
+Benchmark the evaluation grid of BalancedGridGeoSampler.
+
+Compares tiling every hit independently, as the sampler used to, with the
+windows snapped to the stride grid and deduplicated. For each grid it reports
+the number of windows, the time to read and score all of them, and the
+Jaccard index of a stand-in prediction: the mask read a few pixels away from
+each window, as from a model with a small localisation error.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.eval_grid [--num_polygons <num>] [--stride <px>]
+    [--max_overlap <frac>] [--shift <px>]
+"""
+
+import argparse
+import time
+
+import torch
+from rasterio.crs import CRS
+from torchgeo.datasets import BoundingBox
+from torchmetrics.classification import MulticlassJaccardIndex
+
+from benchmarks.kc_payload import LABELS, PATCH_SIZE, RES, SyntheticKaneCounty
+from data.sampler import BalancedGridGeoSampler
+
+
+class PerHitGridGeoSampler(BalancedGridGeoSampler):
+    """Grid sampler tiling every hit independently, as it used to."""
+
+    def snap(self, windows, hits):
+        return windows
+
+    def deduplicate(self, windows):
+        return windows
+
+
+def evaluate(dataset, sampler, shift: float, batch_size: int = 16):
+    """
+    Return the time to score every window of a sampler and the Jaccard index.
+
+    Args:
+        dataset: dataset the windows are read from
+        sampler: grid sampler yielding the windows
+        shift: offset of the stand-in prediction in CRS units
+        batch_size: number of windows scored per metric update
+    """
+    jaccard = MulticlassJaccardIndex(
+        num_classes=len(LABELS), ignore_index=0, average="micro"
+    )
+    targets, preds = [], []
+    start = time.perf_counter()
+    for window in sampler:
+        target = dataset[window]["mask"]
+        shifted = BoundingBox(
+            window.minx + shift,
+            window.maxx + shift,
+            window.miny + shift,
+            window.maxy + shift,
+            window.mint,
+            window.maxt,
+        )
+        try:
+            pred = dataset[shifted]["mask"]
+        except IndexError:  # moved off every basin
+            pred = torch.zeros_like(target)
+        targets.append(target)
+        preds.append(pred)
+        if len(targets) == batch_size:
+            jaccard.update(
+                torch.stack(preds).long(), torch.stack(targets).long()
+            )
+            targets, preds = [], []
+    if targets:
+        jaccard.update(torch.stack(preds).long(), torch.stack(targets).long())
+    return time.perf_counter() - start, float(jaccard.compute())
+
+
+def main(
+    num_polygons: int, stride: int, max_overlap: float, shift: int
+) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        num_polygons: number of polygons in the synthetic layer
+        stride: distance between windows in pixels
+        max_overlap: max_overlap of the deduplicated grid
+        shift: offset of the stand-in prediction in pixels
+    """
+    SyntheticKaneCounty.num_polygons = num_polygons
+    configs = (None, LABELS, PATCH_SIZE, CRS.from_epsg(26916), RES)
+    dataset = SyntheticKaneCounty("synthetic", configs)
+    sampler_config = {
+        "dataset": dataset,
+        "size": PATCH_SIZE,
+        "stride": stride,
+        "max_overlap": max_overlap,
+    }
+
+    print(
+        f"polygons: {num_polygons}, stride: {stride}, "
+        f"max_overlap: {max_overlap}, shift: {shift}"
+    )
+    print(f"{'grid':<8} {'windows':>8} {'eval s':>8} {'IoU':>8}")
+    results = {}
+    for name, sampler_class in (
+        ("per-hit", PerHitGridGeoSampler),
+        ("snapped", BalancedGridGeoSampler),
+    ):
+        sampler = sampler_class(sampler_config)
+        elapsed, iou = evaluate(dataset, sampler, shift * RES)
+        results[name] = iou
+        print(f"{name:<8} {len(sampler):>8} {elapsed:>8.2f} {iou:>8.4f}")
+    print(f"IoU drift: {results['snapped'] - results['per-hit']:+.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the BalancedGridGeoSampler evaluation grid."
+    )
+    parser.add_argument(
+        "--num_polygons",
+        type=int,
+        default=5000,
+        help="Number of polygons in the synthetic layer",
+    )
+    parser.add_argument(
+        "--stride",
+        type=int,
+        default=PATCH_SIZE,
+        help="Distance between windows in pixels",
+    )
+    parser.add_argument(
+        "--max_overlap",
+        type=float,
+        default=0.5,
+        help="Share of a window's area it may have in common with another",
+    )
+    parser.add_argument(
+        "--shift",
+        type=int,
+        default=8,
+        help="Offset of the stand-in prediction in pixels",
+    )
+    args = parser.parse_args()
+    main(args.num_polygons, args.stride, args.max_overlap, args.shift)
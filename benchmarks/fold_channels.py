@@ -0,0 +1,150 @@
+"""
+Benchmark folding copied input channels into the first convolution.
+
+Compares the configured model taking its default input channels, filled with
+copies of band 0, with the same model after fold_input_channels, taking the
+NAIP bands themselves. For each it reports the bytes copied to the device per
+batch, the multiply-adds of the first convolution, the forward time per batch
+and the largest difference between the outputs.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.fold_channels configs.<config> [--batches <num>]
+    [--in_channels <num>]
+"""
+
+import argparse
+import copy
+import importlib
+import time
+
+import torch
+
+from model import SegmentationModel, fold_input_channels
+from utils.transforms import InputTransform
+
+MODEL_DEVICE = (
+    "cuda"
+    if torch.cuda.is_available()
+    else "mps" if torch.backends.mps.is_available() else "cpu"
+)
+
+
+def synchronize() -> None:
+    """
+    Wait for pending work on the model device.
+    """
+    if MODEL_DEVICE == "cuda":
+        torch.cuda.synchronize()
+    elif MODEL_DEVICE == "mps":
+        torch.mps.synchronize()
+
+
+def first_conv_macs(model, in_channels: int, image_size: int) -> int:
+    """
+    Return the multiply-adds of the first convolution for one image.
+    """
+    conv = next(
+        module
+        for module in model.modules()
+        if isinstance(module, torch.nn.Conv2d)
+        and module.in_channels == in_channels
+    )
+    height = (image_size + 2 * conv.padding[0] - conv.kernel_size[0]) // (
+        conv.stride[0]
+    ) + 1
+    width = (image_size + 2 * conv.padding[1] - conv.kernel_size[1]) // (
+        conv.stride[1]
+    ) + 1
+    return conv.weight.numel() * height * width
+
+
+@torch.no_grad()
+def forward_ms(model, transform, image, batches: int):
+    """
+    Return the mean time in milliseconds of a forward pass and the output.
+    """
+    x = image.to(MODEL_DEVICE)
+    if transform.channels.numel() > image.size(1):
+        # as before, the copies are made on the host and moved with the bands
+        x = transform.expand(image).to(MODEL_DEVICE)
+    output = model(transform(x))
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(batches):
+        model(transform(x))
+    synchronize()
+    return (time.perf_counter() - start) / batches * 1000, x, output
+
+
+def main(config, batches: int, in_channels: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        config: configuration module
+        batches: number of batches per variant
+        in_channels: number of input channels of the unfolded model
+    """
+    bands = len(config.DATASET_MEAN)
+    torch.manual_seed(0)
+    full = SegmentationModel(
+        {
+            "model": config.MODEL,
+            "backbone": config.BACKBONE,
+            "num_classes": config.NUM_CLASSES,
+            "weights": None,
+            "in_channels": in_channels,
+        }
+    ).model
+    folded = copy.deepcopy(full)
+    fold_input_channels(folded, in_channels, bands)
+    image = torch.randint(
+        0, 256, (config.BATCH_SIZE, bands, config.PATCH_SIZE, config.PATCH_SIZE)
+    ).float()
+
+    print(
+        f"device: {MODEL_DEVICE}, model: {config.MODEL} {config.BACKBONE}, "
+        f"batch: {tuple(image.shape)}"
+    )
+    print(
+        f"{'input':<10} {'MB to device':>13} {'conv1 GMACs':>12} "
+        f"{'forward ms':>11}"
+    )
+    outputs = []
+    for name, model, channels in (
+        (f"{in_channels} chans", full, in_channels),
+        (f"{bands} bands", folded, bands),
+    ):
+        model = model.to(MODEL_DEVICE).eval()
+        transform = InputTransform(
+            config.DATASET_MEAN, config.DATASET_STD, channels
+        ).to(MODEL_DEVICE)
+        elapsed, x, output = forward_ms(model, transform, image, batches)
+        outputs.append(output)
+        macs = first_conv_macs(model, channels, config.PATCH_SIZE)
+        macs *= config.BATCH_SIZE
+        print(
+            f"{name:<10} {x.numel() * x.element_size() / 2**20:>13.1f} "
+            f"{macs / 1e9:>12.2f} {elapsed:>11.1f}"
+        )
+    diff = (outputs[0] - outputs[1]).abs().max().item()
+    scale = outputs[0].abs().max().item()
+    print(f"max output difference: {diff:.1e} (max output {scale:.1e})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark folding copied channels into the first conv."
+    )
+    parser.add_argument("config", type=str, help="Configuration module")
+    parser.add_argument(
+        "--batches", type=int, default=5, help="Batches per variant"
+    )
+    parser.add_argument(
+        "--in_channels",
+        type=int,
+        default=5,
+        help="Input channels of the unfolded model",
+    )
+    args = parser.parse_args()
+    main(importlib.import_module(args.config), args.batches, args.in_channels)
@@ -0,0 +1,147 @@
+"""
+Benchmark NAIP chip reads against the number of open file handles per worker.
+
+Writes a grid of synthetic NAIP-like tiles and reads random chips from it with
+a PooledNAIP dataset for a range of pool sizes, and with torchgeo's uncached
+reads that open and close every file on each chip.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.handle_pool [--grid <num>] [--num_chips <num>]
+    [--num_workers <num>]
+"""
+
+import argparse
+import functools
+import os
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+import torch
+from rasterio.transform import from_origin
+from torch.utils.data import DataLoader
+from torchgeo.datasets import BoundingBox, stack_samples
+
+from data.handles import PooledNAIP, configure_gdal
+
+PATCH_SIZE = 256
+RES = 0.6
+TILE_SIZE = 1024
+GDAL_OPTIONS = {"GDAL_CACHEMAX": 256, "GDAL_NUM_THREADS": 1, "VSI_CACHE": True}
+
+
+def make_tiles(root: str, grid: int) -> None:
+    """
+    Write a grid x grid mosaic of tiled 4-band uint8 GeoTIFFs.
+    """
+    rng = np.random.default_rng(0)
+    for i in range(grid):
+        for j in range(grid):
+            transform = from_origin(
+                400000 + j * TILE_SIZE * RES,
+                4650000 - i * TILE_SIZE * RES,
+                RES,
+                RES,
+            )
+            with rasterio.open(
+                os.path.join(
+                    root, f"m_41088{i:02d}{j:02d}_ne_16_060_20210601.tif"
+                ),
+                "w",
+                driver="GTiff",
+                width=TILE_SIZE,
+                height=TILE_SIZE,
+                count=4,
+                dtype="uint8",
+                crs="EPSG:26916",
+                transform=transform,
+                tiled=True,
+                blockxsize=PATCH_SIZE,
+                blockysize=PATCH_SIZE,
+                compress="deflate",
+            ) as dst:
+                dst.write(
+                    rng.integers(0, 255, (4, TILE_SIZE, TILE_SIZE), np.uint8)
+                )
+
+
+def make_queries(dataset, num_chips: int, seed: int = 0):
+    """
+    Create random chip queries within the bounds of a dataset.
+    """
+    rng = np.random.default_rng(seed)
+    bounds = dataset.bounds
+    size = PATCH_SIZE * RES
+    xs = rng.uniform(bounds.minx, bounds.maxx - size, num_chips)
+    ys = rng.uniform(bounds.miny, bounds.maxy - size, num_chips)
+    return [
+        BoundingBox(x, x + size, y, y + size, bounds.mint, bounds.maxt)
+        for x, y in zip(xs, ys)
+    ]
+
+
+def chips_per_second(dataset, queries, num_workers: int) -> float:
+    """
+    Return the rate at which a DataLoader reads the queried chips.
+    """
+    dataloader = DataLoader(
+        dataset,
+        batch_size=16,
+        sampler=queries,
+        collate_fn=stack_samples,
+        num_workers=num_workers,
+        worker_init_fn=functools.partial(configure_gdal, options=GDAL_OPTIONS),
+    )
+    start = time.perf_counter()
+    for _ in dataloader:
+        pass
+    return len(queries) / (time.perf_counter() - start)
+
+
+def main(grid: int, num_chips: int, num_workers: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        grid: number of tiles along each side of the mosaic
+        num_chips: number of chips read per configuration
+        num_workers: number of DataLoader workers
+    """
+    torch.set_num_threads(1)
+    if num_workers == 0:
+        configure_gdal(0, GDAL_OPTIONS)
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tiles(root, grid)
+        print(
+            f"tiles: {grid * grid}, chips: {num_chips}, workers: {num_workers}"
+        )
+        print(f"{'open handles':<13} {'chips/s':>8}")
+
+        dataset = PooledNAIP(root, cache=False)
+        queries = make_queries(dataset, num_chips)
+        rate = chips_per_second(dataset, queries, num_workers)
+        print(f"{'uncached':<13} {rate:>8.1f}")
+
+        for max_open_handles in (1, 2, 4, 8, 16, 64):
+            dataset = PooledNAIP(root, max_open_handles=max_open_handles)
+            rate = chips_per_second(dataset, queries, num_workers)
+            print(f"{max_open_handles:<13} {rate:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark chip reads against the number of open handles."
+    )
+    parser.add_argument(
+        "--grid", type=int, default=6, help="Tiles along each mosaic side"
+    )
+    parser.add_argument(
+        "--num_chips", type=int, default=2000, help="Chips read per setting"
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=0, help="DataLoader workers"
+    )
+    args = parser.parse_args()
+    main(args.grid, args.num_chips, args.num_workers)
@@ -0,0 +1,136 @@
+"""
+Benchmark the preparation of model input from a batch of NAIP chips.
+
+Compares the steps train.py used to take on every batch, copying channel 0 on
+the host until the image has the model's channels, rebuilding the scale and
+normalize transforms and applying them in two passes, with an InputTransform
+built once, which expands the channels on the model device and scales and
+normalizes them in one multiply-add. For each it reports the time per batch,
+the bytes copied to the device and the largest difference from the old
+output.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.input_transform configs.<config> [--batches <num>]
+    [--in_channels <num>]
+"""
+
+import argparse
+import importlib
+import time
+
+import kornia.augmentation as K
+import torch
+
+from utils.transforms import InputTransform
+
+MODEL_DEVICE = (
+    "cuda"
+    if torch.cuda.is_available()
+    else "mps" if torch.backends.mps.is_available() else "cpu"
+)
+
+
+def synchronize() -> None:
+    """
+    Wait for pending work on the model device.
+    """
+    if MODEL_DEVICE == "cuda":
+        torch.cuda.synchronize()
+    elif MODEL_DEVICE == "mps":
+        torch.mps.synchronize()
+
+
+def legacy_input(image, mean, std, in_channels):
+    """
+    Prepare model input as train.py used to.
+    """
+    while image.size(1) < in_channels:
+        image = torch.cat((image, image[:, :1].clone()), dim=1)
+    x = image.to(MODEL_DEVICE)
+    # pad copies of the statistics without modifying the configured lists
+    extra = in_channels - len(mean)
+    mean = list(mean) + [mean[0]] * extra
+    std = list(std) + [std[0]] * extra
+    normalize = K.Normalize(mean=mean, std=std)
+    scale = K.Normalize(mean=torch.tensor(0.0), std=torch.tensor(255.0))
+    return normalize(scale(x)), x.numel() * x.element_size()
+
+
+def fused_input(image, transform):
+    """
+    Prepare model input with an InputTransform.
+    """
+    x = image.to(MODEL_DEVICE)
+    return transform(x), x.numel() * x.element_size()
+
+
+def ms_per_batch(prepare, image, batches: int):
+    """
+    Return the mean time in milliseconds to prepare a batch, the bytes copied
+    to the device per batch and the prepared input.
+    """
+    output, moved = prepare(image)
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(batches):
+        prepare(image)
+    synchronize()
+    return (time.perf_counter() - start) / batches * 1000, moved, output
+
+
+def main(config, batches: int, in_channels: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        config: configuration module
+        batches: number of batches prepared per variant
+        in_channels: number of channels the model takes
+    """
+    bands = len(config.DATASET_MEAN)
+    image = torch.randint(
+        0, 256, (config.BATCH_SIZE, bands, config.PATCH_SIZE, config.PATCH_SIZE)
+    ).float()
+    transform = InputTransform(
+        config.DATASET_MEAN, config.DATASET_STD, in_channels
+    ).to(MODEL_DEVICE)
+
+    print(
+        f"device: {MODEL_DEVICE}, batch: {tuple(image.shape)}, "
+        f"in_channels: {in_channels}"
+    )
+    print(f"{'input':<8} {'ms/batch':>9} {'MB to device':>13} {'max diff':>9}")
+    legacy_ms, legacy_moved, expected = ms_per_batch(
+        lambda x: legacy_input(
+            x, config.DATASET_MEAN, config.DATASET_STD, in_channels
+        ),
+        image,
+        batches,
+    )
+    fused_ms, fused_moved, output = ms_per_batch(
+        lambda x: fused_input(x, transform), image, batches
+    )
+    diff = (output - expected).abs().max().item()
+    print(f"{'legacy':<8} {legacy_ms:>9.2f} {legacy_moved / 2**20:>13.1f}")
+    print(
+        f"{'fused':<8} {fused_ms:>9.2f} {fused_moved / 2**20:>13.1f} "
+        f"{diff:>9.1e}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the preparation of model input."
+    )
+    parser.add_argument("config", type=str, help="Configuration module")
+    parser.add_argument(
+        "--batches", type=int, default=50, help="Batches per variant"
+    )
+    parser.add_argument(
+        "--in_channels",
+        type=int,
+        default=5,
+        help="Number of channels the model takes",
+    )
+    args = parser.parse_args()
+    main(importlib.import_module(args.config), args.batches, args.in_channels)
@@ -0,0 +1,149 @@
+"""
+Benchmark the construction of the KaneCounty spatial index.
+
+Compares the row-by-row rtree insertion previously used by
+KaneCounty._populate_index with the bulk-loaded stream on a synthetic layer.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.kc_index [--num_polygons <num>] [--repeats <num>]
+"""
+
+import argparse
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from rtree.index import Index, Property
+from torchgeo.datasets import GeoDataset
+
+from data.kc import KaneCounty
+
+CRS = "EPSG:26916"
+CONTEXT_SIZE = 77
+
+
+def make_synthetic_layer(num_polygons: int, seed: int = 0) -> gpd.GeoDataFrame:
+    """
+    Create a synthetic stormwater layer of random rectangular basins.
+
+    Args:
+        num_polygons: number of polygons in the layer
+        seed: seed for the random number generator
+
+    Returns:
+        GeoDataFrame with BasinType and geometry columns
+    """
+    rng = np.random.default_rng(seed)
+    minx = rng.uniform(380000, 420000, num_polygons)
+    miny = rng.uniform(4620000, 4660000, num_polygons)
+    width = rng.uniform(10, 300, num_polygons)
+    height = rng.uniform(10, 300, num_polygons)
+    geometry = shapely.box(minx, miny, minx + width, miny + height)
+    basin_types = rng.choice(
+        ["POND", "WETLAND", "DRY BOTTOM - TURF", "DRY BOTTOM - MESIC PRAIRIE"],
+        num_polygons,
+    )
+    return gpd.GeoDataFrame(
+        {"BasinType": basin_types}, geometry=geometry, crs=CRS
+    )
+
+
+def legacy_populate_index(gdf, context_size):
+    """
+    Build the index one row at a time, as KaneCounty originally did.
+
+    Args:
+        gdf: GeoDataFrame containing the data
+        context_size: size of the context around shapes for sampling
+
+    Returns:
+        Index: the populated rtree index
+    """
+    index = Index(interleaved=False, properties=Property(dimension=3))
+    for i, (_, row) in enumerate(gdf.iterrows()):
+        minx, miny, maxx, maxy = row["geometry"].bounds
+        coords = (
+            minx - context_size,
+            maxx + context_size,
+            miny - context_size,
+            maxy + context_size,
+            0,
+            sys.maxsize,
+        )
+        index.insert(i, coords, row)
+    return index
+
+
+def bulk_populate_index(gdf, context_size):
+    """
+    Build the index with KaneCounty._populate_index.
+
+    Args:
+        gdf: GeoDataFrame containing the data
+        context_size: size of the context around shapes for sampling
+
+    Returns:
+        Index: the populated rtree index
+    """
+    dataset = KaneCounty.__new__(KaneCounty)
+    GeoDataset.__init__(dataset)
+    dataset._populate_index("synthetic", gdf, context_size)
+    return dataset.index
+
+
+def time_build(build_fn, gdf, repeats):
+    """
+    Return the best wall time and the index from repeated builds.
+    """
+    best = float("inf")
+    index = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        index = build_fn(gdf, CONTEXT_SIZE)
+        best = min(best, time.perf_counter() - start)
+    return best, index
+
+
+def main(num_polygons: int, repeats: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        num_polygons: number of polygons in the synthetic layer
+        repeats: number of times each build is repeated
+    """
+    gdf = make_synthetic_layer(num_polygons)
+
+    legacy_time, legacy_index = time_build(legacy_populate_index, gdf, repeats)
+    bulk_time, bulk_index = time_build(bulk_populate_index, gdf, repeats)
+
+    # both indexes must cover the same extent with the same number of entries
+    assert legacy_index.bounds == bulk_index.bounds
+    assert len(legacy_index) == len(bulk_index) == num_polygons
+
+    print(f"polygons:      {num_polygons}")
+    print(f"iterrows:      {legacy_time:.3f} s")
+    print(f"bulk stream:   {bulk_time:.3f} s")
+    print(f"speedup:       {legacy_time / bulk_time:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark KaneCounty spatial index construction."
+    )
+    parser.add_argument(
+        "--num_polygons",
+        type=int,
+        default=100_000,
+        help="Number of polygons in the synthetic layer",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Number of times each build is repeated",
+    )
+    args = parser.parse_args()
+    main(args.num_polygons, args.repeats)
@@ -0,0 +1,182 @@
+"""
+Benchmark the cost of the KaneCounty index payloads in DataLoader workers.
+
+Compares the pandas row payloads previously stored in the rtree with the
+integer feature ids used now. For each variant it reports the pickled
+dataset size, the resident memory a fresh worker process gains when
+unpickling it, and the mean __getitem__ latency inside that worker.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.kc_payload [--num_polygons <num>] [--num_queries <num>]
+"""
+
+import argparse
+import multiprocessing as mp
+import pickle
+import sys
+import time
+
+import numpy as np
+import rasterio
+import torch
+from rasterio.crs import CRS
+from torchgeo.datasets import BoundingBox, GeoDataset
+
+from benchmarks.kc_index import legacy_populate_index, make_synthetic_layer
+from data.kc import KaneCounty
+
+LABELS = {
+    "BACKGROUND": 0,
+    "POND": 1,
+    "WETLAND": 2,
+    "DRY BOTTOM - TURF": 3,
+    "DRY BOTTOM - MESIC PRAIRIE": 4,
+}
+PATCH_SIZE = 256
+RES = 0.6
+
+
+class SyntheticKaneCounty(KaneCounty):
+    """KaneCounty built from an in-memory synthetic layer."""
+
+    num_polygons = 100_000
+
+    def _load_and_prepare_data(
+        self, path, layer, labels, dest_crs, cache_root=None
+    ):
+        return make_synthetic_layer(self.num_polygons).to_crs(dest_crs)
+
+
+class LegacyKaneCounty(SyntheticKaneCounty):
+    """KaneCounty storing a pandas row per index entry, as it used to."""
+
+    def _populate_index(self, path, gdf, context_size):
+        self.index = legacy_populate_index(gdf, context_size)
+
+    def _rasterize_query(self, query):
+        hits = self.index.intersection(tuple(query), objects=True)
+        shapes = [
+            (hit.object["geometry"], self.labels[hit.object["BasinType"]])
+            for hit in hits
+        ]
+        width = (query.maxx - query.minx) / self._res
+        height = (query.maxy - query.miny) / self._res
+        transform = rasterio.transform.from_bounds(
+            query.minx, query.miny, query.maxx, query.maxy, width, height
+        )
+        return rasterio.features.rasterize(
+            shapes, out_shape=(round(height), round(width)), transform=transform
+        )
+
+    def __getstate__(self):
+        return GeoDataset.__getstate__(self)
+
+
+def current_rss() -> int:
+    """
+    Return the resident set size of this process in bytes.
+    """
+    with open("/proc/self/status", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def worker(payload, queries, results):
+    """
+    Unpickle a dataset in a fresh process and time queries against it.
+
+    Args:
+        payload: the pickled dataset
+        queries: list of bounding boxes to sample
+        results: queue to put (rss delta, mean latency) on
+    """
+    torch.set_num_threads(1)
+    rss_before = current_rss()
+    dataset = pickle.loads(payload)
+    rss_delta = current_rss() - rss_before
+
+    start = time.perf_counter()
+    for query in queries:
+        dataset[query]
+    latency = (time.perf_counter() - start) / len(queries)
+    results.put((rss_delta, latency))
+
+
+def make_queries(dataset, num_queries, seed=0):
+    """
+    Create chip-sized queries centred on random features of the dataset.
+    """
+    rng = np.random.default_rng(seed)
+    half = PATCH_SIZE * RES / 2
+    centroids = dataset.gdf.geometry.centroid
+    queries = []
+    for i in rng.integers(len(centroids), size=num_queries):
+        x, y = centroids.iloc[i].x, centroids.iloc[i].y
+        queries.append(
+            BoundingBox(x - half, x + half, y - half, y + half, 0, sys.maxsize)
+        )
+    return queries
+
+
+def measure(dataset, queries):
+    """
+    Return the pickled size, worker RSS gain and latency for a dataset.
+    """
+    payload = pickle.dumps(dataset)
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=worker, args=(payload, queries, results))
+    process.start()
+    rss_delta, latency = results.get()
+    process.join()
+    return len(payload), rss_delta, latency
+
+
+def main(num_polygons: int, num_queries: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        num_polygons: number of polygons in the synthetic layer
+        num_queries: number of __getitem__ calls timed per variant
+    """
+    SyntheticKaneCounty.num_polygons = num_polygons
+    configs = (None, LABELS, PATCH_SIZE, CRS.from_epsg(26916), RES)
+    variants = {
+        "pandas rows": LegacyKaneCounty("synthetic", configs),
+        "integer ids": SyntheticKaneCounty("synthetic", configs),
+    }
+    queries = make_queries(variants["integer ids"], num_queries)
+
+    print(f"polygons: {num_polygons}, queries: {num_queries}")
+    print(
+        f"{'payload':<12} {'pickle MB':>10} {'worker RSS MB':>14} {'ms/item':>8}"
+    )
+    for name, dataset in variants.items():
+        size, rss_delta, latency = measure(dataset, queries)
+        print(
+            f"{name:<12} {size / 2**20:>10.1f} {rss_delta / 2**20:>14.1f} "
+            f"{latency * 1000:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark KaneCounty index payloads in worker processes."
+    )
+    parser.add_argument(
+        "--num_polygons",
+        type=int,
+        default=100_000,
+        help="Number of polygons in the synthetic layer",
+    )
+    parser.add_argument(
+        "--num_queries",
+        type=int,
+        default=1000,
+        help="Number of __getitem__ calls timed per variant",
+    )
+    args = parser.parse_args()
+    main(args.num_polygons, args.num_queries)
@@ -0,0 +1,94 @@
+"""
+Benchmark the memory and transfer cost of mask batches by dtype.
+
+Collates per-sample masks into a batch with stack_samples and copies the batch
+to the model device, comparing the int64 masks previously produced by
+KaneCounty with the uint8 masks it returns now.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.mask_transfer [--batch_size <num>] [--patch_size <num>]
+"""
+
+import argparse
+import time
+
+import torch
+from torchgeo.datasets import stack_samples
+
+MODEL_DEVICE = (
+    "cuda"
+    if torch.cuda.is_available()
+    else "mps" if torch.backends.mps.is_available() else "cpu"
+)
+
+
+def synchronize() -> None:
+    """
+    Wait for pending work on the model device.
+    """
+    if MODEL_DEVICE == "cuda":
+        torch.cuda.synchronize()
+    elif MODEL_DEVICE == "mps":
+        torch.mps.synchronize()
+
+
+def time_batches(samples, repeats):
+    """
+    Return the mean collate and host-to-device times for a list of samples.
+    """
+    collate_time = 0.0
+    transfer_time = 0.0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        batch = stack_samples(samples)
+        collate_time += time.perf_counter() - start
+
+        synchronize()
+        start = time.perf_counter()
+        batch["mask"].to(MODEL_DEVICE)
+        synchronize()
+        transfer_time += time.perf_counter() - start
+    return batch, collate_time / repeats, transfer_time / repeats
+
+
+def main(batch_size: int, patch_size: int, repeats: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        batch_size: number of masks per batch
+        patch_size: height and width of each mask in pixels
+        repeats: number of batches timed per dtype
+    """
+    masks = torch.randint(0, 5, (batch_size, patch_size, patch_size))
+    print(
+        f"device: {MODEL_DEVICE}, batch: {batch_size}x{patch_size}x{patch_size}"
+    )
+    print(
+        f"{'dtype':<8} {'batch MB':>9} {'collate ms':>11} {'to device ms':>13}"
+    )
+    for dtype in (torch.int64, torch.uint8):
+        samples = [{"mask": mask.to(dtype)} for mask in masks]
+        batch, collate_time, transfer_time = time_batches(samples, repeats)
+        size = batch["mask"].element_size() * batch["mask"].nelement()
+        print(
+            f"{str(dtype).split('.')[-1]:<8} {size / 2**20:>9.2f} "
+            f"{collate_time * 1000:>11.3f} {transfer_time * 1000:>13.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark mask batch size and transfer time by dtype."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=16, help="Number of masks per batch"
+    )
+    parser.add_argument(
+        "--patch_size", type=int, default=256, help="Mask size in pixels"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=100, help="Number of timed batches"
+    )
+    args = parser.parse_args()
+    main(args.batch_size, args.patch_size, args.repeats)
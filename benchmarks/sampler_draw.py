@@ -0,0 +1,98 @@
+"""
+Benchmark the throughput of BalancedRandomBatchGeoSampler.
+
+Compares drawing one hit and one random bounding box per sample, as the
+sampler used to, with drawing the boxes of a whole epoch at once. The sampler
+runs over the index of a synthetic KaneCounty layer.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.sampler_draw [--num_samples <num>] [--num_polygons <num>]
+"""
+
+import argparse
+import time
+
+import torch
+from rasterio.crs import CRS
+from torchgeo.datasets import BoundingBox
+from torchgeo.samplers.utils import get_random_bounding_box
+
+from benchmarks.kc_payload import LABELS, PATCH_SIZE, RES, SyntheticKaneCounty
+from data.sampler import BalancedRandomBatchGeoSampler
+
+BATCH_SIZE = 16
+
+
+class LegacyBalancedRandomBatchGeoSampler(BalancedRandomBatchGeoSampler):
+    """Sampler drawing one hit and bounding box at a time, as it used to."""
+
+    def __iter__(self):
+        hit_bounds = self.bounds
+        for _ in range(len(self)):
+            batch = []
+            for _ in range(self.batch_size):
+                idx = torch.multinomial(self.areas, 1)
+                bounds = BoundingBox(*hit_bounds[idx.item()])
+                bounding_box = get_random_bounding_box(
+                    bounds, self.size, self.res
+                )
+                batch.append(bounding_box)
+            yield batch
+
+
+def samples_per_second(sampler) -> float:
+    """
+    Return the rate at which a sampler yields bounding boxes.
+    """
+    start = time.perf_counter()
+    count = sum(len(batch) for batch in sampler)
+    return count / (time.perf_counter() - start)
+
+
+def main(num_samples: int, num_polygons: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        num_samples: number of bounding boxes drawn per epoch
+        num_polygons: number of polygons in the synthetic layer
+    """
+    SyntheticKaneCounty.num_polygons = num_polygons
+    configs = (None, LABELS, PATCH_SIZE, CRS.from_epsg(26916), RES)
+    dataset = SyntheticKaneCounty("synthetic", configs)
+    sampler_config = {
+        "dataset": dataset,
+        "size": PATCH_SIZE,
+        "batch_size": BATCH_SIZE,
+        "length": num_samples,
+    }
+
+    print(f"polygons: {num_polygons}, samples: {num_samples}")
+    print(f"{'sampler':<10} {'samples/s':>12} {'s/epoch':>8}")
+    for name, sampler_class in (
+        ("per-box", LegacyBalancedRandomBatchGeoSampler),
+        ("epoch", BalancedRandomBatchGeoSampler),
+    ):
+        sampler = sampler_class(sampler_config)
+        rate = samples_per_second(sampler)
+        print(f"{name:<10} {rate:>12.0f} {num_samples / rate:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark BalancedRandomBatchGeoSampler throughput."
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=1_000_000,
+        help="Number of bounding boxes drawn per epoch",
+    )
+    parser.add_argument(
+        "--num_polygons",
+        type=int,
+        default=20_000,
+        help="Number of polygons in the synthetic layer",
+    )
+    args = parser.parse_args()
+    main(args.num_samples, args.num_polygons)
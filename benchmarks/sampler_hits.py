@@ -0,0 +1,159 @@
+"""
+Benchmark the storage of hits in the balanced samplers.
+
+Compares the lists of rtree items the samplers used to keep with the
+HIT_DTYPE arrays they keep now, on the index of a synthetic KaneCounty layer.
+For each sampler and storage it reports the time to compute the hits, the
+memory they retain and their pickled size. rtree items hold ctypes pointers
+and cannot be pickled at all, so the samplers could not be either.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.sampler_hits [--num_polygons <num>]
+"""
+
+import argparse
+import math
+import pickle
+import time
+import tracemalloc
+
+from rasterio.crs import CRS
+from torchgeo.datasets import BoundingBox
+from torchgeo.samplers.utils import tile_to_chips
+
+from benchmarks.kc_payload import LABELS, PATCH_SIZE, RES, SyntheticKaneCounty
+from data.sampler import BalancedGridGeoSampler, BalancedRandomBatchGeoSampler
+
+
+def legacy_random_hits(sampler):
+    """
+    Compute the hits of a random sampler as a list of rtree items.
+    """
+    hits = []
+    areas = []
+    context_x = sampler.size[1] / 2
+    context_y = sampler.size[0] / 2
+    for hit in sampler.index.intersection(tuple(sampler.roi), objects=True):
+        bounds = BoundingBox(*hit.bounds)
+        if (
+            bounds.maxx - bounds.minx >= sampler.size[1]
+            and bounds.maxy - bounds.miny >= sampler.size[0]
+        ):
+            shape_bounds = sampler.get_shape_bounds(
+                bounds, context_x, context_y
+            )
+            if (
+                shape_bounds.maxx - shape_bounds.minx >= sampler.size[1]
+                or shape_bounds.maxy - shape_bounds.miny >= sampler.size[0]
+            ):
+                tile_to_chips(shape_bounds, sampler.size)
+            hits.append(hit)
+            areas.append(shape_bounds.area)
+    return hits
+
+
+def legacy_dimension(interval, size, stride):
+    """
+    Return the number of windows along one side of a hit, as computed before.
+    """
+    min_val, max_val = interval
+    diff = max_val - min_val
+    if diff >= size * 2:
+        return math.ceil((diff - size) / stride) + 1
+    if diff >= size:
+        return 1
+    return 0
+
+
+def legacy_grid_hits(sampler):
+    """
+    Compute the hits of a grid sampler as a list of rtree items.
+    """
+    hits = []
+    for hit in sampler.index.intersection(tuple(sampler.roi), objects=True):
+        bounds = BoundingBox(*hit.bounds)
+        cols = legacy_dimension(
+            (bounds.minx, bounds.maxx), sampler.size[1], sampler.stride[1]
+        )
+        rows = legacy_dimension(
+            (bounds.miny, bounds.maxy), sampler.size[0], sampler.stride[0]
+        )
+        if rows > 0 and cols > 0:
+            hit.bounds = bounds
+            hits.append(hit)
+    return hits
+
+
+def measure(compute_hits):
+    """
+    Return the time, retained memory and pickled size of computed hits.
+
+    The hits are computed twice, since tracing allocations slows down the
+    computation being timed.
+    """
+    start = time.perf_counter()
+    compute_hits()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    hits = compute_hits()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    try:
+        size = f"{len(pickle.dumps(hits)) / 2**20:.2f}"
+    except ValueError:
+        size = "fails"
+    return elapsed, retained, size
+
+
+def main(num_polygons: int) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        num_polygons: number of polygons in the synthetic layer
+    """
+    SyntheticKaneCounty.num_polygons = num_polygons
+    configs = (None, LABELS, PATCH_SIZE, CRS.from_epsg(26916), RES)
+    dataset = SyntheticKaneCounty("synthetic", configs)
+    random_sampler = BalancedRandomBatchGeoSampler(
+        {"dataset": dataset, "size": PATCH_SIZE, "batch_size": 16}
+    )
+    grid_sampler = BalancedGridGeoSampler(
+        {"dataset": dataset, "size": PATCH_SIZE, "stride": PATCH_SIZE}
+    )
+    variants = [
+        ("random", "items", lambda: legacy_random_hits(random_sampler)),
+        ("random", "array", lambda: random_sampler.calculate_hits_and_areas()),
+        ("grid", "items", lambda: legacy_grid_hits(grid_sampler)),
+        ("grid", "array", lambda: grid_sampler.calculate_hits_and_length()),
+    ]
+
+    print(f"polygons: {num_polygons}")
+    print(
+        f"{'sampler':<8} {'hits':<6} {'build s':>8} {'memory MB':>10} "
+        f"{'pickle MB':>10}"
+    )
+    for sampler_name, storage, compute_hits in variants:
+        elapsed, retained, size = measure(compute_hits)
+        print(
+            f"{sampler_name:<8} {storage:<6} {elapsed:>8.3f} "
+            f"{retained / 2**20:>10.2f} {size:>10}"
+        )
+    for name, sampler in (("random", random_sampler), ("grid", grid_sampler)):
+        sampler_size = len(pickle.dumps(sampler)) / 2**20
+        print(f"pickled {name} sampler with array hits: {sampler_size:.2f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark hit storage in the balanced samplers."
+    )
+    parser.add_argument(
+        "--num_polygons",
+        type=int,
+        default=100_000,
+        help="Number of polygons in the synthetic layer",
+    )
+    args = parser.parse_args()
+    main(args.num_polygons)
@@ -0,0 +1,180 @@
+"""
+Benchmark the locality modes of BalancedRandomBatchGeoSampler.
+
+Writes a grid of synthetic NAIP-like tiles and reads an epoch of chips drawn
+by the sampler from a PooledNAIP dataset, in the order drawn and in each
+locality mode. Every mode reads the same chips. For each it reports the read
+throughput, the share of reads served by an already open file handle, and the
+hit ratio of an LRU block cache the size of GDAL_CACHEMAX replayed over the
+blocks each chip touches. Each mode runs in a fresh process, so GDAL's caches
+start empty.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.sampler_locality [--grid <num>] [--num_chips <num>]
+    [--max_open_handles <num>] [--gdal_cachemax <MB>]
+"""
+
+import argparse
+import multiprocessing as mp
+import tempfile
+import time
+from collections import OrderedDict
+
+import torch
+
+from benchmarks.handle_pool import PATCH_SIZE, make_tiles
+from data.handles import PooledNAIP, configure_gdal
+from data.sampler import BalancedRandomBatchGeoSampler
+
+BATCH_SIZE = 16
+BLOCK_BYTES = PATCH_SIZE * PATCH_SIZE * 4
+
+
+class CountingNAIP(PooledNAIP):
+    """PooledNAIP counting the files it opens."""
+
+    opens = 0
+
+    def _load_warp_file(self, filepath):
+        CountingNAIP.opens += 1
+        return super()._load_warp_file(filepath)
+
+
+def block_hit_ratio(dataset, boxes, capacity: int) -> float:
+    """
+    Replay the blocks read for each box through an LRU cache.
+
+    Args:
+        dataset: dataset the boxes are read from
+        boxes: bounding boxes in the order they are read
+        capacity: number of blocks the cache holds
+
+    Returns:
+        float: share of block reads found in the cache
+    """
+    cache = OrderedDict()
+    block = PATCH_SIZE * dataset.res
+    hits = reads = 0
+    for box in boxes:
+        for tile in dataset.index.intersection(tuple(box), objects=True):
+            minx, _, _, maxy, _, _ = tile.bounds
+            cols = range(
+                max(int((box.minx - minx) // block), 0),
+                int((box.maxx - minx) // block) + 1,
+            )
+            rows = range(
+                max(int((maxy - box.maxy) // block), 0),
+                int((maxy - box.miny) // block) + 1,
+            )
+            for row in rows:
+                for col in cols:
+                    key = (tile.object, row, col)
+                    reads += 1
+                    if key in cache:
+                        hits += 1
+                        cache.move_to_end(key)
+                    else:
+                        cache[key] = True
+                        if len(cache) > capacity:
+                            cache.popitem(last=False)
+    return hits / max(reads, 1)
+
+
+def run(root, locality, num_chips, max_open_handles, gdal_cachemax, results):
+    """
+    Read an epoch of chips in one locality mode and report the measurements.
+    """
+    torch.set_num_threads(1)
+    configure_gdal(0, {"GDAL_CACHEMAX": gdal_cachemax})
+    dataset = CountingNAIP(root, max_open_handles=max_open_handles)
+    sampler = BalancedRandomBatchGeoSampler(
+        {
+            "dataset": dataset,
+            "size": PATCH_SIZE,
+            "batch_size": BATCH_SIZE,
+            "length": num_chips,
+            "generator": torch.Generator().manual_seed(0),
+            "locality": locality,
+        }
+    )
+    boxes = [box for batch in sampler for box in batch]
+
+    start = time.perf_counter()
+    for box in boxes:
+        dataset[box]
+    rate = len(boxes) / (time.perf_counter() - start)
+
+    handle_hits = 1 - CountingNAIP.opens / len(boxes)
+    capacity = gdal_cachemax * 2**20 // BLOCK_BYTES
+    results.put((rate, handle_hits, block_hit_ratio(dataset, boxes, capacity)))
+
+
+def main(
+    grid: int, num_chips: int, max_open_handles: int, gdal_cachemax: int
+) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        grid: number of tiles along each side of the mosaic
+        num_chips: number of chips read per mode
+        max_open_handles: open files kept by the dataset
+        gdal_cachemax: MB of GDAL block cache
+    """
+    ctx = mp.get_context("spawn")
+    with tempfile.TemporaryDirectory() as root:
+        make_tiles(root, grid)
+        print(
+            f"tiles: {grid * grid}, chips: {num_chips}, "
+            f"open handles: {max_open_handles}, GDAL_CACHEMAX: {gdal_cachemax}"
+        )
+        print(
+            f"{'order':<8} {'chips/s':>8} {'handle hits':>12} "
+            f"{'block hits':>11}"
+        )
+        for locality in (None, "tile", "hilbert"):
+            results = ctx.Queue()
+            process = ctx.Process(
+                target=run,
+                args=(
+                    root,
+                    locality,
+                    num_chips,
+                    max_open_handles,
+                    gdal_cachemax,
+                    results,
+                ),
+            )
+            process.start()
+            rate, handle_hits, block_hits = results.get()
+            process.join()
+            print(
+                f"{locality or 'drawn':<8} {rate:>8.1f} {handle_hits:>12.1%} "
+                f"{block_hits:>11.1%}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the locality modes of the random sampler."
+    )
+    parser.add_argument(
+        "--grid", type=int, default=8, help="Tiles along each mosaic side"
+    )
+    parser.add_argument(
+        "--num_chips", type=int, default=4096, help="Chips read per mode"
+    )
+    parser.add_argument(
+        "--max_open_handles",
+        type=int,
+        default=8,
+        help="Open files kept by the dataset",
+    )
+    parser.add_argument(
+        "--gdal_cachemax",
+        type=int,
+        default=16,
+        help="MB of GDAL block cache",
+    )
+    args = parser.parse_args()
+    main(args.grid, args.num_chips, args.max_open_handles, args.gdal_cachemax)
@@ -0,0 +1,163 @@
+"""
+Benchmark augmenting in the DataLoader workers against on the model device.
+
+Serves synthetic NAIP-like chips through a DataLoader and augments them with
+the configured AugmentationEngine, either per batch in the main process on
+the model device, as AUG_LOCATION = "device" does, or per sample in the
+workers, as AUG_LOCATION = "workers" does. A model step is simulated by
+sleeping, which leaves the CPU to the workers as a GPU step would. For each
+mode it reports the training throughput and the time the main process spends
+per batch waiting for data and augmenting it.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m benchmarks.worker_augmentation configs.<config>
+    [--batches <num>] [--num_workers <num>] [--step_ms <ms>]
+"""
+
+import argparse
+import importlib
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torchgeo.datasets import stack_samples
+
+from data.augment import TransformedDataset
+from utils.transforms import (
+    AugmentationEngine,
+    SampleAugmentation,
+    create_augmentation_pipelines,
+)
+
+MODEL_DEVICE = (
+    "cuda"
+    if torch.cuda.is_available()
+    else "mps" if torch.backends.mps.is_available() else "cpu"
+)
+
+
+class SyntheticChips(Dataset):
+    """Random 4-band chips with masks, generated from their index."""
+
+    def __init__(self, length: int, patch_size: int, num_classes: int):
+        self.length = length
+        self.patch_size = patch_size
+        self.num_classes = num_classes
+
+    def __getitem__(self, index: int):
+        generator = torch.Generator().manual_seed(index)
+        size = (self.patch_size, self.patch_size)
+        image = torch.randint(0, 256, (4, *size), generator=generator)
+        mask = torch.randint(0, self.num_classes, size, generator=generator)
+        return {"image": image.float(), "mask": mask.to(torch.uint8)}
+
+    def __len__(self) -> int:
+        return self.length
+
+
+def synchronize() -> None:
+    """
+    Wait for pending work on the model device.
+    """
+    if MODEL_DEVICE == "cuda":
+        torch.cuda.synchronize()
+    elif MODEL_DEVICE == "mps":
+        torch.mps.synchronize()
+
+
+def run(dataloader, augment, step_ms: float):
+    """
+    Return the chips per second of an epoch and the mean time in milliseconds
+    the main process spent per batch on data and augmentation.
+    """
+    busy = 0.0
+    count = 0
+    start = time.perf_counter()
+    wait_start = start
+    for sample in dataloader:
+        x = sample["image"].to(MODEL_DEVICE)
+        y = sample["mask"].to(MODEL_DEVICE).type(torch.float32)
+        if augment is not None:
+            x, y = augment(x / 255.0, y)
+        synchronize()
+        busy += time.perf_counter() - wait_start
+        count += len(x)
+        time.sleep(step_ms / 1000)
+        wait_start = time.perf_counter()
+    elapsed = time.perf_counter() - start
+    return count / elapsed, busy / len(dataloader) * 1000
+
+
+def main(config, batches: int, num_workers: int, step_ms: float) -> None:
+    """
+    Run the benchmark and print the results.
+
+    Args:
+        config: configuration module
+        batches: number of batches per mode
+        num_workers: number of DataLoader workers
+        step_ms: simulated model step in milliseconds
+    """
+    spatial_augs, color_augs = create_augmentation_pipelines(
+        config, config.SPATIAL_AUG_INDICES, config.IMAGE_AUG_INDICES
+    )
+    augment = AugmentationEngine(
+        spatial_augs,
+        color_augs,
+        config.SPATIAL_AUG_MODE,
+        config.COLOR_AUG_MODE,
+    )
+    dataset = SyntheticChips(
+        batches * config.BATCH_SIZE, config.PATCH_SIZE, config.NUM_CLASSES
+    )
+
+    print(
+        f"device: {MODEL_DEVICE}, cpus: {os.cpu_count()}, "
+        f"workers: {num_workers}, batch: {config.BATCH_SIZE}, "
+        f"step: {step_ms} ms"
+    )
+    print(f"{'augment':<8} {'chips/s':>8} {'main ms/batch':>14}")
+    for location in ("device", "workers"):
+        torch.manual_seed(0)
+        mode_dataset, mode_augment = dataset, augment
+        if location == "workers":
+            mode_dataset = TransformedDataset(
+                dataset, SampleAugmentation(augment)
+            )
+            mode_augment = None
+        dataloader = DataLoader(
+            mode_dataset,
+            batch_size=config.BATCH_SIZE,
+            collate_fn=stack_samples,
+            num_workers=num_workers,
+            generator=torch.Generator().manual_seed(0),
+        )
+        rate, busy = run(dataloader, mode_augment, step_ms)
+        print(f"{location:<8} {rate:>8.1f} {busy:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark worker-side against device-side augmentation."
+    )
+    parser.add_argument("config", type=str, help="Configuration module")
+    parser.add_argument(
+        "--batches", type=int, default=40, help="Batches per mode"
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=8, help="DataLoader workers"
+    )
+    parser.add_argument(
+        "--step_ms",
+        type=float,
+        default=0.0,
+        help="Simulated model step in milliseconds",
+    )
+    args = parser.parse_args()
+    main(
+        importlib.import_module(args.config),
+        args.batches,
+        args.num_workers,
+        args.step_ms,
+    )
@@ -11,6 +11,26 @@ KC_IMAGE_ROOT = os.path.join(DATA_ROOT, "KC-images")
 KC_RIVER_ROOT = os.path.join(DATA_ROOT, "KC-river-images")
 KC_DEM_ROOT = None
 # KC_DEM_ROOT = os.path.join(KC_SHAPE_ROOT, "KC_DEM_2017")
+# DEM aligned to the NAIP grid by `python -m data.dem configs.config`
+KC_DEM_ALIGNED_ROOT = None
+# KC_DEM_ALIGNED_ROOT = os.path.join(KC_SHAPE_ROOT, "KC_DEM_2017_aligned")
+# terrain derivatives from `python -m data.dem configs.config --action derivatives`
+KC_DEM_DERIVATIVES_ROOT = None
+# KC_DEM_DERIVATIVES_ROOT = os.path.join(KC_SHAPE_ROOT, "KC_DEM_2017_derivatives")
+KC_DEM_BANDS = ["elevation", "slope", "curvature", "relief"]
+KC_DEM_RELIEF_RADIUS = 15  # pixels
+KC_DEM_Z_FACTOR = 0.3048  # DEM elevations are in feet, NAIP CRS in meters
+# mean and standard deviation of each DEM band as read, used to normalize it:
+# the derivative bands, in meters and degrees, and the raw elevation, in feet.
+# Approximate values for Kane County; print the exact ones for the DEM in use
+# with `python -m data.dem configs.config --action stats`
+KC_DEM_STATS = {
+    "elevation": (244.0, 18.0),
+    "slope": (2.0, 3.0),
+    "curvature": (0.0, 0.05),
+    "relief": (1.5, 2.0),
+}
+KC_DEM_ELEVATION_STATS = (800.0, 60.0)
 KC_MASK_ROOT = os.path.join(DATA_ROOT, "KC-masks/separate-masks")
 OUTPUT_ROOT = f"/net/projects/cmap/workspaces/{os.environ['USER']}"
 
@@ -19,6 +39,12 @@ MODEL = "deeplabv3+"
 BACKBONE = "resnet101"
 # check backbone, mean, and std when setting weights
 WEIGHTS = True
+# fold the first convolution weights of the input channels copying band 0
+# into those of band 0, so the model takes only the image bands; the folded
+# model.pth has a narrower first convolution, so it does not load into an
+# unfolded model, nor models of earlier runs into a folded one. Training
+# then updates band 0 by the summed weight, not by each copy's own step
+FOLD_INPUT_CHANNELS = False
 
 # model hyperparams
 DATASET_MEAN = [
@@ -33,6 +59,15 @@ DATASET_STD = [
     0.025523325960784313,
     0.03643713776470588,
 ]
+# the DEM bands follow the NAIP bands in the image; every channel is divided
+# by 255 before it is normalized, so their statistics are too
+if KC_DEM_ROOT is not None:
+    if KC_DEM_DERIVATIVES_ROOT is not None:
+        KC_DEM_BAND_STATS = [KC_DEM_STATS[band] for band in KC_DEM_BANDS]
+    else:
+        KC_DEM_BAND_STATS = [KC_DEM_ELEVATION_STATS]
+    DATASET_MEAN = DATASET_MEAN + [mean / 255 for mean, _ in KC_DEM_BAND_STATS]
+    DATASET_STD = DATASET_STD + [std / 255 for _, std in KC_DEM_BAND_STATS]
 BATCH_SIZE = 16
 PATCH_SIZE = 256
 NUM_CLASSES = 5  # predicting 4 classes + background
@@ -49,6 +84,15 @@ REGULARIZATION_WEIGHT = 1.0e-5
 GRADIENT_CLIPPING = False
 CLIP_VALUE = 1.0
 
+# write checkpoint.pth, holding the model, optimizer and training sampler
+# states, to the output directory after every epoch and every
+# CHECKPOINT_BATCHES training batches; None writes none
+CHECKPOINT_BATCHES = None
+# checkpoint.pth of an interrupted run, resumed by its first trial at the
+# batch after the one it was written at; with several ranks, a path holding
+# {rank}, such as "output/run_trial1/checkpoint-{rank}.pth"
+RESUME_CHECKPOINT = None
+
 # data augmentation
 SPATIAL_AUG_INDICES = [
     0,  # HorizontalFlip
@@ -91,6 +135,9 @@ GAMMA = (0.8, 1.2)
 
 SPATIAL_AUG_MODE = "all"  # all or random
 COLOR_AUG_MODE = "all"  # all or random
+# "device" augments each batch on the model device in the main process;
+# "workers" augments each sample on the CPU in the DataLoader workers
+AUG_LOCATION = "device"
 
 # KaneCounty data
 KC_SHAPE_FILENAME = "KC_StormwaterDataJan2024.gdb.zip"
@@ -102,6 +149,64 @@ KC_LABELS = {
     "DRY BOTTOM - TURF": 3,
     "DRY BOTTOM - MESIC PRAIRIE": 4,
 }
+# rasterize the masks of a whole training batch at once
+KC_BATCH_MASKS = False
+# filtered and reprojected layer is cached here as GeoParquet; None disables
+KC_SHAPE_CACHE_ROOT = os.path.join(OUTPUT_ROOT, "kc-shape-cache")
+# set to a directory to rasterize the labels once into a memory-mapped mosaic;
+# training boxes are then snapped to its pixel grid, off-grid queries such as
+# test windows are rasterized
+KC_LABEL_CACHE_ROOT = None
+# KC_LABEL_CACHE_ROOT = os.path.join(OUTPUT_ROOT, "kc-label-cache")
+
+# move batches to the model device ahead of the training loop, from pinned
+# memory on a side stream on CUDA and from a background thread otherwise
+DEVICE_PREFETCH = True
+
+# set to read NAIP chips from one VRT mosaic over the tiles in KC_IMAGE_ROOT,
+# written by `python retrieve_images.py configs.config --action vrt`
+KC_IMAGE_VRT = None
+# KC_IMAGE_VRT = os.path.join(KC_IMAGE_ROOT, "naip.vrt")
+
+# raster reads in each DataLoader worker
+MAX_OPEN_HANDLES = 64  # open files kept per dataset and worker
+GDAL_CACHEMAX = 256  # MB of GDAL block cache per worker
+GDAL_NUM_THREADS = 1  # decoding threads per worker; workers run in parallel
+VSI_CACHE = True
+
+# order of the training chips within an epoch: None keeps the order drawn,
+# "tile" or "hilbert" group them by NAIP tile or along a Hilbert curve into
+# windows of SAMPLER_LOCALITY_BATCHES batches, shuffled within each window, so
+# consecutive reads reuse the open files and GDAL block cache; with
+# KC_IMAGE_VRT the mosaic is indexed by tile as well
+SAMPLER_LOCALITY = None
+SAMPLER_LOCALITY_BATCHES = 8
+
+# NAIP tiles are rewritten as COGs by `python retrieve_images.py configs.config
+# --action cog`, tiled to match the chips read during training
+NAIP_COG_BLOCK_SIZE = PATCH_SIZE
+NAIP_COG_COMPRESS = "ZSTD"  # lossless; ZSTD, LZW or DEFLATE
+NAIP_COG_LEVEL = 1  # low levels favour decoding speed
+
+# set to read training chips from the shards written by
+# `python -m data.chips configs.config`; the test split is then fixed by the
+# seed recorded in the store and checked against the tiles it recorded;
+# KC_BATCH_MASKS and checkpoints within an epoch do not apply to the store
+CHIP_STORE_ROOT = None
+# CHIP_STORE_ROOT = os.path.join(OUTPUT_ROOT, "kc-chips")
+# pixels added on every side of an exported chip, within the training tiles
+CHIP_STORE_JITTER = 32
+CHIP_STORE_SHARD_SIZE = 1024  # chips per shard
+
+# share of a test window's area it may have in common with an earlier window
+# before it is dropped; windows are snapped to the stride grid first, so at a
+# stride of PATCH_SIZE only exact repeats are dropped
+TEST_MAX_OVERLAP = 0.5
+
+# in-memory LRU cache of test chips, in bytes per DataLoader worker; 0 disables
+TEST_CHIP_CACHE_BYTES = 0
+# optional directory where chips evicted from memory are spilled to disk
+TEST_CHIP_CACHE_SPILL_ROOT = None
 
 # for wandb
 WANDB_API = ""
@@ -0,0 +1,58 @@
+"""
+This module provides a wrapper applying a transform to every sample of a
+dataset. Wrapped around the training dataset, it runs the augmentations in the
+DataLoader workers, one sample at a time, instead of on the collated batch in
+the main process. The DataLoader seeds the torch and Python RNGs of each worker
+from its own base seed, so every worker draws independent augmentations.
+"""
+
+from torch.utils.data import Dataset
+
+
+class TransformedDataset(Dataset):
+    """View of a dataset with a transform applied to every sample."""
+
+    def __init__(self, dataset, transform) -> None:
+        """Initialize a new TransformedDataset instance.
+
+        Args:
+            dataset: dataset indexed by bounding boxes or integers; batches are
+                read with its ``__getitems__`` when it has one
+            transform: callable taking and returning a sample dictionary
+        """
+        self.dataset = dataset
+        self.transform = transform
+
+    def __getitem__(self, query):
+        """Retrieve a transformed sample indexed by query.
+
+        Args:
+            query: index of the sample in the wrapped dataset
+
+        Returns:
+            transformed sample of image/mask and metadata at that index
+        """
+        return self.transform(self.dataset[query])
+
+    def __getitems__(self, queries):
+        """Retrieve the transformed samples for a whole batch of queries.
+
+        Args:
+            queries: list of indexes of samples in the wrapped dataset
+
+        Returns:
+            list of transformed samples, ready to be collated
+        """
+        if hasattr(self.dataset, "__getitems__"):
+            samples = self.dataset.__getitems__(queries)
+        else:
+            samples = [self.dataset[query] for query in queries]
+        return [self.transform(sample) for sample in samples]
+
+    def __len__(self) -> int:
+        """Return the number of entries in the wrapped dataset.
+
+        Returns:
+            length of the dataset
+        """
+        return len(self.dataset)
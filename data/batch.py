@@ -0,0 +1,72 @@
+"""
+This module provides a batch-aware wrapper around the intersection of an image
+dataset and the KaneCounty labels. When used with a batch sampler, the
+DataLoader hands the whole list of bounding boxes to the wrapper, so the masks
+for a batch are produced by a single call to KaneCounty.get_batch instead of
+one rasterization per chip.
+"""
+
+from torch.utils.data import Dataset
+from torchgeo.datasets import BoundingBox, IntersectionDataset
+
+
+class KaneCountyBatchDataset(Dataset):
+    """Batch-aware view of an ``image & KaneCounty`` intersection dataset."""
+
+    def __init__(self, dataset: IntersectionDataset) -> None:
+        """Initialize a new KaneCountyBatchDataset instance.
+
+        Args:
+            dataset: intersection of an image dataset with a KaneCounty dataset
+        """
+        self.dataset = dataset
+        self.image_dataset, self.label_dataset = dataset.datasets
+
+    def __getitem__(self, query: BoundingBox):
+        """Retrieve a single image/mask sample indexed by query.
+
+        Args:
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+
+        Returns:
+            sample of image/mask and metadata at that index
+        """
+        return self.dataset[query]
+
+    def __getitems__(self, queries):
+        """Retrieve the samples for a whole batch of queries.
+
+        Called by the DataLoader with every bounding box yielded by the batch
+        sampler. Images are read per query; masks are rasterized together,
+        then go through the same transforms as in ``__getitem__``.
+
+        Args:
+            queries: list of (minx, maxx, miny, maxy, mint, maxt) coordinates
+
+        Returns:
+            list of samples, ready to be collated with ``stack_samples``
+        """
+        masks = self.label_dataset.get_batch(queries)
+        samples = []
+        for query, mask in zip(queries, masks):
+            label_sample = {
+                "mask": mask,
+                "crs": self.label_dataset.crs,
+                "bbox": query,
+            }
+            if self.label_dataset.transforms is not None:
+                label_sample = self.label_dataset.transforms(label_sample)
+            sample = self.image_dataset[query]
+            sample["mask"] = label_sample["mask"]
+            if self.dataset.transforms is not None:
+                sample = self.dataset.transforms(sample)
+            samples.append(sample)
+        return samples
+
+    def __len__(self) -> int:
+        """Return the number of entries in the wrapped dataset.
+
+        Returns:
+            length of the dataset
+        """
+        return len(self.dataset)
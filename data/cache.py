@@ -0,0 +1,155 @@
+"""
+This module provides a bounded cache for chips read from a geospatial dataset.
+Samplers such as BalancedGridGeoSampler yield the same deterministic windows in
+every epoch, so the images and masks read for evaluation can be kept in memory
+(with an LRU byte budget) and optionally spilled to ``.npy`` files on disk
+instead of being read and rasterized again.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchgeo.datasets import BoundingBox, GeoDataset
+
+
+def dataset_fingerprint(dataset: GeoDataset) -> str:
+    """Compute a fingerprint identifying the samples a dataset returns.
+
+    The fingerprint covers the CRS, resolution and index entries of the
+    dataset and of any datasets it combines, as well as the label settings
+    of label datasets.
+
+    Args:
+        dataset: dataset to fingerprint
+
+    Returns:
+        str: hex digest of the dataset settings
+    """
+    parts = [type(dataset).__name__, str(dataset.crs), str(dataset.res)]
+    items = dataset.index.intersection(dataset.index.bounds, objects=True)
+    parts.extend(sorted(f"{item.bounds}{item.object}" for item in items))
+    for name in ("labels", "label_cache_path"):
+        parts.append(f"{name}={getattr(dataset, name, None)}")
+    for child in getattr(dataset, "datasets", []):
+        parts.append(dataset_fingerprint(child))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+
+class ChipCache(Dataset):
+    """LRU cache of the samples of a GeoDataset, keyed by bounding box.
+
+    Each sample gets a ``cache_hit`` flag so hit and miss counts can be
+    gathered from the collated batches, including those produced in
+    DataLoader worker processes. The byte budget applies per process.
+    """
+
+    def __init__(self, dataset: GeoDataset, max_bytes: int, spill_root=None):
+        """Initialize a new ChipCache instance.
+
+        Args:
+            dataset: dataset whose samples are cached
+            max_bytes: budget in bytes for the tensors kept in memory
+            spill_root: optional directory where samples evicted from memory
+                are written as ``.npy`` files and loaded back on a hit
+        """
+        self.dataset = dataset
+        self.max_bytes = max_bytes
+        self.fingerprint = dataset_fingerprint(dataset)
+        self.spill_dir = None
+        if spill_root is not None:
+            self.spill_dir = os.path.join(spill_root, self.fingerprint)
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+        self._chips = OrderedDict()
+        self._nbytes = 0
+
+    def _key(self, query: BoundingBox) -> str:
+        """Return the cache key of a query."""
+        digest = hashlib.sha256(repr(tuple(query)).encode()).hexdigest()
+        return f"{self.fingerprint}-{digest[:24]}"
+
+    def _spill_path(self, key: str, name: str) -> str:
+        """Return the path of a spilled tensor."""
+        return os.path.join(self.spill_dir, f"{key}-{name}.npy")
+
+    def _load_spilled(self, key: str, query: BoundingBox):
+        """Load a spilled sample from disk, or return None if absent."""
+        tensors = {}
+        for name in ("image", "mask"):
+            path = self._spill_path(key, name)
+            if not os.path.exists(path):
+                return None
+            tensors[name] = torch.from_numpy(np.load(path))
+        return dict(tensors, crs=self.dataset.crs, bbox=query)
+
+    def _store(self, key: str, sample) -> None:
+        """Keep a sample in memory, evicting least recently used chips."""
+        tensors = {
+            name: value
+            for name, value in sample.items()
+            if isinstance(value, torch.Tensor)
+        }
+        nbytes = sum(t.element_size() * t.nelement() for t in tensors.values())
+        if nbytes > self.max_bytes:
+            return
+
+        self._chips[key] = tensors
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            old_key, old_tensors = self._chips.popitem(last=False)
+            self._nbytes -= sum(
+                t.element_size() * t.nelement() for t in old_tensors.values()
+            )
+            if self.spill_dir is not None:
+                self._spill(old_key, old_tensors)
+
+    def _spill(self, key: str, tensors) -> None:
+        """Write an evicted sample to disk unless it is already there."""
+        for name, tensor in tensors.items():
+            path = self._spill_path(key, name)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, tensor.numpy())
+                os.replace(tmp_path, path)
+
+    def __getitem__(self, query: BoundingBox):
+        """Retrieve a sample, reading it from the dataset only on a miss.
+
+        Args:
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+
+        Returns:
+            sample of image/mask and metadata at that index, with a
+            ``cache_hit`` flag
+        """
+        key = self._key(query)
+        if key in self._chips:
+            self._chips.move_to_end(key)
+            sample = dict(self._chips[key], crs=self.dataset.crs, bbox=query)
+            sample["cache_hit"] = True
+            return sample
+
+        if self.spill_dir is not None:
+            sample = self._load_spilled(key, query)
+            if sample is not None:
+                self._store(key, sample)
+                sample["cache_hit"] = True
+                return sample
+
+        sample = self.dataset[query]
+        self._store(key, sample)
+        sample["cache_hit"] = False
+        return sample
+
+    def __len__(self) -> int:
+        """Return the number of entries in the wrapped dataset.
+
+        Returns:
+            length of the dataset
+        """
+        return len(self.dataset)
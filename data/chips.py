@@ -0,0 +1,457 @@
+"""
+This module provides a pre-extracted store of training chips. The export
+command walks the regions that BalancedRandomBatchGeoSampler samples from,
+widened by a jitter margin, and writes image and mask chips into fixed-size
+memory-mapped shards. ChipShardDataset then serves random crops from the
+shards, so training needs no rtree lookups, GDAL reads or rasterization.
+
+The train/test split is fixed by a seed recorded in the store, together with
+the bounds of the image tiles on either side of it. train.py reuses the seed
+and checks that its own split assigns the same tiles, so no exported region
+is evaluated on. The jitter margin of each chip is clipped to the training
+tiles, so the crops never reach into a test tile.
+
+To run: from repo directory (2024-winter-cmap)
+> python -m data.chips configs.<config> [--split <split>] [--seed <num>]
+"""
+
+import argparse
+import importlib
+import json
+import math
+import os
+
+import numpy as np
+import torch
+from rasterio.crs import CRS
+from torch.utils.data import Dataset
+from torchgeo.datasets import NAIP, BoundingBox, random_bbox_assignment
+
+from data.kc import KaneCounty
+from data.naip import NAIPMosaic
+from data.sampler import BalancedRandomBatchGeoSampler
+
+METADATA_FILENAME = "chips.json"
+
+
+def _window_starts(interval, size):
+    """
+    Return the start coordinates of the windows tiling an interval.
+
+    Windows are spaced by their size and the last one is aligned with the end
+    of the interval; an interval shorter than a window gets one centred window.
+    """
+    min_val, max_val = interval
+    length = max_val - min_val
+    if length <= size:
+        return [min_val + (length - size) / 2]
+    count = math.ceil((length - size) / size) + 1
+    return [min(min_val + i * size, max_val - size) for i in range(count)]
+
+
+def export_windows(sampler: BalancedRandomBatchGeoSampler, margin: float):
+    """
+    Compute the windows to export for the regions a sampler draws from.
+
+    Args:
+        sampler: sampler whose hits define the sampling regions
+        margin: jitter margin added on every side of a window, in CRS units
+
+    Returns:
+        list of BoundingBox windows of identical size
+    """
+    height, width = sampler.size
+    windows = []
+    for hit in sampler.bounds.tolist():
+        bounds = BoundingBox(*hit)
+        for miny in _window_starts((bounds.miny, bounds.maxy), height):
+            for minx in _window_starts((bounds.minx, bounds.maxx), width):
+                windows.append(
+                    BoundingBox(
+                        minx - margin,
+                        minx + width + margin,
+                        miny - margin,
+                        miny + height + margin,
+                        bounds.mint,
+                        bounds.maxt,
+                    )
+                )
+    return windows
+
+
+def split_bounds(dataset) -> list:
+    """
+    Return the bounds of the index entries of one side of a split.
+
+    Args:
+        dataset: dataset returned by random_bbox_assignment
+
+    Returns:
+        list: sorted [minx, maxx, miny, maxy] of each entry, rounded to
+            millimetres so splits of the same tiles compare equal
+    """
+    items = dataset.index.intersection(dataset.index.bounds, objects=True)
+    return sorted(
+        [round(value, 3) for value in item.bounds[:4]] for item in items
+    )
+
+
+def crop_region(tiles, window: BoundingBox, res: float, jitter: int):
+    """
+    Clip the jitter margin of a chip to the tiles of an index.
+
+    On each side, the margin keeps the rows or columns next to the centre
+    patch that lie within the tiles, up to the first one that does not.
+
+    Args:
+        tiles: rtree index of the training tiles
+        window: bounds of the chip, centre patch and margin
+        res: resolution of the chip
+        jitter: jitter margin in pixels
+
+    Returns:
+        tuple: (row_start, row_stop, col_start, col_stop) pixels of the chip
+            that crops may cover
+    """
+    size = round((window.maxy - window.miny) / res)
+    if jitter == 0:
+        return 0, size, 0, size
+
+    covered = np.zeros((size, size), dtype=bool)
+    for hit in tiles.intersection(tuple(window), objects=True):
+        tile = BoundingBox(*hit.bounds)
+        row_start = max(round((window.maxy - tile.maxy) / res), 0)
+        row_stop = round((window.maxy - tile.miny) / res)
+        col_start = max(round((tile.minx - window.minx) / res), 0)
+        col_stop = round((tile.maxx - window.minx) / res)
+        covered[row_start:row_stop, col_start:col_stop] = True
+
+    def extent(lines):
+        """Count the fully covered lines, from the centre patch outwards."""
+        count = 0
+        for line in lines:
+            if not line.all():
+                break
+            count += 1
+        return count
+
+    core = slice(jitter, size - jitter)
+    top = extent(covered[jitter - 1 :: -1, core])
+    bottom = extent(covered[size - jitter :, core])
+    left = extent(covered[core, jitter - 1 :: -1].T)
+    right = extent(covered[core, size - jitter :].T)
+    return (
+        jitter - top,
+        size - jitter + bottom,
+        jitter - left,
+        size - jitter + right,
+    )
+
+
+def _fit(array: np.ndarray, size: int) -> np.ndarray:
+    """Crop or zero-pad the last two dimensions of an array to size."""
+    array = array[..., :size, :size]
+    pad = [(0, 0)] * (array.ndim - 2)
+    pad += [(0, size - array.shape[-2]), (0, size - array.shape[-1])]
+    return np.pad(array, pad)
+
+
+def export_chips(
+    dataset, sampler, tiles, root: str, jitter: int, shard_size: int, split_info
+) -> int:
+    """
+    Write the chips of a dataset into memory-mapped shards.
+
+    Each shard holds up to shard_size chips in four ``.npy`` files: uint8
+    images (N, C, S, S), uint8 masks (N, S, S), float64 bounding boxes (N, 6)
+    and the int64 (row_start, row_stop, col_start, col_stop) region of each
+    chip crops may cover (N, 4), where S is the patch size plus twice the
+    jitter margin.
+
+    Args:
+        dataset: intersection of the image dataset with the KaneCounty labels
+        sampler: training sampler whose regions are exported
+        tiles: rtree index of the training tiles the margins are clipped to
+        root: directory to write the shards and metadata to
+        jitter: jitter margin in pixels
+        shard_size: maximum number of chips per shard
+        split_info: dictionary with the split rate and seed of the dataset
+            and the bounds of the tiles on either side of the split
+
+    Returns:
+        int: number of chips written
+    """
+    chip_size = round(sampler.size[0] / sampler.res) + 2 * jitter
+    windows = export_windows(sampler, jitter * sampler.res)
+    os.makedirs(root, exist_ok=True)
+
+    shard_lengths = []
+    images = masks = bboxes = regions = None
+    for window in windows:
+        try:
+            sample = dataset[window]
+        except IndexError:
+            continue
+        image = sample["image"].numpy()
+        if image.min() < 0 or image.max() > 255:
+            raise ValueError(
+                "The chip store holds uint8 images; "
+                "bands outside 0-255 such as the DEM are not supported"
+            )
+
+        count = shard_lengths[-1] if shard_lengths else shard_size
+        if count == shard_size:
+            shard = len(shard_lengths)
+            shape = (shard_size, image.shape[0], chip_size, chip_size)
+            images = np.lib.format.open_memmap(
+                os.path.join(root, f"images-{shard:05d}.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=shape,
+            )
+            masks = np.lib.format.open_memmap(
+                os.path.join(root, f"masks-{shard:05d}.npy"),
+                mode="w+",
+                dtype=np.uint8,
+                shape=(shard_size, chip_size, chip_size),
+            )
+            bboxes = np.lib.format.open_memmap(
+                os.path.join(root, f"bboxes-{shard:05d}.npy"),
+                mode="w+",
+                dtype=np.float64,
+                shape=(shard_size, 6),
+            )
+            regions = np.lib.format.open_memmap(
+                os.path.join(root, f"regions-{shard:05d}.npy"),
+                mode="w+",
+                dtype=np.int64,
+                shape=(shard_size, 4),
+            )
+            shard_lengths.append(0)
+            count = 0
+
+        images[count] = _fit(image, chip_size)
+        masks[count] = _fit(sample["mask"].numpy(), chip_size)
+        bboxes[count] = tuple(window)
+        regions[count] = crop_region(tiles, window, sampler.res, jitter)
+        shard_lengths[-1] += 1
+
+    for array in (images, masks, bboxes, regions):
+        if array is not None:
+            array.flush()
+
+    metadata = {
+        "chip_size": chip_size,
+        "jitter": jitter,
+        "res": sampler.res,
+        "crs": dataset.crs.to_wkt(),
+        "length": sampler.length,
+        "shard_size": shard_size,
+        "shard_lengths": shard_lengths,
+        **split_info,
+    }
+    with open(os.path.join(root, METADATA_FILENAME), "w") as f:
+        json.dump(metadata, f, indent=2)
+    return sum(shard_lengths)
+
+
+class ChipShardDataset(Dataset):
+    """Random crops served from the shards written by export_chips."""
+
+    def __init__(self, root: str, patch_size: int) -> None:
+        """Initialize a new ChipShardDataset instance.
+
+        Args:
+            root: directory containing the shards and metadata
+            patch_size: height and width of the crops in pixels
+        """
+        with open(os.path.join(root, METADATA_FILENAME)) as f:
+            metadata = json.load(f)
+        patch = metadata["chip_size"] - 2 * metadata["jitter"]
+        if patch_size > patch:
+            raise ValueError(
+                f"patch_size {patch_size} is larger than the exported patches "
+                f"({patch} pixels), crops could reach into the test tiles"
+            )
+
+        self.root = root
+        self.patch_size = patch_size
+        self.chip_size = metadata["chip_size"]
+        self.res = metadata["res"]
+        self.crs = CRS.from_wkt(metadata["crs"])
+        self.length = metadata["length"]
+        self.split_rate = metadata["split_rate"]
+        self.split_seed = metadata["split_seed"]
+        self.train_bounds = metadata.get("train_bounds")
+        self.test_bounds = metadata.get("test_bounds")
+        self.shard_size = metadata["shard_size"]
+        self.shard_lengths = metadata["shard_lengths"]
+        self._shards = None
+
+    def _open_shards(self):
+        """Memory-map the shards; done lazily so each worker maps its own."""
+        shards = []
+        for shard in range(len(self.shard_lengths)):
+            shards.append(
+                tuple(
+                    np.load(
+                        os.path.join(self.root, f"{name}-{shard:05d}.npy"),
+                        mmap_mode="r",
+                    )
+                    for name in ("images", "masks", "bboxes", "regions")
+                )
+            )
+        return shards
+
+    def __getitem__(self, index: int):
+        """Retrieve a random crop of a stored chip.
+
+        Args:
+            index: index of the chip to crop
+
+        Returns:
+            sample of image/mask and metadata of the crop
+        """
+        if self._shards is None:
+            self._shards = self._open_shards()
+        images, masks, bboxes, regions = self._shards[index // self.shard_size]
+        index %= self.shard_size
+
+        row_start, row_stop, col_start, col_stop = regions[index].tolist()
+        row = torch.randint(
+            row_start, row_stop - self.patch_size + 1, ()
+        ).item()
+        col = torch.randint(
+            col_start, col_stop - self.patch_size + 1, ()
+        ).item()
+        rows = slice(row, row + self.patch_size)
+        cols = slice(col, col + self.patch_size)
+        image = torch.from_numpy(
+            images[index, :, rows, cols].astype(np.float32)
+        )
+        mask = torch.from_numpy(np.ascontiguousarray(masks[index, rows, cols]))
+
+        minx, _, _, maxy, mint, maxt = bboxes[index]
+        minx += col * self.res
+        maxy -= row * self.res
+        size = self.patch_size * self.res
+        bbox = BoundingBox(minx, minx + size, maxy - size, maxy, mint, maxt)
+        return {"image": image, "mask": mask, "crs": self.crs, "bbox": bbox}
+
+    def check_split(self, train_portion, test_portion) -> None:
+        """Check that a split assigns the tiles the store was exported from.
+
+        Args:
+            train_portion: training side of random_bbox_assignment
+            test_portion: test side of random_bbox_assignment
+
+        Raises:
+            ValueError: if the split differs from the one exported
+        """
+        if self.train_bounds is None or self.test_bounds is None:
+            raise ValueError(
+                f"Chip store {self.root} does not record its split, "
+                "export it again"
+            )
+        if (
+            split_bounds(train_portion) != self.train_bounds
+            or split_bounds(test_portion) != self.test_bounds
+        ):
+            raise ValueError(
+                f"Chip store {self.root} was exported from a different split "
+                "of the images; export it again from the configured dataset"
+            )
+
+    def __len__(self) -> int:
+        """Return the number of stored chips.
+
+        Returns:
+            number of chips in the shards
+        """
+        return sum(self.shard_lengths)
+
+    def __getstate__(self):
+        """Drop the memory maps so the dataset pickles cheaply to workers."""
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+
+def export_training_chips(config, split_rate: float, seed: int) -> None:
+    """
+    Export the training chips of a split of the NAIP and KaneCounty data.
+
+    Args:
+        config: the configuration settings
+        split_rate: fraction of the data assigned to the training set
+        seed: seed of the random train/test split
+    """
+    # split the images train.py splits, so the tiles match its split
+    if config.KC_IMAGE_VRT is not None:
+        naip_dataset = NAIPMosaic(config.KC_IMAGE_VRT)
+    else:
+        naip_dataset = NAIP(config.KC_IMAGE_ROOT)
+    shape_path = os.path.join(config.KC_SHAPE_ROOT, config.KC_SHAPE_FILENAME)
+    dataset_config = (
+        config.KC_LAYER,
+        config.KC_LABELS,
+        config.PATCH_SIZE,
+        naip_dataset.crs,
+        naip_dataset.res,
+    )
+    kc_dataset = KaneCounty(
+        shape_path,
+        dataset_config,
+        label_cache_root=config.KC_LABEL_CACHE_ROOT,
+        shape_cache_root=config.KC_SHAPE_CACHE_ROOT,
+    )
+
+    generator = torch.Generator().manual_seed(seed)
+    train_portion, test_portion = random_bbox_assignment(
+        naip_dataset, [split_rate, 1 - split_rate], generator
+    )
+    train_dataset = train_portion & kc_dataset
+    train_sampler = BalancedRandomBatchGeoSampler(
+        config={
+            "dataset": train_dataset,
+            "size": config.PATCH_SIZE,
+            "batch_size": config.BATCH_SIZE,
+        }
+    )
+
+    count = export_chips(
+        train_dataset,
+        train_sampler,
+        train_portion.index,
+        config.CHIP_STORE_ROOT,
+        config.CHIP_STORE_JITTER,
+        config.CHIP_STORE_SHARD_SIZE,
+        {
+            "split_rate": split_rate,
+            "split_seed": seed,
+            "train_bounds": split_bounds(train_portion),
+            "test_bounds": split_bounds(test_portion),
+        },
+    )
+    print(f"Wrote {count} chips to {config.CHIP_STORE_ROOT}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export training chips into memory-mapped shards"
+    )
+    parser.add_argument(
+        "config", type=str, help="Path to the configuration file"
+    )
+    parser.add_argument(
+        "--split",
+        type=str,
+        help="Ratio of split; enter the size of the train split as an int out of 100",
+        default="80",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="Seed of the train/test split", default=0
+    )
+    args = parser.parse_args()
+    configs = importlib.import_module(args.config)
+    export_training_chips(configs, float(int(args.split) / 100), args.seed)
@@ -1,4 +1,4 @@
-""""
+""" "
 ***************convert .gdb file to .tif file****************
 * must have gdal installed
 * first run
@@ -6,12 +6,267 @@
 in command line to convert .gdb file into .tif file.
 * replace "input.gdb" and "output.tif" in above code with file paths to
 input a .gdb file and output a .tif file
+
+***************align the DEM to the NAIP grid****************
+* to avoid warping the DEM on every sample, run once
+    python -m data.dem configs.config --action align
+from the repo directory to write a tiled copy of the DEM in the CRS,
+resolution and pixel grid of the NAIP images to KC_DEM_ALIGNED_ROOT
+
+***************precompute terrain derivatives****************
+* run once
+    python -m data.dem configs.config --action derivatives
+to write elevation, slope, curvature and local relief bands computed from
+the (aligned) DEM to KC_DEM_DERIVATIVES_ROOT
+
+***************band statistics****************
+* run
+    python -m data.dem configs.config --action stats
+to print the mean and standard deviation of the DEM bands, to be set as
+KC_DEM_STATS (or KC_DEM_ELEVATION_STATS) in the configuration
 """
 
-from torchgeo.datasets import RasterDataset
+import argparse
+import glob
+import importlib
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+import rasterio.warp
+import rasterio.windows
+import torch
+import torch.nn.functional as F
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from torchgeo.datasets import NAIP, RasterDataset
+
+from data.handles import HandlePoolMixin
+from data.naip import read_window
+
+
+def aligned_grid(bounds, res, origin=(0.0, 0.0)):
+    """
+    Snap bounds outwards onto a pixel grid.
+
+    Args:
+        bounds (tuple): (minx, miny, maxx, maxy) in units of the grid CRS.
+        res (float): Resolution of the grid.
+        origin (tuple): Any (x, y) corner of a pixel on the grid.
+
+    Returns:
+        tuple: Affine transform, width and height of the snapped grid.
+    """
+    minx, miny, maxx, maxy = bounds
+    x0, y0 = origin
+    left = x0 + math.floor((minx - x0) / res) * res
+    top = y0 + math.ceil((maxy - y0) / res) * res
+    width = math.ceil((maxx - left) / res)
+    height = math.ceil((top - miny) / res)
+    transform = rasterio.transform.from_origin(left, top, res, res)
+    return transform, width, height
+
+
+def align_dem(src_path, dst_path, crs, res, origin=(0.0, 0.0)):
+    """
+    Write a copy of a DEM reprojected onto a target pixel grid.
+
+    The output is a tiled, compressed GeoTIFF with the given CRS and
+    resolution whose pixel corners line up with ``origin``.
+
+    Args:
+        src_path (str): Path to the source DEM.
+        dst_path (str): Path of the aligned DEM to write.
+        crs (CRS): Coordinate reference system of the target grid.
+        res (float): Resolution of the target grid.
+        origin (tuple): Any (x, y) corner of a pixel on the target grid.
+
+    Returns:
+        None
+    """
+    with rasterio.open(src_path) as src:
+        bounds = rasterio.warp.transform_bounds(src.crs, crs, *src.bounds)
+        transform, width, height = aligned_grid(bounds, res, origin)
+        with WarpedVRT(
+            src,
+            crs=crs,
+            transform=transform,
+            width=width,
+            height=height,
+            resampling=Resampling.bilinear,
+        ) as vrt:
+            tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+            rasterio.shutil.copy(
+                vrt,
+                tmp_path,
+                driver="GTiff",
+                tiled=True,
+                blockxsize=256,
+                blockysize=256,
+                compress="deflate",
+                predictor=3 if np.dtype(vrt.dtypes[0]).kind == "f" else 2,
+                num_threads="ALL_CPUS",
+                BIGTIFF="IF_SAFER",
+            )
+    os.replace(tmp_path, dst_path)
+
+
+DERIVATIVE_BANDS = ["elevation", "slope", "curvature", "relief"]
+
+
+def terrain_derivatives(elevation, res, relief_radius, z_factor=1.0):
+    """
+    Compute terrain derivative bands from a block of elevation.
+
+    Args:
+        elevation (np.ndarray): 2D elevation block.
+        res (float): Pixel size in units of the CRS.
+        relief_radius (int): Radius in pixels of the local relief window.
+        z_factor (float): Factor converting elevation units to CRS units.
+
+    Returns:
+        np.ndarray: float32 array of shape (4, H, W) with the bands of
+        ``DERIVATIVE_BANDS``.
+    """
+    z = elevation.astype(np.float32) * z_factor
+    dz_dy, dz_dx = np.gradient(z, res)
+    slope = np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+    d2z_dy2 = np.gradient(dz_dy, res, axis=0)
+    d2z_dx2 = np.gradient(dz_dx, res, axis=1)
+    curvature = d2z_dx2 + d2z_dy2
+
+    # local relief is the max minus the min elevation in a square window
+    window = torch.from_numpy(z)[None, None]
+    kernel = 2 * relief_radius + 1
+    high = F.max_pool2d(window, kernel, stride=1, padding=relief_radius)
+    low = -F.max_pool2d(-window, kernel, stride=1, padding=relief_radius)
+    relief = (high - low)[0, 0].numpy()
+
+    return np.stack([z, slope, curvature, relief]).astype(np.float32)
+
+
+def _derivative_block(args):
+    """
+    Read a block of a DEM with a halo and compute its derivatives.
+
+    Args:
+        args (tuple): Source path, block window, halo size in pixels,
+            relief radius and z factor.
+
+    Returns:
+        tuple: The block window and its derivative bands.
+    """
+    src_path, window, halo, relief_radius, z_factor = args
+    with rasterio.open(src_path) as src:
+        row_start = max(window.row_off - halo, 0)
+        col_start = max(window.col_off - halo, 0)
+        row_stop = min(window.row_off + window.height + halo, src.height)
+        col_stop = min(window.col_off + window.width + halo, src.width)
+        elevation = src.read(
+            1,
+            window=rasterio.windows.Window.from_slices(
+                (row_start, row_stop), (col_start, col_stop)
+            ),
+            masked=True,
+        )
+        elevation = elevation.astype(np.float32).filled(np.nan)
+        valid = ~np.isnan(elevation)
+        if not valid.any():
+            return window, None
+        # fill nodata with the block mean so it does not spread NaNs
+        elevation[~valid] = elevation[valid].mean()
+
+        # replicate edges where the halo extends past the file
+        pad = (
+            (
+                row_start - (window.row_off - halo),
+                window.row_off + window.height + halo - row_stop,
+            ),
+            (
+                col_start - (window.col_off - halo),
+                window.col_off + window.width + halo - col_stop,
+            ),
+        )
+        elevation = np.pad(elevation, pad, mode="edge")
+        bands = terrain_derivatives(
+            elevation, src.res[0], relief_radius, z_factor
+        )
+    rows = slice(halo, halo + window.height)
+    cols = slice(halo, halo + window.width)
+    return window, bands[:, rows, cols]
+
+
+def write_derivatives(
+    src_path,
+    dst_path,
+    relief_radius=15,
+    z_factor=1.0,
+    block_size=1024,
+    num_workers=None,
+):
+    """
+    Write a multi-band raster of terrain derivatives computed from a DEM.
+
+    The DEM is processed in tiles read with a halo around them, so the
+    derivatives have no artifacts at tile borders. Tiles are computed in
+    parallel worker processes and written to a tiled GeoTIFF on the grid
+    of the source DEM.
+
+    Args:
+        src_path (str): Path to the source DEM.
+        dst_path (str): Path of the derivative raster to write.
+        relief_radius (int): Radius in pixels of the local relief window.
+        z_factor (float): Factor converting elevation units to CRS units.
+        block_size (int): Size in pixels of the tiles processed at once.
+        num_workers (Optional[int]): Number of worker processes.
+
+    Returns:
+        None
+    """
+    halo = relief_radius + 2
+    with rasterio.open(src_path) as src:
+        profile = src.profile.copy()
+        windows = [
+            rasterio.windows.Window(
+                col,
+                row,
+                min(block_size, src.width - col),
+                min(block_size, src.height - row),
+            )
+            for row in range(0, src.height, block_size)
+            for col in range(0, src.width, block_size)
+        ]
+
+    profile.update(
+        driver="GTiff",
+        count=len(DERIVATIVE_BANDS),
+        dtype="float32",
+        nodata=None,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        predictor=3,
+        BIGTIFF="IF_SAFER",
+    )
+    tasks = [
+        (src_path, window, halo, relief_radius, z_factor) for window in windows
+    ]
+    tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+    with rasterio.open(tmp_path, "w", **profile) as dst:
+        for i, name in enumerate(DERIVATIVE_BANDS, start=1):
+            dst.set_band_description(i, name)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for window, bands in executor.map(_derivative_block, tasks):
+                if bands is not None:
+                    dst.write(bands, window=window)
+    os.replace(tmp_path, dst_path)
 
 
-class KaneDEM(RasterDataset):
+class KaneDEM(HandlePoolMixin, RasterDataset):
     """
     A dataset class for handling Kane County Digital Elevation Model (DEM) data.
 
@@ -22,7 +277,16 @@ class KaneDEM(RasterDataset):
 
     filename_glob = "*2017BE.tif"
 
-    def __init__(self, paths, crs=None, res=None, transforms=None):
+    def __init__(
+        self,
+        paths,
+        crs=None,
+        res=None,
+        transforms=None,
+        aligned=False,
+        derivatives=False,
+        bands=None,
+    ):
         """
         Initializes a KaneDEM instance.
 
@@ -31,12 +295,38 @@ class KaneDEM(RasterDataset):
             crs (Optional[str]): Coordinate reference system (CRS) of the DEM data.
             res (Optional[float]): Spatial resolution of the DEM data.
             transforms (Optional[callable]): function/transform to apply to DEM data.
+            aligned (bool): Whether the files were written by ``align_dem`` on
+                the grid of the images they are combined with. Samples are then
+                read with plain windowed reads instead of being warped.
+            derivatives (bool): Whether the files were written by
+                ``write_derivatives`` and hold the bands of ``DERIVATIVE_BANDS``.
+            bands (Optional[List[str]]): Bands to return (defaults to all bands).
 
         Returns:
             None
         """
-        super().__init__(paths, crs, res, transforms=transforms)
-        self.all_bands = ["elevation"]  # Assuming single band for elevation
+        if derivatives:
+            self.all_bands = DERIVATIVE_BANDS
+        else:
+            self.all_bands = ["elevation"]  # Assuming single band for elevation
+        super().__init__(paths, crs, res, bands=bands, transforms=transforms)
+        self.aligned = aligned
+
+    def _read_aligned(self, filepath, query):
+        """
+        Read a query from an aligned DEM file with a windowed read.
+
+        Args:
+            filepath (str): Path to an aligned DEM file.
+            query: The bounding box to read.
+
+        Returns:
+            torch.Tensor: The elevation data, zero outside the file.
+        """
+        src = self._cached_load_warp_file(filepath)
+        dest = read_window(src, query, self.res, self.band_indexes)
+        self._trim_handle_pool()
+        return torch.from_numpy(dest)
 
     def __getitem__(self, query):
         """
@@ -46,17 +336,166 @@ class KaneDEM(RasterDataset):
             query: An index or query to retrieve the DEM sample.
 
         Returns:
-            dict: A dictionary containing the elevation data.
+            dict: A dictionary containing the selected bands as "image", so
+            intersecting with NAIP concatenates them onto the NAIP bands.
         """
+        if self.aligned:
+            filepaths = [
+                hit.object
+                for hit in self.index.intersection(tuple(query), objects=True)
+            ]
+            if len(filepaths) == 1:
+                elevation = self._read_aligned(filepaths[0], query)
+                return {"image": elevation.to(self.dtype)}
+
         # This method loads the DEM data similar to how other raster data is loaded
         sample = super().__getitem__(query)
-        elevation = sample[
-            "image"
-        ]  # Assuming the elevation data is stored as 'image'
-        return {"elevation": elevation}
+        return {"image": sample["image"]}
 
     def __getallbands__(self):
         """
         Get all bands for this dataset.
         """
         return self.all_bands
+
+
+def align_dem_to_naip(config):
+    """
+    Write every DEM file in KC_DEM_ROOT onto the NAIP pixel grid.
+
+    Args:
+        config: the configuration settings
+    """
+    naip = NAIP(config.KC_IMAGE_ROOT)
+    reference = next(
+        iter(naip.index.intersection(naip.index.bounds, objects=True))
+    )
+    with rasterio.open(reference.object) as src:
+        origin = (src.transform.c, src.transform.f)
+
+    os.makedirs(config.KC_DEM_ALIGNED_ROOT, exist_ok=True)
+    pattern = os.path.join(config.KC_DEM_ROOT, "**", KaneDEM.filename_glob)
+    for src_path in sorted(glob.glob(pattern, recursive=True)):
+        dst_path = os.path.join(
+            config.KC_DEM_ALIGNED_ROOT, os.path.basename(src_path)
+        )
+        if os.path.exists(dst_path):
+            print(f"{dst_path} already exists, skipping")
+            continue
+        print(f"aligning {src_path} -> {dst_path}")
+        align_dem(src_path, dst_path, naip.crs, naip.res, origin)
+
+
+def write_dem_derivatives(config):
+    """
+    Write terrain derivatives for every DEM file to KC_DEM_DERIVATIVES_ROOT.
+
+    The aligned DEM is used when KC_DEM_ALIGNED_ROOT is set, so the
+    derivatives share the NAIP pixel grid.
+
+    Args:
+        config: the configuration settings
+    """
+    src_root = config.KC_DEM_ALIGNED_ROOT or config.KC_DEM_ROOT
+    os.makedirs(config.KC_DEM_DERIVATIVES_ROOT, exist_ok=True)
+    pattern = os.path.join(src_root, "**", KaneDEM.filename_glob)
+    for src_path in sorted(glob.glob(pattern, recursive=True)):
+        dst_path = os.path.join(
+            config.KC_DEM_DERIVATIVES_ROOT, os.path.basename(src_path)
+        )
+        if os.path.exists(dst_path):
+            print(f"{dst_path} already exists, skipping")
+            continue
+        print(f"computing derivatives {src_path} -> {dst_path}")
+        write_derivatives(
+            src_path,
+            dst_path,
+            relief_radius=config.KC_DEM_RELIEF_RADIUS,
+            z_factor=config.KC_DEM_Z_FACTOR,
+            num_workers=config.NUM_WORKERS,
+        )
+
+
+def band_statistics(paths, block_size=1024):
+    """
+    Compute the mean and standard deviation of every band of some rasters.
+
+    Args:
+        paths (List[str]): Paths to rasters with the same bands.
+        block_size (int): Size in pixels of the blocks read at once.
+
+    Returns:
+        tuple: Lists of the mean and the standard deviation of each band,
+        over the valid pixels of all the rasters.
+    """
+    total = total_sq = count = 0
+    for path in paths:
+        with rasterio.open(path) as src:
+            for row in range(0, src.height, block_size):
+                for col in range(0, src.width, block_size):
+                    window = rasterio.windows.Window(
+                        col,
+                        row,
+                        min(block_size, src.width - col),
+                        min(block_size, src.height - row),
+                    )
+                    block = src.read(window=window, masked=True)
+                    block = block.astype(np.float64)
+                    total = total + block.sum(axis=(1, 2)).filled(0)
+                    total_sq = total_sq + (block**2).sum(axis=(1, 2)).filled(0)
+                    count = count + block.count(axis=(1, 2))
+    mean = total / count
+    std = np.sqrt(total_sq / count - mean**2)
+    return mean.tolist(), std.tolist()
+
+
+def print_dem_statistics(config):
+    """
+    Print the statistics of the DEM bands used for training.
+
+    They are the values to set as KC_DEM_STATS in the configuration, or as
+    KC_DEM_ELEVATION_STATS without derivatives.
+
+    Args:
+        config: the configuration settings
+    """
+    src_root = (
+        config.KC_DEM_DERIVATIVES_ROOT
+        or config.KC_DEM_ALIGNED_ROOT
+        or config.KC_DEM_ROOT
+    )
+    pattern = os.path.join(src_root, "**", KaneDEM.filename_glob)
+    paths = sorted(glob.glob(pattern, recursive=True))
+    names = DERIVATIVE_BANDS
+    if config.KC_DEM_DERIVATIVES_ROOT is None:
+        names = ["elevation"]
+    mean, std = band_statistics(paths)
+    for name, band_mean, band_std in zip(names, mean, std):
+        print(f"{name}: mean {band_mean:.6g}, std {band_std:.6g}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Preprocess the Kane County DEM for training"
+    )
+    parser.add_argument(
+        "config", type=str, help="Path to the configuration file"
+    )
+    parser.add_argument(
+        "--action",
+        type=str,
+        default="align",
+        choices=["all", "align", "derivatives", "stats"],
+        help="Specify the action to perform",
+    )
+    args = parser.parse_args()
+    configs = importlib.import_module(args.config)
+
+    if args.action in ("all", "align"):
+        align_dem_to_naip(configs)
+
+    if args.action in ("all", "derivatives"):
+        write_dem_derivatives(configs)
+
+    if args.action in ("all", "stats"):
+        print_dem_statistics(configs)
@@ -0,0 +1,121 @@
+"""
+This module provides a process-local pool of open rasterio file handles for
+raster datasets, and the DataLoader worker_init_fn that applies the GDAL cache
+settings from the configuration.
+
+torchgeo caches file handles with a class-level functools.lru_cache, which is
+shared by every dataset instance and inherited across fork, so workers can end
+up reading through handles opened by the main process. HandlePoolMixin keeps
+one LRU of handles per dataset and per process instead, closing the least
+recently used handle once the pool is full.
+"""
+
+import os
+from collections import OrderedDict
+
+from rasterio.env import set_gdal_config
+from torchgeo.datasets import NAIP
+
+
+class HandlePoolMixin:
+    """Mixin giving a RasterDataset a per-process LRU pool of file handles."""
+
+    def __init__(self, *args, max_open_handles: int = 64, **kwargs) -> None:
+        """Initialize the handle pool and the wrapped dataset.
+
+        Args:
+            max_open_handles: maximum number of files kept open per process
+            *args: positional arguments of the dataset
+            **kwargs: keyword arguments of the dataset
+        """
+        self.max_open_handles = max_open_handles
+        self._handle_pool = OrderedDict()
+        self._handle_pool_pid = os.getpid()
+        super().__init__(*args, **kwargs)
+
+    def _cached_load_warp_file(self, filepath: str):
+        """Return an open handle to a file, opening it on a pool miss.
+
+        Args:
+            filepath: file to load and warp
+
+        Returns:
+            file handle of the (warped) file
+        """
+        if self._handle_pool_pid != os.getpid():
+            # handles inherited from the parent process belong to it
+            self._handle_pool = OrderedDict()
+            self._handle_pool_pid = os.getpid()
+
+        pool = self._handle_pool
+        if filepath in pool:
+            pool.move_to_end(filepath)
+            return pool[filepath]
+
+        handle = self._load_warp_file(filepath)
+        pool[filepath] = handle
+        return handle
+
+    def _trim_handle_pool(self) -> None:
+        """Close the least recently used handles beyond max_open_handles.
+
+        Called once a read is done, so the handles of a chip spanning more
+        files than the pool holds stay open until it has been merged.
+        """
+        pool = self._handle_pool
+        while len(pool) > self.max_open_handles:
+            _, handle = pool.popitem(last=False)
+            handle.close()
+
+    def _merge_files(self, filepaths, query, band_indexes=None):
+        """Load and merge one or more files, then trim the handle pool.
+
+        Args:
+            filepaths: one or more files to load and merge
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+            band_indexes: indexes of bands to be used
+
+        Returns:
+            image/mask at that index
+        """
+        try:
+            return super()._merge_files(filepaths, query, band_indexes)
+        finally:
+            self._trim_handle_pool()
+
+    def close_handles(self) -> None:
+        """Close every handle this process holds in the pool."""
+        if self._handle_pool_pid == os.getpid():
+            for handle in self._handle_pool.values():
+                handle.close()
+        self._handle_pool = OrderedDict()
+
+    def __getstate__(self):
+        """Leave the open handles out of the pickled dataset."""
+        attrs, tuples = super().__getstate__()
+        attrs = dict(attrs, _handle_pool=OrderedDict(), _handle_pool_pid=None)
+        return attrs, tuples
+
+
+class PooledNAIP(HandlePoolMixin, NAIP):
+    """NAIP dataset reading through a per-process pool of file handles."""
+
+
+def configure_gdal(worker_id: int, options=None) -> None:
+    """
+    Apply GDAL configuration options in a DataLoader worker.
+
+    Meant to be bound with functools.partial and passed as worker_init_fn.
+
+    Args:
+        worker_id: id of the DataLoader worker
+        options: dictionary of GDAL configuration options, e.g. GDAL_CACHEMAX
+            (in MB), GDAL_NUM_THREADS and VSI_CACHE
+    """
+    for key, value in (options or {}).items():
+        if value is None:
+            continue
+        if key == "GDAL_CACHEMAX":
+            # rasterio passes integers straight to GDALSetCacheMax64 as bytes
+            value = int(value) * 2**20
+        set_gdal_config(key, value)
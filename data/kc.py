@@ -6,13 +6,19 @@ samples of labels or features as masks or rasterized images within specified
 bounding boxes.
 """
 
+import hashlib
+import json
 import math
+import os
 import sys
 
 import geopandas as gpd
 import numpy as np
 import rasterio
+import rasterio.features
+import shapely
 import torch
+from rtree.index import Index, Property
 from torchgeo.datasets import BoundingBox, GeoDataset
 
 
@@ -22,6 +28,11 @@ class KaneCounty(GeoDataset):
     all_bands = ["Label"]
     is_image = False
 
+    # size in pixels of the blocks used to burn the label mosaic
+    mosaic_block_size = 4096
+    # largest offset, in pixels, from the mosaic grid of a query read from it
+    mosaic_grid_tolerance = 1e-6
+
     # all colors and labels
     all_colors = {
         0: (0, 0, 0, 0),
@@ -60,7 +71,9 @@ class KaneCounty(GeoDataset):
         15: "UNKNOWN",
     }
 
-    def __init__(self, path: str, configs) -> None:
+    def __init__(
+        self, path: str, configs, label_cache_root=None, shape_cache_root=None
+    ) -> None:
         """Initialize a new KaneCounty dataset instance.
 
         Args:
@@ -71,6 +84,11 @@ class KaneCounty(GeoDataset):
                 patch_size: the patch size used for the model
                 dest_crs: the coordinate reference system (CRS) to convert to
                 res: resolution of the dataset in units of CRS
+            label_cache_root: optional directory in which the whole layer is
+                rasterized once into a memory-mapped label mosaic; queries
+                are then served as windowed slices of the mosaic
+            shape_cache_root: optional directory in which the filtered and
+                reprojected layer is cached as GeoParquet
 
         Raises:
             FileNotFoundError: if no files are found in path
@@ -79,8 +97,15 @@ class KaneCounty(GeoDataset):
 
         layer, labels, patch_size, dest_crs, res = configs
 
-        gdf = self._load_and_prepare_data(path, layer, labels, dest_crs)
+        gdf = self._load_and_prepare_data(
+            path, layer, labels, dest_crs, shape_cache_root
+        )
         self.gdf = gdf
+        self.labels = labels
+
+        # compact per-feature arrays looked up by the integer ids in the index
+        self.geometries = gdf.geometry.to_numpy()
+        self.label_codes = gdf["BasinType"].map(labels).to_numpy(np.uint8)
 
         context_size = math.ceil(patch_size / 2 * res)
         self.context_size = context_size
@@ -88,96 +113,376 @@ class KaneCounty(GeoDataset):
         self._res = res
 
         self._populate_index(path, gdf, context_size)
-        self.labels = labels
         self.colors = {i: self.all_colors[i] for i in labels.values()}
         self.labels_inverse = {v: k for k, v in labels.items()}
 
-    def _load_and_prepare_data(self, path, layer, labels, dest_crs):
+        self.label_cache_path = None
+        self._label_mosaic = None
+        self._tree = None
+        if label_cache_root is not None:
+            self.label_cache_path = self._build_label_mosaic(
+                path, layer, label_cache_root
+            )
+
+    def _load_and_prepare_data(
+        self, path, layer, labels, dest_crs, cache_root=None
+    ):
         """Load and prepare the GeoDataFrame.
 
+        If a cache directory is given, the prepared frame is stored there as
+        GeoParquet and reloaded on later runs. The cache file is keyed by the
+        source size and modification time, the layer, the labels and the
+        destination CRS, so changing any of them prepares the data again.
+
         Args:
             path: directory to the file to load
             layer: specifying layer of GPKG
             labels: a dictionary containing a label mapping for masks
             dest_crs: the coordinate reference system (CRS) to convert to
+            cache_root: optional directory for the GeoParquet cache
 
         Returns:
             gdf: A GeoDataFrame filtered and converted to the target CRS
         """
+        cache_path = None
+        if cache_root is not None:
+            stat = os.stat(path)
+            settings = {
+                "path": os.path.abspath(path),
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "layer": layer,
+                "labels": sorted(labels.items()),
+                "crs": str(dest_crs),
+            }
+            key = hashlib.sha256(
+                json.dumps(settings, sort_keys=True).encode()
+            ).hexdigest()[:16]
+            cache_path = os.path.join(cache_root, f"kc_shapes_{key}.parquet")
+            if os.path.exists(cache_path):
+                return gpd.read_parquet(cache_path)
+
         gdf = gpd.read_file(path, layer=layer)[["BasinType", "geometry"]]
         gdf = gdf[gdf["BasinType"].isin(labels.keys())]
         gdf = gdf.to_crs(dest_crs)
+
+        if cache_path is not None:
+            os.makedirs(cache_root, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            gdf.to_parquet(tmp_path)
+            os.replace(tmp_path, cache_path)
         return gdf
 
     def _populate_index(self, path, gdf, context_size):
         """Populate the spatial index with data from the GeoDataFrame.
 
+        The index is bulk loaded in a single pass from the bounds of every
+        shape rather than inserting one row at a time. Entries only carry
+        their integer feature id, which indexes ``geometries`` and
+        ``label_codes``.
+
         Args:
+            path: directory to the file to load
             gdf: GeoDataFrame containing the data
             context_size: size of the context around shapes for sampling
+
+        Raises:
+            FileNotFoundError: if the GeoDataFrame contains no shapes
         """
-        i = 0
-        for _, row in gdf.iterrows():
-            minx, miny, maxx, maxy = row["geometry"].bounds
-            mint, maxt = 0, sys.maxsize
-            coords = (
-                minx - context_size,
-                maxx + context_size,
-                miny - context_size,
-                maxy + context_size,
-                mint,
-                maxt,
-            )
-            self.index.insert(i, coords, row)
-            i += 1
-        if i == 0:
+        if len(gdf) == 0:
             msg = f"No {self.__class__.__name__} data was found in `path='{path}'`"
             raise FileNotFoundError(msg)
 
-    def __getitem__(self, query: BoundingBox):
-        """Retrieve image/mask and metadata indexed by query.
+        bounds = gdf.bounds.to_numpy()
+        coords = np.empty((len(gdf), 6), dtype=np.float64)
+        coords[:, 0] = bounds[:, 0] - context_size
+        coords[:, 1] = bounds[:, 2] + context_size
+        coords[:, 2] = bounds[:, 1] - context_size
+        coords[:, 3] = bounds[:, 3] + context_size
+        coords[:, 4] = 0
+        coords[:, 5] = sys.maxsize
+
+        stream = ((i, tuple(coord), None) for i, coord in enumerate(coords))
+        self.index = Index(
+            stream, interleaved=False, properties=Property(dimension=3)
+        )
+
+    def _label_cache_key(self, path, layer):
+        """Compute the key identifying a label mosaic.
+
+        Args:
+            path: directory to the file to load
+            layer: specifying layer of GPKG
+
+        Returns:
+            str: hash of the source file, layer, labels, CRS, res and context
+        """
+        hasher = hashlib.sha256()
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path)
+                for name in names
+            )
+        else:
+            files = [path]
+        for fpath in files:
+            with open(fpath, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    hasher.update(chunk)
+
+        settings = {
+            "layer": layer,
+            "labels": sorted(self.labels.items()),
+            "crs": str(self._crs),
+            "res": self._res,
+            "context_size": self.context_size,
+        }
+        hasher.update(json.dumps(settings, sort_keys=True).encode())
+        return hasher.hexdigest()[:16]
+
+    def _build_label_mosaic(self, path, layer, cache_root):
+        """Rasterize the whole layer once into an on-disk uint8 label mosaic.
+
+        The mosaic covers the bounds of the index on a grid snapped to the
+        dataset resolution and is reused as long as the cache key matches.
+
+        Args:
+            path: directory to the file to load
+            layer: specifying layer of GPKG
+            cache_root: directory where the mosaic is stored
+
+        Returns:
+            str: path to the ``.npy`` file holding the mosaic
+        """
+        res = self._res
+        minx, maxx, miny, maxy = self.index.bounds[:4]
+        x0 = math.floor(minx / res) * res
+        y0 = math.ceil(maxy / res) * res
+        width = math.ceil((maxx - x0) / res)
+        height = math.ceil((y0 - miny) / res)
+        self._mosaic_origin = (x0, y0)
+
+        key = self._label_cache_key(path, layer)
+        mosaic_path = os.path.join(cache_root, f"kc_labels_{key}.npy")
+        if os.path.exists(mosaic_path):
+            return mosaic_path
+
+        print(f"Building {self.__class__.__name__} label mosaic {mosaic_path}")
+        os.makedirs(cache_root, exist_ok=True)
+        tmp_path = f"{mosaic_path}.{os.getpid()}.tmp"
+        # untouched blocks are never written and stay sparse on disk
+        mosaic = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.uint8, shape=(height, width)
+        )
+
+        block = self.mosaic_block_size
+        for row in range(0, height, block):
+            for col in range(0, width, block):
+                block_h = min(block, height - row)
+                block_w = min(block, width - col)
+                block_minx = x0 + col * res
+                block_maxy = y0 - row * res
+                idx = self.gdf.sindex.query(
+                    shapely.box(
+                        block_minx,
+                        block_maxy - block_h * res,
+                        block_minx + block_w * res,
+                        block_maxy,
+                    )
+                )
+                if len(idx) == 0:
+                    continue
+                # keep the layer order so overlapping shapes burn consistently
+                idx.sort()
+                transform = rasterio.transform.from_origin(
+                    block_minx, block_maxy, res, res
+                )
+                mosaic[row : row + block_h, col : col + block_w] = (
+                    rasterio.features.rasterize(
+                        zip(self.geometries[idx], self.label_codes[idx]),
+                        out_shape=(block_h, block_w),
+                        transform=transform,
+                    )
+                )
+
+        mosaic.flush()
+        del mosaic
+        os.replace(tmp_path, mosaic_path)
+        return mosaic_path
+
+    def _read_label_mosaic(self, query):
+        """Read the mask for a query as a windowed slice of the label mosaic.
+
+        Queries off the mosaic grid are rasterized instead, as a slice would
+        shift their mask by up to half a pixel.
 
         Args:
             query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
 
         Returns:
-            sample of image/mask and metadata at that index
+            np.ndarray: uint8 mask, zero outside the mosaic
+        """
+        x0, y0 = self._mosaic_origin
+        height = round((query.maxy - query.miny) / self._res)
+        width = round((query.maxx - query.minx) / self._res)
+        row = (y0 - query.maxy) / self._res
+        col = (query.minx - x0) / self._res
+        offset = max(abs(row - round(row)), abs(col - round(col)))
+        if offset > self.mosaic_grid_tolerance:
+            try:
+                return self._rasterize_query(query)
+            except IndexError:
+                # no shapes within the query
+                return np.zeros((height, width), dtype=np.uint8)
+        row, col = round(row), round(col)
+
+        if self._label_mosaic is None:
+            # opened lazily so every DataLoader worker maps its own view
+            self._label_mosaic = np.load(self.label_cache_path, mmap_mode="r")
+        mosaic = self._label_mosaic
+
+        masks = np.zeros((height, width), dtype=np.uint8)
+        row_start, col_start = max(row, 0), max(col, 0)
+        row_stop = min(row + height, mosaic.shape[0])
+        col_stop = min(col + width, mosaic.shape[1])
+        if row_stop > row_start and col_stop > col_start:
+            masks[
+                row_start - row : row_stop - row,
+                col_start - col : col_stop - col,
+            ] = mosaic[row_start:row_stop, col_start:col_stop]
+        return masks
+
+    def __getstate__(self):
+        """Define how instances are pickled.
+
+        The GeoDataFrame, the mosaic mapping and the STRtree are left out;
+        samples only need the index and the compact feature arrays.
+
+        Returns:
+            the state necessary to unpickle the instance
+        """
+        attrs, tuples = super().__getstate__()
+        attrs = dict(attrs, gdf=None, _label_mosaic=None, _tree=None)
+        return attrs, tuples
+
+    def _rasterize_query(self, query):
+        """Rasterize the shapes intersecting a query into a mask.
+
+        Args:
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+
+        Returns:
+            np.ndarray: uint8 mask of the labels within the query
 
         Raises:
             IndexError: if query is not found in the index
         """
-        hits = self.index.intersection(tuple(query), objects=True)
-        objs = [hit.object for hit in hits]
+        ids = np.fromiter(self.index.intersection(tuple(query)), dtype=np.intp)
 
-        if not objs:
+        if len(ids) == 0:
             raise IndexError(
                 f"query: {query} not found in index with bounds: {self.bounds}"
             )
 
-        shapes = []
-        for obj in objs:
-            shape = obj["geometry"]
-            label = self.labels[obj["BasinType"]]
-            shapes.append((shape, label))
+        # keep the layer order so overlapping shapes burn as in the mosaic
+        ids.sort()
+        shapes = zip(self.geometries[ids], self.label_codes[ids])
 
         width = (query.maxx - query.minx) / self._res
         height = (query.maxy - query.miny) / self._res
         transform = rasterio.transform.from_bounds(
             query.minx, query.miny, query.maxx, query.maxy, width, height
         )
-        if shapes and min((round(height), round(width))) != 0:
+        if min((round(height), round(width))) != 0:
             masks = rasterio.features.rasterize(
                 shapes,
                 out_shape=(round(height), round(width)),
                 transform=transform,
             )
         else:
-            # If no features are found in this query, return an empty mask
+            # If the query has no extent, return an empty mask
             # with the default fill value and dtype used by rasterize
             masks = np.zeros((round(height), round(width)), dtype=np.uint8)
 
+        return masks
+
+    def get_batch(self, queries):
+        """Retrieve the masks for a batch of queries at once.
+
+        All windows are matched against the shapes with a single vectorized
+        STRtree query, grouped per window and rasterized.
+
+        Args:
+            queries: list of (minx, maxx, miny, maxy, mint, maxt) coordinates
+
+        Returns:
+            torch.Tensor: uint8 masks stacked to shape (B, H, W)
+        """
+        if self.label_cache_path is not None:
+            masks = [self._read_label_mosaic(query) for query in queries]
+            return torch.from_numpy(np.stack(masks))
+
+        if self._tree is None:
+            self._tree = shapely.STRtree(self.geometries)
+
+        bounds = np.array([tuple(query)[:4] for query in queries])
+        minx, maxx, miny, maxy = bounds.T
+        windows = shapely.box(minx, miny, maxx, maxy)
+        window_idx, shape_idx = self._tree.query(windows)
+
+        # group hits per window, keeping the layer order within each window
+        order = np.lexsort((shape_idx, window_idx))
+        window_idx, shape_idx = window_idx[order], shape_idx[order]
+        splits = np.searchsorted(window_idx, np.arange(1, len(queries)))
+
+        masks = []
+        for query, ids in zip(queries, np.split(shape_idx, splits)):
+            width = round((query.maxx - query.minx) / self._res)
+            height = round((query.maxy - query.miny) / self._res)
+            if len(ids) and min(height, width) != 0:
+                transform = rasterio.transform.from_bounds(
+                    query.minx,
+                    query.miny,
+                    query.maxx,
+                    query.maxy,
+                    width,
+                    height,
+                )
+                mask = rasterio.features.rasterize(
+                    zip(self.geometries[ids], self.label_codes[ids]),
+                    out_shape=(height, width),
+                    transform=transform,
+                )
+            else:
+                mask = np.zeros((height, width), dtype=np.uint8)
+            masks.append(mask)
+
+        return torch.from_numpy(np.stack(masks))
+
+    def __getitem__(self, query: BoundingBox):
+        """Retrieve image/mask and metadata indexed by query.
+
+        Args:
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+
+        Returns:
+            sample of image/mask and metadata at that index
+
+        Raises:
+            IndexError: if query is not found in the index
+        """
+        if self.label_cache_path is not None:
+            if not self.index.count(tuple(query)):
+                raise IndexError(
+                    f"query: {query} not found in index with bounds: {self.bounds}"
+                )
+            masks = self._read_label_mosaic(query)
+        else:
+            masks = self._rasterize_query(query)
+
         sample = {
-            "mask": torch.Tensor(masks).long(),
+            "mask": torch.from_numpy(masks),
             "crs": self.crs,
             "bbox": query,
         }
@@ -0,0 +1,326 @@
+"""
+This module provides a single GDAL VRT mosaic over the downloaded NAIP tiles
+and a dataset reading chips from it. torchgeo's NAIP dataset indexes every
+tile at startup and merges a chip straddling tile edges from several files on
+every read; with the mosaic the index holds one entry and every chip is a
+single windowed read.
+
+To run: from repo directory (2024-winter-cmap)
+> python retrieve_images.py configs.config --action vrt
+"""
+
+import glob
+import math
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import rasterio
+import rasterio.windows
+import torch
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from rtree.index import Index, Property
+from torchgeo.datasets import NAIP, RasterDataset
+from torchgeo.datasets.utils import BoundingBox
+
+from data.handles import HandlePoolMixin
+
+GDAL_TYPES = {
+    "uint8": "Byte",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+COLOR_INTERP = ["Red", "Green", "Blue", "Undefined"]
+
+
+def read_window(src, query, res, indexes=None) -> np.ndarray:
+    """
+    Read a query from a file on the query grid with a single windowed read.
+
+    Args:
+        src: open rasterio dataset in the CRS and resolution of the query
+        query: (minx, maxx, miny, maxy, mint, maxt) coordinates to read
+        res: resolution of the file
+        indexes: band indexes to read, defaults to every band
+
+    Returns:
+        np.ndarray: (bands, height, width) array, zero outside the file
+    """
+    height = round((query.maxy - query.miny) / res)
+    width = round((query.maxx - query.minx) / res)
+    row = round((src.transform.f - query.maxy) / res)
+    col = round((query.minx - src.transform.c) / res)
+
+    count = len(indexes) if indexes else src.count
+    dest = np.zeros((count, height, width), dtype=src.dtypes[0])
+    row_start, col_start = max(row, 0), max(col, 0)
+    row_stop = min(row + height, src.height)
+    col_stop = min(col + width, src.width)
+    if row_stop > row_start and col_stop > col_start:
+        window = rasterio.windows.Window.from_slices(
+            (row_start, row_stop), (col_start, col_stop)
+        )
+        dest[
+            :,
+            row_start - row : row_stop - row,
+            col_start - col : col_stop - col,
+        ] = src.read(indexes, window=window)
+    return dest
+
+
+def _tile_date(fpath: str) -> str:
+    """Return the acquisition date in a NAIP file name, or an empty string."""
+    regex = re.compile(NAIP.filename_regex, re.VERBOSE)
+    match = regex.match(os.path.basename(fpath))
+    return match.group("date") if match else ""
+
+
+def _pixels(value: float, eps: float = 1e-6) -> str:
+    """Format a pixel offset or size, snapped to an integer when within eps."""
+    if abs(value - round(value)) < eps:
+        return str(round(value))
+    return repr(value)
+
+
+def build_naip_vrt(img_dir: str, vrt_path: str) -> int:
+    """
+    Write a VRT mosaic of the NAIP tiles in a directory.
+
+    The mosaic uses the CRS and pixel grid of the first tile and the finest
+    resolution of the tiles. Where tiles overlap, the most recent acquisition
+    is drawn on top. Source paths are relative to the VRT and the source
+    properties are recorded, so opening the mosaic does not open the tiles.
+
+    Args:
+        img_dir: directory containing the NAIP tiles
+        vrt_path: path of the VRT file to write
+
+    Returns:
+        int: number of tiles in the mosaic
+    """
+    fpaths = sorted(
+        glob.glob(
+            os.path.join(img_dir, "**", NAIP.filename_glob), recursive=True
+        )
+    )
+    fpaths = [fpath for fpath in fpaths if not fpath.endswith(".vrt")]
+    if not fpaths:
+        raise FileNotFoundError(f"No NAIP tiles found in {img_dir}")
+    # later sources are drawn over earlier ones
+    fpaths.sort(key=lambda fpath: (_tile_date(fpath), fpath))
+
+    tiles = []
+    for fpath in fpaths:
+        with rasterio.open(fpath) as src:
+            tiles.append(
+                {
+                    "path": fpath,
+                    "crs": src.crs,
+                    "bounds": src.bounds,
+                    "res": src.res[0],
+                    "shape": (src.height, src.width),
+                    "count": src.count,
+                    "dtype": src.dtypes[0],
+                    "block": src.block_shapes[0],
+                }
+            )
+
+    crs = tiles[0]["crs"]
+    mismatched = [tile["path"] for tile in tiles if tile["crs"] != crs]
+    if mismatched:
+        raise ValueError(
+            f"NAIP tiles are not all in {crs}: {', '.join(mismatched)}"
+        )
+
+    res = min(tile["res"] for tile in tiles)
+    count = tiles[0]["count"]
+    origin_x = tiles[0]["bounds"].left
+    origin_y = tiles[0]["bounds"].top
+    # tolerate floating point error when snapping the extent to whole pixels
+    eps = 1e-6
+    minx = origin_x + res * math.floor(
+        (min(t["bounds"].left for t in tiles) - origin_x) / res + eps
+    )
+    maxy = origin_y + res * math.ceil(
+        (max(t["bounds"].top for t in tiles) - origin_y) / res - eps
+    )
+    width = math.ceil(
+        (max(t["bounds"].right for t in tiles) - minx) / res - eps
+    )
+    height = math.ceil(
+        (maxy - min(t["bounds"].bottom for t in tiles)) / res - eps
+    )
+
+    root = ET.Element(
+        "VRTDataset", rasterXSize=str(width), rasterYSize=str(height)
+    )
+    ET.SubElement(root, "SRS").text = crs.to_wkt()
+    ET.SubElement(root, "GeoTransform").text = (
+        f"{minx!r}, {res!r}, 0.0, {maxy!r}, 0.0, {-res!r}"
+    )
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_path))
+    for band in range(1, count + 1):
+        band_element = ET.SubElement(
+            root,
+            "VRTRasterBand",
+            dataType=GDAL_TYPES[tiles[0]["dtype"]],
+            band=str(band),
+        )
+        ET.SubElement(band_element, "ColorInterp").text = COLOR_INTERP[
+            min(band, len(COLOR_INTERP)) - 1
+        ]
+        for tile in tiles:
+            source = ET.SubElement(band_element, "SimpleSource")
+            filename = ET.SubElement(
+                source, "SourceFilename", relativeToVRT="1"
+            )
+            filename.text = os.path.relpath(
+                os.path.abspath(tile["path"]), vrt_dir
+            )
+            ET.SubElement(source, "SourceBand").text = str(band)
+            tile_height, tile_width = tile["shape"]
+            block_height, block_width = tile["block"]
+            ET.SubElement(
+                source,
+                "SourceProperties",
+                RasterXSize=str(tile_width),
+                RasterYSize=str(tile_height),
+                DataType=GDAL_TYPES[tile["dtype"]],
+                BlockXSize=str(block_width),
+                BlockYSize=str(block_height),
+            )
+            ET.SubElement(
+                source,
+                "SrcRect",
+                xOff="0",
+                yOff="0",
+                xSize=str(tile_width),
+                ySize=str(tile_height),
+            )
+            scale = tile["res"] / res
+            ET.SubElement(
+                source,
+                "DstRect",
+                xOff=_pixels((tile["bounds"].left - minx) / res),
+                yOff=_pixels((maxy - tile["bounds"].top) / res),
+                xSize=_pixels(tile_width * scale),
+                ySize=_pixels(tile_height * scale),
+            )
+
+    tmp_path = f"{vrt_path}.{os.getpid()}.tmp"
+    ET.ElementTree(root).write(tmp_path)
+    os.replace(tmp_path, vrt_path)
+    return len(tiles)
+
+
+def mosaic_tiles(vrt_path: str, crs=None) -> list:
+    """
+    Return the bounds of the tiles of a VRT mosaic without opening them.
+
+    Args:
+        vrt_path: path of a VRT written by build_naip_vrt
+        crs: CRS of the bounds, defaults to the CRS of the mosaic
+
+    Returns:
+        list: (minx, maxx, miny, maxy) bounds of each tile
+    """
+    with rasterio.open(vrt_path) as src:
+        transform, src_crs = src.transform, src.crs
+    band = ET.parse(vrt_path).getroot().find("VRTRasterBand")
+    tiles = []
+    for rect in band.iter("DstRect"):
+        window = Window(
+            float(rect.get("xOff")),
+            float(rect.get("yOff")),
+            float(rect.get("xSize")),
+            float(rect.get("ySize")),
+        )
+        left, bottom, right, top = rasterio.windows.bounds(window, transform)
+        if crs is not None and crs != src_crs:
+            left, bottom, right, top = transform_bounds(
+                src_crs, crs, left, bottom, right, top
+            )
+        tiles.append((left, right, bottom, top))
+    return tiles
+
+
+class NAIPMosaic(HandlePoolMixin, RasterDataset):
+    """NAIP imagery read from a VRT mosaic written by build_naip_vrt."""
+
+    filename_glob = "*.vrt"
+    all_bands = NAIP.all_bands
+    rgb_bands = NAIP.rgb_bands
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Initialize the dataset and index the mosaic by tile.
+
+        Args:
+            *args: positional arguments of the dataset
+            **kwargs: keyword arguments of the dataset
+        """
+        super().__init__(*args, **kwargs)
+        mosaics = [
+            hit.object
+            for hit in self.index.intersection(self.bounds, objects=True)
+        ]
+        self.index = Index(interleaved=False, properties=Property(dimension=3))
+        i = 0
+        for vrt_path in mosaics:
+            for bounds in mosaic_tiles(vrt_path, self.crs):
+                self.index.insert(i, (*bounds, 0, sys.maxsize), vrt_path)
+                i += 1
+
+    def _covered(self, query) -> np.ndarray:
+        """Return which pixels of a query fall within the indexed tiles.
+
+        Args:
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+
+        Returns:
+            np.ndarray: (height, width) boolean array
+        """
+        height = round((query.maxy - query.miny) / self.res)
+        width = round((query.maxx - query.minx) / self.res)
+        covered = np.zeros((height, width), dtype=bool)
+        for hit in self.index.intersection(tuple(query), objects=True):
+            tile = BoundingBox(*hit.bounds)
+            row_start = max(round((query.maxy - tile.maxy) / self.res), 0)
+            row_stop = round((query.maxy - tile.miny) / self.res)
+            col_start = max(round((tile.minx - query.minx) / self.res), 0)
+            col_stop = round((tile.maxx - query.minx) / self.res)
+            covered[row_start:row_stop, col_start:col_stop] = True
+        return covered
+
+    def _merge_files(self, filepaths, query, band_indexes=None):
+        """Read a query from the mosaic with a single windowed read.
+
+        Args:
+            filepaths: files intersecting the query
+            query: (minx, maxx, miny, maxy, mint, maxt) coordinates to index
+            band_indexes: indexes of bands to be used
+
+        Returns:
+            image at that index
+        """
+        # every tile of a mosaic is indexed with the path of the mosaic
+        filepaths = list(dict.fromkeys(filepaths))
+        if len(filepaths) != 1:
+            return super()._merge_files(filepaths, query, band_indexes)
+
+        src = self._cached_load_warp_file(filepaths[0])
+        try:
+            dest = read_window(src, query, self.res, band_indexes)
+        finally:
+            self._trim_handle_pool()
+        # as the NAIP dataset does, leave out tiles not in this (split) index
+        covered = self._covered(query)
+        if not covered.all():
+            dest *= covered
+        return torch.from_numpy(dest)
@@ -0,0 +1,150 @@
+"""
+This module provides a wrapper that moves DataLoader batches to the model
+device ahead of the training loop. On CUDA the copies of the next batch are
+issued from pinned memory on a side stream while the current batch is being
+used; on other devices a background thread keeps a small queue of batches
+already on the device. The time the loop spends waiting for data is recorded
+so it can be reported per step.
+"""
+
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+_DONE = object()
+
+
+class DevicePrefetcher:
+    """Iterable over the batches of a DataLoader, already on a device."""
+
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        device,
+        keys=("image", "mask"),
+        depth: int = 2,
+    ) -> None:
+        """Initialize a new DevicePrefetcher instance.
+
+        Args:
+            dataloader: loader producing collated sample dictionaries; it
+                should pin memory when the device is a CUDA device
+            device: device the tensors are moved to
+            keys: entries of each sample that are moved to the device
+            depth: number of batches queued ahead when not using CUDA
+        """
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.keys = keys
+        self.depth = depth
+        self.wait_time = 0.0
+        self.steps = 0
+
+    def __len__(self) -> int:
+        """Return the number of batches of the wrapped DataLoader.
+
+        Returns:
+            number of batches per epoch
+        """
+        return len(self.dataloader)
+
+    @property
+    def mean_wait(self) -> float:
+        """Mean time in seconds the last iteration waited for a batch."""
+        return self.wait_time / max(self.steps, 1)
+
+    def _to_device(self, sample, non_blocking: bool):
+        """Move the selected entries of a sample to the device."""
+        for key in self.keys:
+            if isinstance(sample.get(key), torch.Tensor):
+                sample[key] = sample[key].to(
+                    self.device, non_blocking=non_blocking
+                )
+        return sample
+
+    def __iter__(self):
+        """Yield the batches of the DataLoader with tensors on the device.
+
+        Yields:
+            collated samples whose selected entries are on the device
+        """
+        self.wait_time = 0.0
+        self.steps = 0
+        if self.device.type == "cuda":
+            yield from self._iter_cuda()
+        else:
+            yield from self._iter_threaded()
+
+    def _iter_cuda(self):
+        """Double-buffer batches with non-blocking copies on a side stream."""
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.dataloader)
+
+        def load():
+            start = time.perf_counter()
+            sample = next(iterator, _DONE)
+            self.wait_time += time.perf_counter() - start
+            if sample is not _DONE:
+                with torch.cuda.stream(stream):
+                    sample = self._to_device(sample, non_blocking=True)
+            return sample
+
+        next_sample = load()
+        while next_sample is not _DONE:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            sample = next_sample
+            for key in self.keys:
+                if isinstance(sample.get(key), torch.Tensor):
+                    # keep the copy alive until the compute stream is done
+                    sample[key].record_stream(current)
+            # issue the copy of the following batch before handing this out
+            next_sample = load()
+            self.steps += 1
+            yield sample
+
+    def _iter_threaded(self):
+        """Queue batches moved to the device from a background thread."""
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for sample in self.dataloader:
+                    sample = self._to_device(sample, non_blocking=False)
+                    while not stop.is_set():
+                        try:
+                            batches.put(sample, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+                batches.put(_DONE)
+            except Exception as error:  # re-raised in the training loop
+                batches.put(error)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                sample = batches.get()
+                self.wait_time += time.perf_counter() - start
+                if sample is _DONE:
+                    break
+                if isinstance(sample, Exception):
+                    raise sample
+                self.steps += 1
+                yield sample
+        finally:
+            stop.set()
+            # drain the queue so a producer blocked on put can finish
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
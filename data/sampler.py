@@ -6,17 +6,187 @@ the dataset are smaller than the desired patch size, ensuring that both
 background and feature areas are adequately represented in the sampled data.
 """
 
+import itertools
 import math
 
+import numpy as np
 import torch
-from torchgeo.datasets import BoundingBox
+import torch.distributed as dist
+from numpy.lib.recfunctions import structured_to_unstructured
+from torchgeo.datasets import BoundingBox, IntersectionDataset
 from torchgeo.samplers import BatchGeoSampler, GeoSampler
 from torchgeo.samplers.constants import Units
-from torchgeo.samplers.utils import (
-    _to_tuple,
-    get_random_bounding_box,
-    tile_to_chips,
+from torchgeo.samplers.utils import _to_tuple
+
+LOCALITY_MODES = ("tile", "hilbert")
+HILBERT_ORDER = 16  # bits per axis of the Hilbert curve grid
+
+# one record per sampled region, replacing lists of rtree items
+HIT_DTYPE = np.dtype(
+    [
+        ("minx", np.float64),
+        ("maxx", np.float64),
+        ("miny", np.float64),
+        ("maxy", np.float64),
+        ("mint", np.float64),
+        ("maxt", np.float64),
+        ("area", np.float64),
+        ("rows", np.int64),
+        ("cols", np.int64),
+    ]
 )
+BOUNDS_FIELDS = ["minx", "maxx", "miny", "maxy", "mint", "maxt"]
+
+
+def index_bounds(index, roi) -> np.ndarray:
+    """
+    Return the bounds of the index entries intersecting a region of interest.
+
+    Args:
+        index: rtree index of a dataset
+        roi: region of interest
+
+    Returns:
+        np.ndarray: (N, 6) array of (minx, maxx, miny, maxy, mint, maxt)
+    """
+    items = index.intersection(tuple(roi), objects=True)
+    return np.array([item.bounds for item in items], dtype=np.float64).reshape(
+        -1, 6
+    )
+
+
+def make_hits(bounds, area, rows, cols) -> np.ndarray:
+    """
+    Pack the bounds, areas and chip counts of hits into a HIT_DTYPE array.
+
+    Args:
+        bounds: (N, 6) array of (minx, maxx, miny, maxy, mint, maxt)
+        area: (N,) array of sampling areas
+        rows: (N,) array of chip rows
+        cols: (N,) array of chip columns
+
+    Returns:
+        np.ndarray: structured array of the hits
+    """
+    hits = np.empty(len(bounds), dtype=HIT_DTYPE)
+    for i, name in enumerate(BOUNDS_FIELDS):
+        hits[name] = bounds[:, i]
+    hits["area"] = area
+    hits["rows"] = rows
+    hits["cols"] = cols
+    return hits
+
+
+def hit_bounds(hits) -> np.ndarray:
+    """
+    Return the bounds of a HIT_DTYPE array as a plain (N, 6) array.
+    """
+    return structured_to_unstructured(hits[BOUNDS_FIELDS])
+
+
+def hilbert_index(x, y, order=HILBERT_ORDER) -> np.ndarray:
+    """
+    Return the positions of points along a Hilbert curve.
+
+    Args:
+        x: integer x coordinates in [0, 2**order)
+        y: integer y coordinates in [0, 2**order)
+        order: number of bits per axis of the curve grid
+
+    Returns:
+        np.ndarray: distance of each point along the curve
+    """
+    x = np.asarray(x, dtype=np.int64).copy()
+    y = np.asarray(y, dtype=np.int64).copy()
+    last = (1 << order) - 1
+    d = np.zeros_like(x)
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x[flip] = last - x[flip]
+        y[flip] = last - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        s >>= 1
+    return d
+
+
+def tile_index(dataset):
+    """
+    Return the index of the source tiles of a dataset.
+
+    For an intersection of datasets, such as the NAIP tiles and the
+    KaneCounty labels, these are the tiles of the first dataset.
+
+    Args:
+        dataset: dataset a sampler indexes from
+
+    Returns:
+        rtree index whose entries are the source tiles
+    """
+    while isinstance(dataset, IntersectionDataset):
+        dataset = dataset.datasets[0]
+    return dataset.index
+
+
+def default_generator() -> torch.Generator:
+    """
+    Return a generator seeded from the global torch RNG, as torch's
+    RandomSampler does when it is not given one.
+    """
+    seed = int(torch.empty((), dtype=torch.int64).random_().item())
+    return torch.Generator().manual_seed(seed)
+
+
+def get_shard(config):
+    """
+    Return the number of replicas and the rank a sampler draws for.
+
+    Args:
+        config: sampler config, optionally with num_replicas and rank keys;
+            missing values are taken from the initialized default process
+            group, or describe a single process without one
+
+    Returns:
+        tuple: (num_replicas, rank)
+    """
+    distributed = dist.is_available() and dist.is_initialized()
+    num_replicas = config.get("num_replicas")
+    if num_replicas is None:
+        num_replicas = dist.get_world_size() if distributed else 1
+    rank = config.get("rank")
+    if rank is None:
+        rank = dist.get_rank() if distributed else 0
+    if not 0 <= rank < num_replicas:
+        raise ValueError(f"Rank {rank} is not in [0, {num_replicas})")
+    return num_replicas, rank
+
+
+def rank_generator(generator, num_replicas, rank) -> torch.Generator:
+    """
+    Return a generator for one rank, independent of the other ranks' ones.
+
+    The streams are spawned from the initial seed of the given generator, so
+    every rank must be given a generator with the same seed.
+
+    Args:
+        generator: generator shared by all ranks
+        num_replicas: number of ranks
+        rank: rank to return the generator of
+
+    Returns:
+        torch.Generator: the given generator for a single replica, otherwise
+            a new generator seeded for the rank
+    """
+    if num_replicas == 1:
+        return generator
+    sequence = np.random.SeedSequence(generator.initial_seed())
+    seed = sequence.spawn(num_replicas)[rank].generate_state(1, np.uint64)[0]
+    return torch.Generator().manual_seed(int(seed))
 
 
 class BalancedRandomBatchGeoSampler(BatchGeoSampler):
@@ -40,6 +210,21 @@ class BalancedRandomBatchGeoSampler(BatchGeoSampler):
                 - length: number of samples per epoch
                 - roi: region of interest to sample from
                 - units: defines if size is in pixel or CRS units
+                - generator: torch.Generator the boxes are drawn with,
+                  seeded from the global torch RNG if not given
+                - num_replicas: number of ranks sharing an epoch
+                - rank: rank of this sampler
+                - locality: None to yield the boxes in the order drawn, or
+                  "tile" or "hilbert" to group them by source tile or along
+                  a Hilbert curve
+                - locality_batches: number of batches grouped together in
+                  locality mode
+                - snap: whether to snap the boxes to the pixel grid of
+                  multiples of res, on which the KaneCounty label mosaic is
+                  read without rasterizing
+
+        With several replicas, each rank draws its share of the epoch from its
+        own stream, spawned from the generator's seed.
         """
         super().__init__(config["dataset"], config.get("roi"))
         self.size = _to_tuple(config["size"])
@@ -54,45 +239,135 @@ class BalancedRandomBatchGeoSampler(BatchGeoSampler):
         if config.get("length") is not None:
             self.length = config["length"]
 
+        self.locality = config.get("locality")
+        if self.locality not in (None,) + LOCALITY_MODES:
+            raise ValueError(
+                f"Unknown locality {self.locality}, "
+                f"expected one of {LOCALITY_MODES}"
+            )
+        self.locality_batches = config.get("locality_batches", 8)
+        self.snap = config.get("snap", False)
+        self.hit_tiles = None
+        if self.locality == "tile":
+            self.hit_tiles = self.find_hit_tiles(tile_index(config["dataset"]))
+
+        self.num_replicas, self.rank = get_shard(config)
+        self.generator = rank_generator(
+            config.get("generator") or default_generator(),
+            self.num_replicas,
+            self.rank,
+        )
+        # generator state the current epoch was drawn from, the batches
+        # yielded from it, and the batch the next epoch starts at
+        self._epoch_state = None
+        self._position = 0
+        self._start = 0
+
     def calculate_hits_and_areas(self):
         """
         Calculate hits and areas for the dataset.
 
         Returns:
-            hits: List of hits within the region of interest.
+            hits: HIT_DTYPE array of the hits within the region of interest.
             areas: Tensor of areas corresponding to each hit.
         """
-        hits = []
-        areas = []
-        context_x = self.size[1] / 2
-        context_y = self.size[0] / 2
-
-        for hit in self.index.intersection(tuple(self.roi), objects=True):
-            bounds = BoundingBox(*hit.bounds)
-            if (
-                bounds.maxx - bounds.minx >= self.size[1]
-                and bounds.maxy - bounds.miny >= self.size[0]
-            ):
-                shape_bounds = self.get_shape_bounds(
-                    bounds, context_x, context_y
-                )
-                if (
-                    shape_bounds.maxx - shape_bounds.minx >= self.size[1]
-                    or shape_bounds.maxy - shape_bounds.miny >= self.size[0]
-                ):
-                    rows, cols = tile_to_chips(shape_bounds, self.size)
-                    self.length += rows * cols
-                else:
-                    self.length += 1
-                hits.append(hit)
-                areas.append(shape_bounds.area)
-
-        areas_tensor = torch.tensor(areas, dtype=torch.float)
+        height, width = self.size
+        bounds = index_bounds(self.index, self.roi)
+        bounds = bounds[
+            (bounds[:, 1] - bounds[:, 0] >= width)
+            & (bounds[:, 3] - bounds[:, 2] >= height)
+        ]
+
+        # shape bounds leave out the context added around each shape
+        shape_width = bounds[:, 1] - bounds[:, 0] - width
+        shape_height = bounds[:, 3] - bounds[:, 2] - height
+        tiled = (shape_width >= width) | (shape_height >= height)
+        rows = np.where(tiled, np.ceil((shape_height - height) / height) + 1, 1)
+        cols = np.where(tiled, np.ceil((shape_width - width) / width) + 1, 1)
+        hits = make_hits(bounds, shape_width * shape_height, rows, cols)
+        self.length += int(np.sum(hits["rows"] * hits["cols"]))
+
+        areas_tensor = torch.tensor(hits["area"], dtype=torch.float)
         if torch.sum(areas_tensor) == 0:
             areas_tensor += 1
 
         return hits, areas_tensor
 
+    @property
+    def bounds(self) -> np.ndarray:
+        """
+        Bounds of the hits as a (N, 6) array of (minx, maxx, miny, maxy,
+        mint, maxt) coordinates.
+        """
+        return hit_bounds(self.hits)
+
+    def find_hit_tiles(self, tiles) -> np.ndarray:
+        """
+        Find the source tile containing the centre of each hit.
+
+        Args:
+            tiles: rtree index of the source tiles
+
+        Returns:
+            np.ndarray: id of the tile of each hit, or -1 if there is none
+        """
+        hit_tiles = np.full(len(self.hits), -1, dtype=np.int64)
+        centres = np.stack(
+            [
+                (self.hits["minx"] + self.hits["maxx"]) / 2,
+                (self.hits["miny"] + self.hits["maxy"]) / 2,
+                self.hits["mint"],
+            ],
+            axis=1,
+        )
+        for i, (x, y, t) in enumerate(centres.tolist()):
+            hit_tiles[i] = next(tiles.intersection((x, x, y, y, t, t)), -1)
+        return hit_tiles
+
+    def locality_order(self, idx, boxes) -> np.ndarray:
+        """
+        Return an order of drawn boxes that keeps nearby boxes together.
+
+        Boxes are sorted by source tile, then along a Hilbert curve, and cut
+        into windows of locality_batches batches. The order of the windows and
+        of the boxes within each window is then shuffled, so batches stay
+        random while consecutive reads come from the same files.
+
+        Args:
+            idx: index of the hit each box was drawn from
+            boxes: (N, 6) array of drawn boxes
+
+        Returns:
+            np.ndarray: permutation of the boxes
+        """
+        num_samples = len(boxes)
+        if num_samples == 0:
+            return np.arange(0)
+        scale = (1 << HILBERT_ORDER) - 1
+        keys = []
+        for lo, hi, start, stop in (
+            (0, 1, self.roi.minx, self.roi.maxx),
+            (2, 3, self.roi.miny, self.roi.maxy),
+        ):
+            centre = (boxes[:, lo] + boxes[:, hi]) / 2
+            extent = max(stop - start, self.res)
+            keys.append(np.clip((centre - start) / extent * scale, 0, scale))
+        sort_keys = [hilbert_index(*keys)]
+        if self.hit_tiles is not None:
+            sort_keys.append(self.hit_tiles[idx])
+        order = np.lexsort(sort_keys)
+
+        window = np.arange(num_samples) // (
+            self.locality_batches * self.batch_size
+        )
+        window_order = torch.randperm(
+            int(window[-1]) + 1, generator=self.generator
+        ).numpy()
+        noise = torch.rand(
+            num_samples, dtype=torch.float64, generator=self.generator
+        ).numpy()
+        return order[np.lexsort((noise, window_order[window]))]
+
     def get_shape_bounds(self, bounds, context_x, context_y):
         """
         Get adjusted shape bounds considering context.
@@ -114,24 +389,120 @@ class BalancedRandomBatchGeoSampler(BatchGeoSampler):
             bounds.maxt,
         )
 
+    def draw_epoch(self, num_samples):
+        """
+        Draw the bounding boxes of a whole epoch at once.
+
+        Hits are drawn with replacement in proportion to their areas, and each
+        box is placed at a random pixel offset within its hit, as
+        get_random_bounding_box does for a single box. In locality mode the
+        same boxes are then reordered by locality_order.
+
+        Args:
+            num_samples: number of bounding boxes to draw
+
+        Returns:
+            np.ndarray: (num_samples, 6) array of (minx, maxx, miny, maxy,
+                mint, maxt) coordinates
+        """
+        idx = torch.multinomial(
+            self.areas, num_samples, replacement=True, generator=self.generator
+        )
+        bounds = self.bounds[idx.numpy()]
+        height, width = self.size
+
+        # number of whole pixels each box can be offset by within its hit
+        offsets = np.stack(
+            [
+                (bounds[:, 1] - bounds[:, 0] - width) // self.res,
+                (bounds[:, 3] - bounds[:, 2] - height) // self.res,
+            ],
+            axis=1,
+        )
+        offsets = np.where(offsets > 0, offsets * self.res, 0.0)
+        offsets *= torch.rand(
+            num_samples, 2, dtype=torch.float64, generator=self.generator
+        ).numpy()
+
+        boxes = np.empty_like(bounds)
+        boxes[:, 0] = bounds[:, 0] + offsets[:, 0]
+        boxes[:, 2] = bounds[:, 2] + offsets[:, 1]
+        if self.snap:
+            boxes[:, [0, 2]] = np.round(boxes[:, [0, 2]] / self.res) * self.res
+        boxes[:, 1] = boxes[:, 0] + width
+        boxes[:, 3] = boxes[:, 2] + height
+        boxes[:, 4:] = bounds[:, 4:]
+        if self.locality is not None:
+            boxes = boxes[self.locality_order(idx.numpy(), boxes)]
+        return boxes
+
     def __iter__(self):
         """
         Return a batch of indices of a dataset.
 
+        After load_state_dict, the epoch that was interrupted is drawn again
+        and iteration starts at its first unseen batch.
+
         Yields:
             batch of (minx, maxx, miny, maxy, mint, maxt) coordinates to index a dataset
         """
-        for _ in range(len(self)):
-            batch = []
-            for _ in range(self.batch_size):
-                idx = torch.multinomial(self.areas, 1)
-                hit = self.hits[idx]
-                bounds = BoundingBox(*hit.bounds)
-                bounding_box = get_random_bounding_box(
-                    bounds, self.size, self.res
-                )
-                batch.append(bounding_box)
-            yield batch
+        start, self._start = self._start, 0
+        self._epoch_state = self.generator.get_state()
+        self._position = start
+        if len(self) == 0:
+            return
+        boxes = self.draw_epoch(len(self) * self.batch_size)
+        for first in range(
+            start * self.batch_size, len(boxes), self.batch_size
+        ):
+            batch = boxes[first : first + self.batch_size].tolist()
+            self._position += 1
+            yield [BoundingBox(*box) for box in batch]
+
+    def state_dict(self, position=None) -> dict:
+        """
+        Return the state needed to resume iteration at the next unseen batch.
+
+        Args:
+            position: number of batches of the current epoch already consumed,
+                defaults to the number yielded. A DataLoader with workers
+                fetches batches ahead of the training loop, so pass the count
+                the loop has consumed.
+
+        Returns:
+            dict: generator state the epoch was drawn from and the position
+                within it
+        """
+        position = self._position if position is None else position
+        if self._epoch_state is None or position >= len(self):
+            # between epochs, the next one is drawn from the current state
+            return {
+                "generator": self.generator.get_state(),
+                "position": 0,
+                "length": len(self),
+            }
+        return {
+            "generator": self._epoch_state.clone(),
+            "position": position,
+            "length": len(self),
+        }
+
+    def load_state_dict(self, state: dict) -> None:
+        """
+        Restore a state returned by state_dict.
+
+        Args:
+            state: state of a sampler over the same hits and length
+        """
+        if state["length"] != len(self):
+            raise ValueError(
+                f"Sampler state is for {state['length']} batches per epoch, "
+                f"not {len(self)}"
+            )
+        self.generator.set_state(state["generator"])
+        self._epoch_state = None
+        self._position = 0
+        self._start = state["position"]
 
     def __len__(self):
         """
@@ -140,7 +511,7 @@ class BalancedRandomBatchGeoSampler(BatchGeoSampler):
         Returns:
             int: The length of the sampler.
         """
-        return self.length // self.batch_size
+        return self.length // self.batch_size // self.num_replicas
 
 
 class BalancedGridGeoSampler(GeoSampler):
@@ -163,6 +534,18 @@ class BalancedGridGeoSampler(GeoSampler):
                 - stride: distance to skip between each patch
                 - roi: region of interest to sample from
                 - units: defines if size and stride are in pixel or CRS units
+                - max_overlap: fraction of a window's area it may share with
+                  an earlier window before it is dropped, defaults to 1.0
+                - num_replicas: number of ranks sharing the windows
+                - rank: rank of this sampler
+
+        Windows are snapped to a grid of the stride anchored at the region of
+        interest, so tiles of neighbouring or overlapping hits coincide, and
+        duplicates are dropped. With several replicas, each rank takes a
+        contiguous block of the windows, with sizes differing by at most one.
+        Ranks with the smaller block repeat the first windows so every rank
+        yields len(self); the number of windows that are not padding is
+        num_windows.
         """
         super().__init__(config["dataset"], config.get("roi"))
         self.size = _to_tuple(config["size"])
@@ -172,142 +555,222 @@ class BalancedGridGeoSampler(GeoSampler):
             self.size = (self.size[0] * self.res, self.size[1] * self.res)
             self.stride = (self.stride[0] * self.res, self.stride[1] * self.res)
 
-        self.hits, self.length = self.calculate_hits_and_length()
+        self.max_overlap = config.get("max_overlap", 1.0)
+        self.hits, _ = self.calculate_hits_and_length()
+        windows, tiled = self.tile_hits(self.hits)
+        self.windows = self.deduplicate(self.snap(windows, self.hits[tiled]))
+        self.length = len(self.windows)
+        self.num_replicas, self.rank = get_shard(config)
+        self.shard_start = self.length * self.rank // self.num_replicas
+        self.shard_stop = self.length * (self.rank + 1) // self.num_replicas
+        # windows yielded by the current iteration, and the window the next
+        # iteration starts at
+        self._position = 0
+        self._start = 0
 
     def calculate_hits_and_length(self):
         """
         Calculate hits and total length for the dataset.
 
         Returns:
-            hits: List of hits within the region of interest.
+            hits: HIT_DTYPE array of the hits within the region of interest,
+                with the rows and columns of windows tiling each hit.
             length: Total number of samples.
         """
-        hits = []
-        total_length = 0
-        context_x = self.size[1] / 2
-        context_y = self.size[0] / 2
-
-        for hit in self.index.intersection(tuple(self.roi), objects=True):
-            bounds = BoundingBox(*hit.bounds)
-            hit_bounds, rows, cols = self.get_hit_bounds_and_dimensions(
-                bounds, context_x, context_y
-            )
-
-            if rows > 0 and cols > 0:
-                hit.bounds = hit_bounds
-                hits.append(hit)
-                total_length += rows * cols
-
-        return hits, total_length
+        # hits narrower than a window get no windows
+        bounds = index_bounds(self.index, self.roi)
+        bounds = bounds[
+            (bounds[:, 1] - bounds[:, 0] >= self.size[1])
+            & (bounds[:, 3] - bounds[:, 2] >= self.size[0])
+        ]
+        rows = np.ceil(
+            (bounds[:, 3] - bounds[:, 2] - self.size[0]) / self.stride[0]
+        )
+        cols = np.ceil(
+            (bounds[:, 1] - bounds[:, 0] - self.size[1]) / self.stride[1]
+        )
+        area = (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2])
+        hits = make_hits(bounds, area, rows + 1, cols + 1)
+        return hits, int(np.sum(hits["rows"] * hits["cols"]))
 
-    def get_hit_bounds_and_dimensions(self, bounds, context_x, context_y):
+    def tile_hits(self, hits) -> np.ndarray:
         """
-        Get adjusted hit bounds and calculate dimensions.
+        Tile each hit with windows, row by row from its minimum corner.
 
         Args:
-            bounds: Original bounding box bounds.
-            context_x: Context size in x direction.
-            context_y: Context size in y direction.
+            hits: HIT_DTYPE array with the rows and columns tiling each hit
 
         Returns:
-            tuple: Adjusted bounding box, number of rows, number of columns.
+            tuple: (N, 6) array of (minx, maxx, miny, maxy, mint, maxt)
+                windows in the order of the hits, and the index of the hit
+                each window tiles
         """
-        minx, maxx = bounds.minx, bounds.maxx
-        miny, maxy = bounds.miny, bounds.maxy
-        mint, maxt = bounds.mint, bounds.maxt
-
-        cols = self.calculate_dimension(
-            (minx, maxx), self.size[1], self.stride[1], context_x
-        )
-        rows = self.calculate_dimension(
-            (miny, maxy), self.size[0], self.stride[0], context_y
+        counts = hits["rows"] * hits["cols"]
+        hit = np.repeat(np.arange(len(hits)), counts)
+        cell = np.arange(len(hit)) - np.repeat(
+            np.cumsum(counts) - counts, counts
         )
+        row, col = np.divmod(cell, hits["cols"][hit])
+
+        windows = np.empty((len(hit), 6), dtype=np.float64)
+        windows[:, 0] = hits["minx"][hit] + col * self.stride[1]
+        windows[:, 1] = windows[:, 0] + self.size[1]
+        windows[:, 2] = hits["miny"][hit] + row * self.stride[0]
+        windows[:, 3] = windows[:, 2] + self.size[0]
+        windows[:, 4] = hits["mint"][hit]
+        windows[:, 5] = hits["maxt"][hit]
+        return windows, hit
+
+    def snap(self, windows, hits) -> np.ndarray:
+        """
+        Move windows to the nearest point of the stride grid.
 
-        if cols == 0 or rows == 0:
-            return bounds, 0, 0
+        A window that would move past the end of its hit moves back instead,
+        so it still intersects the hit and can be read.
 
-        return BoundingBox(minx, maxx, miny, maxy, mint, maxt), rows, cols
+        Args:
+            windows: (N, 6) array of (minx, maxx, miny, maxy, mint, maxt)
+            hits: HIT_DTYPE array of the hit each window tiles
 
-    def calculate_dimension(self, interval, size, stride, context):
+        Returns:
+            np.ndarray: the snapped windows
         """
-        Calculate the dimension for sampling.
+        snapped = windows.copy()
+        for lo, hi, origin, stride, size in (
+            (0, 1, self.roi.minx, self.stride[1], self.size[1]),
+            (2, 3, self.roi.miny, self.stride[0], self.size[0]),
+        ):
+            steps = np.round((windows[:, lo] - origin) / stride)
+            past = origin + steps * stride >= hits[BOUNDS_FIELDS[hi]]
+            steps[past] -= 1
+            snapped[:, lo] = origin + steps * stride
+            snapped[:, hi] = snapped[:, lo] + size
+        return snapped
+
+    def deduplicate(self, windows) -> np.ndarray:
+        """
+        Drop repeated windows and windows overlapping earlier ones too much.
+
+        Windows must be snapped to the stride grid. A window is dropped when
+        it is a repeat, or when the share of its area it has in common with
+        an earlier window kept is more than max_overlap.
 
         Args:
-            interval: Minimum and maximum values of the dimension.
-            size: Size of the patch.
-            stride: Stride between patches.
-            context: Context size to be subtracted.
+            windows: (N, 6) array of snapped windows
 
         Returns:
-            int: Number of patches in the dimension.
-        """
-        min_val, max_val = interval
-        diff = max_val - min_val
-        if diff >= size * 2:
-            max_val -= context
-            min_val += context
-            return math.ceil((diff - size) / stride) + 1
-        if diff >= size:
-            extra_context = (diff - size) / 2
-            max_val -= extra_context
-            min_val = max_val - size
-            return 1
-        return 0
+            np.ndarray: the windows kept, in their original order
+        """
+        # integer grid cells, so repeats compare exactly
+        cells = np.empty((len(windows), 4), dtype=np.int64)
+        cells[:, 0] = np.round((windows[:, 0] - self.roi.minx) / self.stride[1])
+        cells[:, 1] = np.round((windows[:, 2] - self.roi.miny) / self.stride[0])
+        cells[:, 2:] = windows[:, 4:].view(np.int64)
+        _, first = np.unique(cells, axis=0, return_index=True)
+        first.sort()
+        windows, cells = windows[first], cells[first]
+
+        # grid offsets at which two windows overlap by more than max_overlap
+        reach_y = math.ceil(self.size[0] / self.stride[0])
+        reach_x = math.ceil(self.size[1] / self.stride[1])
+        neighbours = [
+            (dx, dy)
+            for dy in range(-reach_y, reach_y + 1)
+            for dx in range(-reach_x, reach_x + 1)
+            if (dx, dy) != (0, 0)
+            and max(self.size[1] - abs(dx) * self.stride[1], 0)
+            * max(self.size[0] - abs(dy) * self.stride[0], 0)
+            > self.max_overlap * self.size[0] * self.size[1]
+        ]
+        if not neighbours:
+            return windows
+
+        kept = set()
+        keep = np.zeros(len(cells), dtype=bool)
+        for i, (x, y, mint, maxt) in enumerate(cells.tolist()):
+            if not any(
+                (x + dx, y + dy, mint, maxt) in kept for dx, dy in neighbours
+            ):
+                kept.add((x, y, mint, maxt))
+                keep[i] = True
+        return windows[keep]
 
     def __iter__(self):
         """
         Return the index of a dataset.
 
+        After load_state_dict, iteration starts at the first unseen window.
+
         Yields:
             (minx, maxx, miny, maxy, mint, maxt) coordinates to index a dataset
         """
-        for hit in self.hits:
-            bounds = BoundingBox(*hit.bounds)
-            mint, maxt = bounds.mint, bounds.maxt
-            rows, cols = tile_to_chips(bounds, self.size, self.stride)
-
-            for i in range(rows):
-                miny, maxy = self.get_min_max(
-                    (bounds.miny, bounds.maxy),
-                    (i, rows),
-                    self.size[0],
-                    self.stride[0],
-                )
-                for j in range(cols):
-                    minx, maxx = self.get_min_max(
-                        (bounds.minx, bounds.maxx),
-                        (j, cols),
-                        self.size[1],
-                        self.stride[1],
-                    )
-                    yield BoundingBox(minx, maxx, miny, maxy, mint, maxt)
-
-    def get_min_max(self, interval, indices, size, stride):
-        """
-        Get the min and max values for a given dimension.
+        start, self._start = self._start, 0
+        self._position = start
+        padding_start = max(start - self.num_windows, 0)
+        start = min(self.shard_start + start, self.shard_stop)
+        for bounds in itertools.chain(
+            self.iter_windows(start, self.shard_stop),
+            self.iter_windows(padding_start, len(self) - self.num_windows),
+        ):
+            self._position += 1
+            yield bounds
+
+    @property
+    def num_windows(self) -> int:
+        """Number of windows of this rank that are not padding."""
+        return self.shard_stop - self.shard_start
+
+    def iter_windows(self, start, stop):
+        """
+        Generate the windows of the whole grid in a range of positions.
 
         Args:
-            interval: Minimum and maximum values of the dimension.
-            indices: Current index and maximum index.
-            size: Size of the patch.
-            stride: Stride between patches.
+            start: position of the first window
+            stop: position after the last window
+
+        Yields:
+            (minx, maxx, miny, maxy, mint, maxt) coordinates to index a dataset
+        """
+        for window in self.windows[start:stop].tolist():
+            yield BoundingBox(*window)
+
+    def state_dict(self, position=None) -> dict:
+        """
+        Return the state needed to resume iteration at the next unseen window.
+
+        Args:
+            position: number of windows already consumed, defaults to the
+                number yielded by the current iteration
 
         Returns:
-            tuple: (min_val, max_val) adjusted for the current index.
+            dict: position within the windows
+        """
+        position = self._position if position is None else position
+        return {
+            "position": position if position < len(self) else 0,
+            "length": len(self),
+        }
+
+    def load_state_dict(self, state: dict) -> None:
         """
-        min_val, max_val = interval
-        idx, max_idx = indices
-        min_val = min_val + idx * stride
-        max_val = min_val + size
-        if idx == max_idx - 1:
-            min_val = max_val - size
-        return min_val, max_val
+        Restore a state returned by state_dict.
+
+        Args:
+            state: state of a sampler over the same windows
+        """
+        if state["length"] != len(self):
+            raise ValueError(
+                f"Sampler state is for {state['length']} windows, "
+                f"not {len(self)}"
+            )
+        self._position = 0
+        self._start = state["position"]
 
     def __len__(self):
         """
-        Return the number of samples over the ROI.
+        Return the number of samples over the ROI drawn by this rank.
 
         Returns:
             int: Number of patches that will be sampled.
         """
-        return self.length
+        return -(-self.length // self.num_replicas)
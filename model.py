@@ -21,7 +21,8 @@ Classes:
     SegmentationModel: A class for configuring and using segmentation models.
 
 Functions:
-    None
+    fold_input_channels: Sums the first convolution weights of input channels
+    that copy another channel into the weights of that channel.
 
 Exceptions:
     None
@@ -31,6 +32,7 @@ import importlib
 import os
 
 import segmentation_models_pytorch as smp
+import torch
 from torchgeo.models import FCN, get_weight
 from torchgeo.trainers import utils
 from torchvision.models._api import WeightsEnum
@@ -76,6 +78,17 @@ class SegmentationModel:
                 - "weights": Union[str, bool], The weights to use for the model.
                 If True, uses imagenet weights. Can also accept a string path
                 to a weights file, or a WeightsEnum with pretrained weights.
+                - "in_channels": int, optional, The number of input channels
+                of the network. Defaults to 5, or more if the weights or the
+                images take more.
+                - "bands": int, optional, The number of bands of the images.
+                If fewer than in_channels, the other channels are copies of
+                band 0.
+                - "fold_bands": bool, optional, Whether to fold the first
+                convolution weights of the copies of band 0 into those of
+                band 0, so the model takes the bands themselves. Defaults to
+                False. A folded model's state dict has a narrower first
+                convolution and does not load into an unfolded model.
 
         Returns
         -------
@@ -88,6 +101,10 @@ class SegmentationModel:
         self.in_channels = model_config.get("in_channels")
         if self.in_channels is None:
             self.in_channels = 5
+        # images with more bands, such as NAIP and DEM, widen the network
+        bands = model_config.get("bands")
+        if bands is not None:
+            self.in_channels = max(self.in_channels, bands)
         if model != "fcn":
             state_dict = None
             # set custom weights
@@ -153,6 +170,13 @@ class SegmentationModel:
                 )
             if self.weights and self.weights is not True:
                 self.model.encoder.load_state_dict(state_dict)
+            if (
+                model_config.get("fold_bands", False)
+                and bands is not None
+                and bands < self.in_channels
+            ):
+                fold_input_channels(self.model, self.in_channels, bands)
+                self.in_channels = bands
             self.model.in_channels = self.in_channels
 
     def __getbackbone__(self):
@@ -166,3 +190,53 @@ class SegmentationModel:
         returns the weights of the model
         """
         return self.weights
+
+
+def fold_input_channels(model, in_channels, bands, source_channel=0):
+    """
+    Fold the input channels that copy a band into the first convolution.
+
+    A network taking in_channels channels, of which those from index bands on
+    are copies of source_channel, computes the same first convolution from
+    the bands alone once the weights of the copies are added to those of the
+    source channel. Outputs then match up to floating point rounding, without
+    moving or convolving the copies.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The network, modified in place.
+    in_channels : int
+        The number of input channels of the network.
+    bands : int
+        The number of channels kept.
+    source_channel : int
+        The band the other channels copy.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    ValueError
+        If the network has no convolution taking in_channels channels.
+    """
+    for module in model.modules():
+        if (
+            isinstance(module, torch.nn.Conv2d)
+            and module.in_channels == in_channels
+        ):
+            break
+    else:
+        raise ValueError(
+            f"Model has no convolution with {in_channels} input channels."
+        )
+    if module.groups != 1:
+        raise ValueError("Cannot fold the inputs of a grouped convolution.")
+
+    with torch.no_grad():
+        weight = module.weight[:, :bands].clone()
+        weight[:, source_channel] += module.weight[:, bands:].sum(dim=1)
+    module.weight = torch.nn.Parameter(weight)
+    module.in_channels = bands
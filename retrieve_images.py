@@ -1,12 +1,20 @@
 """
 To run: from repo directory (2024-winter-cmap)
 > python retrieve_images.py configs.config --action all
+
+The downloaded tiles can be converted to Cloud Optimized GeoTIFFs on their own:
+> python retrieve_images.py configs.config --action cog
+
+and mosaicked into the single VRT set as KC_IMAGE_VRT:
+> python retrieve_images.py configs.config --action vrt
 """
 
 import argparse
 import importlib.util
 import os
 
+from data.naip import build_naip_vrt
+from utils.cog import convert_dir_to_cog
 from utils.get_naip_images import get_images, get_river_images
 
 
@@ -42,6 +50,40 @@ def get_kane_county_river_images(config) -> None:
     get_river_images("image", data_fpath, save_dir)
 
 
+def convert_kane_county_images_to_cog(config) -> None:
+    """
+    Rewrites the downloaded NAIP images as Cloud Optimized GeoTIFFs tiled to
+    NAIP_COG_BLOCK_SIZE, verifying that the pixels are unchanged and reporting
+    the bytes read per chip before and after.
+
+    Args:
+        config: the configuration settings
+    """
+    for img_dir in (config.KC_IMAGE_ROOT, config.KC_RIVER_ROOT):
+        if os.path.isdir(img_dir):
+            convert_dir_to_cog(
+                img_dir,
+                config.NAIP_COG_BLOCK_SIZE,
+                config.NAIP_COG_COMPRESS,
+                config.NAIP_COG_LEVEL,
+            )
+
+
+def build_kane_county_image_vrt(config) -> None:
+    """
+    Writes a single VRT mosaic over the downloaded NAIP images to KC_IMAGE_VRT,
+    so training can read chips from it with one windowed read each.
+
+    Args:
+        config: the configuration settings
+    """
+    if config.KC_IMAGE_VRT is None:
+        print("KC_IMAGE_VRT is not set, skipping the NAIP mosaic")
+        return
+    count = build_naip_vrt(config.KC_IMAGE_ROOT, config.KC_IMAGE_VRT)
+    print(f"Wrote a mosaic of {count} NAIP images to {config.KC_IMAGE_VRT}")
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
@@ -54,7 +96,7 @@ if __name__ == "__main__":
         "--action",
         type=str,
         default="all",
-        choices=["all", "images", "river"],
+        choices=["all", "images", "river", "cog", "vrt"],
         help="Specify the action to perform",
     )
     args = parser.parse_args()
@@ -64,9 +106,17 @@ if __name__ == "__main__":
     if args.action == "all":
         get_kane_county_images(configs)
         get_kane_county_river_images(configs)
+        convert_kane_county_images_to_cog(configs)
+        build_kane_county_image_vrt(configs)
 
     elif args.action == "images":
         get_kane_county_images(configs)
 
     elif args.action == "river":
         get_kane_county_river_images(configs)
+
+    elif args.action == "cog":
+        convert_kane_county_images_to_cog(configs)
+
+    elif args.action == "vrt":
+        build_kane_county_image_vrt(configs)
@@ -19,3 +19,7 @@ export PATH="/home/YOUR_USERNAME/miniconda/bin:$PATH"
 cd /home/YOUR_USERNAME/2024-winter-cmap
 
 python train.py configs.config --experiment_name <ExperimentName> --aug_type <aug> --split <split> --num_trial <num_trial>
+
+# To train on several GPUs, request them with --gres=gpu:<num> and start one
+# rank per GPU with torchrun; set RESUME_CHECKPOINT with {rank} to resume:
+# torchrun --standalone --nproc_per_node=<num> train.py configs.config --experiment_name <ExperimentName> --split <split> --num_trial <num_trial>
@@ -6,6 +6,7 @@ To run: from repo directory (2024-winter-cmap)
 
 import argparse
 import datetime
+import functools
 import importlib.util
 import logging
 import os
@@ -16,22 +17,45 @@ from pathlib import Path
 from statistics import mean, stdev
 from typing import Any, DefaultDict, Tuple
 
-import kornia.augmentation as K
 import torch
+import torch.distributed as dist
 import wandb
 from torch.nn.modules import Module
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import AdamW
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
 from torch.utils.tensorboard import SummaryWriter
-from torchgeo.datasets import NAIP, random_bbox_assignment, stack_samples
+from torchgeo.datasets import (
+    IntersectionDataset,
+    random_bbox_assignment,
+    stack_samples,
+)
 from torchmetrics.classification import MulticlassJaccardIndex
 
+from data.augment import TransformedDataset
+from data.batch import KaneCountyBatchDataset
+from data.cache import ChipCache
+from data.chips import ChipShardDataset
 from data.dem import KaneDEM
+from data.handles import PooledNAIP, configure_gdal
 from data.kc import KaneCounty
-from data.sampler import BalancedGridGeoSampler, BalancedRandomBatchGeoSampler
+from data.naip import NAIPMosaic
+from data.prefetch import DevicePrefetcher
+from data.sampler import (
+    BalancedGridGeoSampler,
+    BalancedRandomBatchGeoSampler,
+    get_shard,
+    rank_generator,
+)
 from model import SegmentationModel
+from utils.checkpoint import load_checkpoint, save_checkpoint, training_sampler
 from utils.plot import find_labels_in_ground_truth, plot_from_tensors
-from utils.transforms import apply_augs, create_augmentation_pipelines
+from utils.transforms import (
+    AugmentationEngine,
+    InputTransform,
+    SampleAugmentation,
+    create_augmentation_pipelines,
+)
 
 MODEL_DEVICE = (
     "cuda"
@@ -40,6 +64,34 @@ MODEL_DEVICE = (
 )
 
 
+def init_distributed():
+    """
+    Join the process group of the ranks started by torchrun, if any.
+
+    torchrun sets WORLD_SIZE, RANK and LOCAL_RANK in the environment of each
+    rank; each rank then trains on its own GPU, or on the CPU with gloo.
+
+    Returns:
+        str: The device this rank trains on.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) == 1:
+        return MODEL_DEVICE
+    if torch.cuda.is_available():
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group("nccl")
+        return f"cuda:{local_rank}"
+    dist.init_process_group("gloo")
+    return "cpu"
+
+
+def is_main_process():
+    """
+    Return whether this process writes the outputs shared by all ranks.
+    """
+    return get_shard({})[1] == 0
+
+
 def arg_parsing(argument):
     """
     Parsing arguments passed in from command line
@@ -66,36 +118,46 @@ def writer_prep(exp_n, trial_num, wandb_t):
     # set output path and exit run if path already exists
     exp_trial_name = f"{exp_n}_trial{trial_num}"
     out_root = os.path.join(config.OUTPUT_ROOT, exp_trial_name)
-    if wandb_t:
-        os.makedirs(out_root, exist_ok=True)
-    else:
-        os.makedirs(out_root, exist_ok=False)
 
     # create directory for output images
     train_images_root = os.path.join(out_root, "train-images")
     test_images_root = os.path.join(out_root, "test-images")
 
-    try:
-        os.mkdir(train_images_root)
-        os.mkdir(test_images_root)
-
-    except FileExistsError:
-        shutil.rmtree(train_images_root)
-        shutil.rmtree(test_images_root)
-        os.mkdir(train_images_root)
-        os.mkdir(test_images_root)
-
-    # open tensorboard writer
-    writer = SummaryWriter(out_root)
-
-    # copy training script and config to output directory
-    shutil.copy(Path(__file__).resolve(), out_root)
-    shutil.copy(Path(config.__file__).resolve(), out_root)
+    # the first rank prepares the output directory the others write to
+    if is_main_process():
+        if wandb_t:
+            os.makedirs(out_root, exist_ok=True)
+        else:
+            os.makedirs(out_root, exist_ok=False)
+
+        try:
+            os.mkdir(train_images_root)
+            os.mkdir(test_images_root)
+
+        except FileExistsError:
+            shutil.rmtree(train_images_root)
+            shutil.rmtree(test_images_root)
+            os.mkdir(train_images_root)
+            os.mkdir(test_images_root)
+
+        # copy training script and config to output directory
+        shutil.copy(Path(__file__).resolve(), out_root)
+        shutil.copy(Path(config.__file__).resolve(), out_root)
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+    # open tensorboard writer; other ranks log apart from the first one
+    num_replicas, rank = get_shard({})
+    writer_root = out_root
+    log_filename = os.path.join(out_root, "training_log.txt")
+    if rank > 0:
+        writer_root = os.path.join(out_root, f"rank-{rank}")
+        log_filename = os.path.join(out_root, f"training_log-{rank}.txt")
+    writer = SummaryWriter(writer_root)
 
     # Set up logging
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
-    log_filename = os.path.join(out_root, "training_log.txt")
     file_handler = logging.FileHandler(log_filename)
     stream_handler = logging.StreamHandler(sys.stdout)
 
@@ -126,7 +188,14 @@ def initialize_dataset():
             The first element is the NAIP dataset, and the
             second element is the KaneCounty dataset.
     """
-    naip_dataset = NAIP(config.KC_IMAGE_ROOT)
+    if config.KC_IMAGE_VRT is not None:
+        naip_dataset = NAIPMosaic(
+            config.KC_IMAGE_VRT, max_open_handles=config.MAX_OPEN_HANDLES
+        )
+    else:
+        naip_dataset = PooledNAIP(
+            config.KC_IMAGE_ROOT, max_open_handles=config.MAX_OPEN_HANDLES
+        )
 
     shape_path = os.path.join(config.KC_SHAPE_ROOT, config.KC_SHAPE_FILENAME)
     dataset_config = (
@@ -136,23 +205,79 @@ def initialize_dataset():
         naip_dataset.crs,
         naip_dataset.res,
     )
-    kc_dataset = KaneCounty(shape_path, dataset_config)
+    kc_dataset = KaneCounty(
+        shape_path,
+        dataset_config,
+        label_cache_root=config.KC_LABEL_CACHE_ROOT,
+        shape_cache_root=config.KC_SHAPE_CACHE_ROOT,
+    )
 
     if config.KC_DEM_ROOT is not None:
-        dem = KaneDEM(config.KC_DEM_ROOT)
+        aligned = config.KC_DEM_ALIGNED_ROOT is not None
+        if config.KC_DEM_DERIVATIVES_ROOT is not None:
+            dem = KaneDEM(
+                config.KC_DEM_DERIVATIVES_ROOT,
+                aligned=aligned,
+                derivatives=True,
+                bands=config.KC_DEM_BANDS,
+            )
+        elif aligned:
+            dem = KaneDEM(config.KC_DEM_ALIGNED_ROOT, aligned=True)
+        else:
+            dem = KaneDEM(config.KC_DEM_ROOT)
         naip_dataset = naip_dataset & dem
         print("naip and dem loaded")
 
     return naip_dataset, kc_dataset
 
 
-def build_dataset(naip_set, split_rate):
+def count_bands(dataset):
+    """
+    Count the bands of the images of a raster dataset or intersection.
+
+    Raster datasets return their bands as "image", which an intersection
+    concatenates, so the count matches the channels of sample["image"].
+
+    Args:
+        dataset: the NAIP dataset, possibly intersected with the DEM
+
+    Returns:
+        int: The number of image bands of a sample.
+    """
+    if isinstance(dataset, IntersectionDataset):
+        return sum(count_bands(member) for member in dataset.datasets)
+    return len(dataset.bands)
+
+
+def build_dataset(naip_set, split_rate, augment=None, seed=None):
     """
     Randomly split and load data to be the test and train sets
-    Returns train dataloader and test dataloader
+    Returns train dataloader, test dataloader and the split seed
+
+    If an AugmentationEngine is given, the DataLoader workers apply it to
+    each training sample. A seed, such as the one of a checkpoint, repeats
+    the split and the training epochs drawn from it.
     """
+    # the chip store was exported from a fixed split, reuse it for testing
+    chip_store = None
+    if seed is None:
+        seed = random.randint(0, sys.maxsize)
+    if config.CHIP_STORE_ROOT is not None:
+        chip_store = ChipShardDataset(config.CHIP_STORE_ROOT, config.PATCH_SIZE)
+        if chip_store.split_rate != split_rate:
+            raise ValueError(
+                f"Chip store was exported with split {chip_store.split_rate}, "
+                f"not {split_rate}"
+            )
+        seed = chip_store.split_seed
+
+    # every rank must split the data and seed its sampler alike
+    if dist.is_available() and dist.is_initialized():
+        seeds = [seed]
+        dist.broadcast_object_list(seeds, src=0)
+        seed = seeds[0]
+
     # record generator seed
-    seed = random.randint(0, sys.maxsize)
     logging.info("Dataset random split seed: %d", seed)
     generator = torch.Generator().manual_seed(seed)
 
@@ -160,6 +285,8 @@ def build_dataset(naip_set, split_rate):
     train_portion, test_portion = random_bbox_assignment(
         naip_set, [split_rate, 1 - split_rate], generator
     )
+    if chip_store is not None:
+        chip_store.check_split(train_portion, test_portion)
     train_dataset = train_portion & kc
     test_dataset = test_portion & kc
 
@@ -168,6 +295,12 @@ def build_dataset(naip_set, split_rate):
             "dataset": train_dataset,
             "size": config.PATCH_SIZE,
             "batch_size": config.BATCH_SIZE,
+            # draw the epochs from the logged seed so they can be replayed
+            "generator": torch.Generator().manual_seed(seed),
+            "locality": config.SAMPLER_LOCALITY,
+            "locality_batches": config.SAMPLER_LOCALITY_BATCHES,
+            # boxes on the label mosaic grid are sliced from it
+            "snap": config.KC_LABEL_CACHE_ROOT is not None,
         }
     )
     test_sampler = BalancedGridGeoSampler(
@@ -175,24 +308,96 @@ def build_dataset(naip_set, split_rate):
             "dataset": test_dataset,
             "size": config.PATCH_SIZE,
             "stride": config.PATCH_SIZE,
+            "max_overlap": config.TEST_MAX_OVERLAP,
         }
     )
 
+    # rasterize the masks of each training batch in one call
+    if config.KC_BATCH_MASKS:
+        train_dataset = KaneCountyBatchDataset(train_dataset)
+
+    # serve random crops of the exported chips, keeping the epoch length
+    if chip_store is not None:
+        if config.KC_BATCH_MASKS:
+            logging.warning(
+                "KC_BATCH_MASKS is ignored, the chip store holds the masks"
+            )
+        if config.CHECKPOINT_BATCHES:
+            logging.warning(
+                "The chip store sampler cannot resume within an epoch, "
+                "checkpoints are written after whole epochs only"
+            )
+        train_dataset = chip_store
+        train_sampler = BatchSampler(
+            RandomSampler(
+                chip_store, replacement=True, num_samples=chip_store.length
+            ),
+            config.BATCH_SIZE,
+            drop_last=True,
+        )
+
+    # augment each sample in the workers rather than the batch on the device
+    if augment is not None:
+        train_dataset = TransformedDataset(
+            train_dataset, SampleAugmentation(augment)
+        )
+
+    # GDAL settings apply per process, so set them in every worker
+    gdal_options = {
+        "GDAL_CACHEMAX": config.GDAL_CACHEMAX,
+        "GDAL_NUM_THREADS": config.GDAL_NUM_THREADS,
+        "VSI_CACHE": config.VSI_CACHE,
+    }
+    worker_init_fn = functools.partial(configure_gdal, options=gdal_options)
+    if config.NUM_WORKERS == 0:
+        configure_gdal(0, gdal_options)
+
+    # pinned batches can be copied to a CUDA device asynchronously
+    pin_memory = (
+        config.DEVICE_PREFETCH and torch.device(MODEL_DEVICE).type == "cuda"
+    )
+
+    # the workers are seeded from the logged seed, apart on every rank
+    worker_generator = rank_generator(
+        torch.Generator().manual_seed(seed), *get_shard({})
+    )
+
     # create dataloaders (must use batch_sampler)
     train_dataloader = DataLoader(
         dataset=train_dataset,
         batch_sampler=train_sampler,
         collate_fn=stack_samples,
         num_workers=config.NUM_WORKERS,
+        worker_init_fn=worker_init_fn,
+        pin_memory=pin_memory,
+        generator=worker_generator,
     )
+
+    # cache the deterministic test windows; workers must persist to keep it
+    persistent_workers = False
+    if config.TEST_CHIP_CACHE_BYTES:
+        test_dataset = ChipCache(
+            test_dataset,
+            config.TEST_CHIP_CACHE_BYTES,
+            config.TEST_CHIP_CACHE_SPILL_ROOT,
+        )
+        persistent_workers = config.NUM_WORKERS > 0
+
     test_dataloader = DataLoader(
         dataset=test_dataset,
         batch_size=config.BATCH_SIZE,
         sampler=test_sampler,
         collate_fn=stack_samples,
         num_workers=config.NUM_WORKERS,
+        worker_init_fn=worker_init_fn,
+        persistent_workers=persistent_workers,
+        pin_memory=pin_memory,
     )
-    return train_dataloader, test_dataloader
+
+    if config.DEVICE_PREFETCH:
+        train_dataloader = DevicePrefetcher(train_dataloader, MODEL_DEVICE)
+        test_dataloader = DevicePrefetcher(test_dataloader, MODEL_DEVICE)
+    return train_dataloader, test_dataloader, seed
 
 
 def regularization_loss(model, reg_type, weight):
@@ -240,13 +445,20 @@ def compute_loss(model, mask, y, loss_fn, reg_config):
     return base_loss
 
 
-def create_model():
+def create_model(bands=None):
     """
     Setting up training model, loss function and measuring metrics
 
+    Args:
+        bands: number of bands of the images, if known; channels the model
+            takes beyond them copy band 0, or are folded into its first
+            convolution with FOLD_INPUT_CHANNELS, and images with another
+            number of bands are rejected
+
     Returns:
         tuple: A tuple containing:
             - model: The PyTorch model instance.
+            - input_transform: The InputTransform preparing the model input.
             - loss_fn: The loss function to use for training.
             - train_jaccard: The metric to measure Jaccard index on the training set.
             - test_jaccard: The metric to measure Jaccard index on the test set.
@@ -259,11 +471,26 @@ def create_model():
         "backbone": config.BACKBONE,
         "num_classes": config.NUM_CLASSES,
         "weights": config.WEIGHTS,
+        "bands": bands,
+        "fold_bands": config.FOLD_INPUT_CHANNELS,
     }
 
     model = SegmentationModel(model_configs).model.to(MODEL_DEVICE)
     logging.info(model)
 
+    # scaling, normalization and extra channels, precomputed for this model;
+    # kept apart from it so model.pth keeps the layout of SegmentationModel
+    input_transform = InputTransform(
+        config.DATASET_MEAN, config.DATASET_STD, model.in_channels, bands
+    ).to(MODEL_DEVICE)
+
+    # ranks started by torchrun average their gradients every step
+    if dist.is_available() and dist.is_initialized():
+        device_ids = None
+        if torch.device(MODEL_DEVICE).type == "cuda":
+            device_ids = [torch.device(MODEL_DEVICE).index]
+        model = DistributedDataParallel(model, device_ids=device_ids)
+
     # set the loss function, metrics, and optimizer
     loss_fn_class = getattr(
         importlib.import_module("segmentation_models_pytorch.losses"),
@@ -294,6 +521,7 @@ def create_model():
 
     return (
         model,
+        input_transform,
         loss_fn,
         train_jaccard,
         test_jaccard,
@@ -302,115 +530,12 @@ def create_model():
     )
 
 
-def copy_first_entry(a_list: list) -> list:
-    """
-    Copies the first entry in a list and appends it to the end.
-
-    Args:
-        a_list: The list to modify
-
-    Returns:
-        list: The modified list
-    """
-    first_entry = a_list[0]
-
-    # Append the copy to the end
-    a_list.append(first_entry)
-
-    return a_list
-
-
-def normalize_func(model):
-    """
-    Create normalization functions for input data to a given model.
-
-    This function generates normalization functions based on the mean
-    and standard deviation specified in the configuration. If the
-    number of channels in the model input does not match the length of
-    the mean and standard deviation lists, it replicates the first entry
-    of each list to match the number of input channels.
-
-    Args:
-        model: The model for which the normalization functions are created.
-
-    Returns:
-        tuple: A tuple containing two normalization functions.
-               The first function normalizes input data using the specified
-               mean and standard deviation.
-               The second function scales input data to a range between 0 and 255.
-    """
-    data_mean = config.DATASET_MEAN
-    data_std = config.DATASET_STD
-    # add copies of first entry to DATASET_MEAN and DATASET_STD
-    # to match data in_channels
-    if len(data_mean) != model.in_channels:
-        for _ in range(model.in_channels - len(data_mean)):
-            data_mean = copy_first_entry(data_mean)
-            data_std = copy_first_entry(data_std)
-
-    scale_mean = torch.tensor(0.0)
-    scale_std = torch.tensor(255.0)
-    normalize = K.Normalize(mean=data_mean, std=data_std)
-    scale = K.Normalize(mean=scale_mean, std=scale_std)
-    return normalize, scale
-
-
-def add_extra_channel(
-    image_tensor: torch.Tensor, source_channel: int = 0
-) -> torch.Tensor:
-    """
-    Adds an additional channel to an image by copying an existing channel.
-
-    Args:
-        image_tensor : A tensor containing image data. Expected shape is
-            (batch, channels, h, w)
-        source_channel : The index of the channel to be copied
-
-    Returns:
-        torch.Tensor: A modified tensor with added channels
-    """
-    # Select the source channel to duplicate
-    original_channel = image_tensor[
-        :, source_channel : source_channel + 1, :, :
-    ]
-
-    # Generate copy of selected channel
-    extra_channel = original_channel.clone()
-
-    # Concatenate the extra channel to the original image along the second
-    # dimension (channel dimension)
-    augmented_tensor = torch.cat((image_tensor, extra_channel), dim=1)
-
-    return augmented_tensor
-
-
-def normalize_and_scale(sample_image, model):
-    """
-    Normalize and scale the sample image.
-    """
-    normalize, scale = normalize_func(model)
-    scaled_image = scale(sample_image)
-    return scaled_image, normalize
-
-
-def add_extra_channels(image, model):
-    """
-    Add extra channels to the image if necessary.
-    """
-    while image.size(1) < model.in_channels:
-        image = add_extra_channel(image)
-    return image
-
-
-def apply_augmentations(
-    dataset, spatial_augs, color_augs, spatial_aug_mode, color_aug_mode
-):
+def apply_augmentations(dataset, augment):
     """
     Apply augmentations to the image and mask.
     """
     x_og, y_og = dataset
-    aug_config = (spatial_augs, color_augs, spatial_aug_mode, color_aug_mode)
-    x_aug, y_aug = apply_augs(aug_config, x_og, y_og)
+    x_aug, y_aug = augment(x_og, y_og)
     y_aug = y_aug.type(torch.int64)  # Convert mask to int64 for loss function
     y_squeezed = y_aug.squeeze()  # Remove channel dim from mask
     return x_aug, y_squeezed
@@ -421,6 +546,9 @@ def save_training_images(
 ):
     """
     Save training sample images.
+
+    If x and samp_mask are None, as when the DataLoader workers augmented the
+    samples, only the augmented image and mask are plotted.
     """
     save_dir = os.path.join(
         train_images_root,
@@ -428,13 +556,13 @@ def save_training_images(
     )
     os.makedirs(save_dir, exist_ok=True)
 
-    for i in range(config.BATCH_SIZE):
-        plot_tensors = {
-            "RGB Image": x[i].cpu(),
-            "Mask": samp_mask[i],
-            "Augmented_RGBImage": x_aug[i].cpu(),
-            "Augmented_Mask": y_aug[i].cpu(),
-        }
+    for i in range(len(x_aug)):
+        plot_tensors = {}
+        if x is not None:
+            plot_tensors["RGB Image"] = x[i].cpu()
+            plot_tensors["Mask"] = samp_mask[i].cpu()
+        plot_tensors["Augmented_RGBImage"] = x_aug[i].cpu()
+        plot_tensors["Augmented_Mask"] = y_aug[i].cpu()
         sample_fname = os.path.join(save_dir, f"train_sample-{epoch}.{i}.png")
         plot_from_tensors(
             plot_tensors,
@@ -448,8 +576,9 @@ def save_training_images(
 def train_setup(
     sample: DefaultDict[str, Any],
     train_config,
-    aug_config,
+    augment,
     model,
+    input_transform,
 ) -> Tuple[torch.Tensor]:
     """
     Sets up for the training step by sending images and masks to device,
@@ -461,59 +590,60 @@ def train_setup(
             - epoch: The current epoch.
             - batch: The current batch.
             - train_images_root: The root path for saving training sample images.
-        aug_config: a tuple of
-            - spatial_aug_mode: The mode for spatial augmentations.
-            - color_aug_mode: The mode for color augmentations.
-            - spatial_augs: The sequence of spatial augmentations.
-            - color_augs: The sequence of color augmentations.
+        augment: The AugmentationEngine applying spatial and color
+            augmentations, or None if the DataLoader workers applied them.
         model: The PyTorch model instance.
+        input_transform: The InputTransform preparing the model input.
 
     Returns:
         A tuple of augmented image and mask tensors to be used in the train step
     """
     epoch, batch, train_images_root = train_config
-    spatial_aug_mode, color_aug_mode, spatial_augs, color_augs = aug_config
 
     samp_image = sample["image"]
     samp_mask = sample["mask"]
 
-    # Add extra channels to image if necessary
-    samp_image = add_extra_channels(samp_image, model)
-
-    # Send image and mask to device; convert mask to float tensor for augmentation
+    # Send image and uint8 mask to device; widen mask to float for augmentation
     x = samp_image.to(MODEL_DEVICE)
-    y = samp_mask.type(torch.float32).to(MODEL_DEVICE)
+    y = samp_mask.to(MODEL_DEVICE).type(torch.float32)
 
-    # Normalize and scale image
-    x_scaled, normalize = normalize_and_scale(x, model)
+    if augment is None:
+        # the workers scaled and augmented the samples already
+        x_aug = input_transform.expand(x)
+        y_squeezed = y.type(torch.int64).squeeze()
+    else:
+        # Add extra channels and scale image; it is normalized once augmented
+        x_scaled = input_transform.scale(x)
 
-    img_data = (x_scaled, y)
-    # Apply augmentations
-    x_aug, y_squeezed = apply_augmentations(
-        img_data, spatial_augs, color_augs, spatial_aug_mode, color_aug_mode
-    )
+        img_data = (x_scaled, y)
+        # Apply augmentations
+        x_aug, y_squeezed = apply_augmentations(img_data, augment)
 
     # Save training sample images if first batch
-    if batch == 0:
+    if batch == 0 and is_main_process():
+        # the workers' samples hold no original to compare against
         save_training_images(
             epoch,
             train_images_root,
-            x,
-            samp_mask,
+            x if augment is not None else None,
+            samp_mask if augment is not None else None,
             x_aug,
             y_squeezed,
             sample,
         )
 
-    return normalize(x_aug), y_squeezed
+    return input_transform.normalize(x_aug), y_squeezed
 
 
 def train_epoch(
     dataloader,
     model,
+    input_transform,
     train_config,
-    aug_config,
+    augment,
     writer,
+    start=0,
+    checkpoint=None,
 ) -> None:
     """
     Executes a training step for the model
@@ -521,40 +651,37 @@ def train_epoch(
     Args:
         dataloader: The data loader containing the training data.
         model: The PyTorch model to be trained.
+        input_transform: The InputTransform preparing the model input.
         train_config: a tuple of
             - loss_fn: The loss function to be used for training.
             - jaccard: The metric to measure Jaccard index during training.
             - optimizer: The optimizer to be used for updating model parameters.
             - epoch: The current epoch number.
             - train_images_root: The root directory for saving training sample images.
-        aug_config: a tuple of
-            - spatial_augs: The sequence of spatial augmentations.
-            - color_augs: The sequence of color augmentations.
-            - spatial_aug_mode: The mode for spatial augmentations.
-            - color_aug_mode: The mode for color augmentations.
+        augment: The AugmentationEngine applying spatial and color
+            augmentations, or None if the DataLoader workers applied them.
         writer: The TensorBoard writer for logging training metrics.
+        start: The number of batches of the epoch already trained on before
+            a checkpoint was resumed.
+        checkpoint: A function saving a checkpoint given the number of
+            batches consumed, called every CHECKPOINT_BATCHES batches, or
+            None to save none.
     """
 
     loss_fn, jaccard, optimizer, epoch, train_images_root = train_config
-    spatial_augs, color_augs, spatial_aug_mode, color_aug_mode = aug_config
 
     num_batches = len(dataloader)
     model.train()
     jaccard.reset()
     train_loss = 0
-    for batch, sample in enumerate(dataloader):
+    for batch, sample in enumerate(dataloader, start):
         train_config = (epoch, batch, train_images_root)
-        aug_config = (
-            spatial_aug_mode,
-            color_aug_mode,
-            spatial_augs,
-            color_augs,
-        )
         x, y = train_setup(
             sample,
             train_config,
-            aug_config,
+            augment,
             model,
+            input_transform,
         )
 
         # compute prediction error
@@ -587,11 +714,23 @@ def train_epoch(
         if batch % 100 == 0:
             loss, current = loss.item(), (batch + 1)
             logging.info("loss: %7.7f  [%5d/%5d]", loss, current, num_batches)
-    train_loss /= num_batches
+
+        # the checkpoint after the last batch is saved once the epoch is done
+        if (
+            checkpoint is not None
+            and (batch + 1) % config.CHECKPOINT_BATCHES == 0
+            and batch + 1 < num_batches
+        ):
+            checkpoint(batch + 1)
+    train_loss /= num_batches - start
     final_jaccard = jaccard.compute()
 
     writer.add_scalar("loss/train", train_loss, epoch)
     writer.add_scalar("IoU/train", final_jaccard, epoch)
+    if isinstance(dataloader, DevicePrefetcher):
+        data_wait = dataloader.mean_wait * 1000
+        writer.add_scalar("data_wait_ms/train", data_wait, epoch)
+        logging.info("Train data wait: %.2f ms per step", data_wait)
     logging.info("Train Jaccard index: %.4f", final_jaccard)
     return final_jaccard
 
@@ -599,6 +738,7 @@ def train_epoch(
 def test(
     dataloader: DataLoader,
     model: Module,
+    input_transform: Module,
     test_config,
     writer,
 ) -> float:
@@ -608,6 +748,7 @@ def test(
     Args:
         dataloader: Dataloader for the testing data.
         model: A PyTorch model.
+        input_transform: The InputTransform preparing the model input.
         test_config: A tuple containing:
             - loss_fn: A PyTorch loss function.
             - jaccard: The metric to be used for evaluation, specifically the
@@ -638,19 +779,25 @@ def test(
     jaccard.reset()
     jaccard_per_class.reset()
     test_loss = 0
+    cache_hits = 0
+    cache_misses = 0
+    # a sharded grid sampler pads its rank with repeated windows; leave them
+    # out so the metrics synced across ranks match a single process
+    loader = getattr(dataloader, "dataloader", dataloader)
+    num_windows = getattr(loader.sampler, "num_windows", None)
+    seen = 0
     with torch.no_grad():
         for batch, sample in enumerate(dataloader):
+            hits = sample.get("cache_hit", [])
+            cache_hits += sum(hits)
+            cache_misses += len(hits) - sum(hits)
             samp_image = sample["image"]
             samp_mask = sample["mask"]
-            # add an extra channel to the images and masks
-            if samp_image.size(1) != model.in_channels:
-                for _ in range(model.in_channels - samp_image.size(1)):
-                    samp_image = add_extra_channel(samp_image)
-            x = samp_image.to(MODEL_DEVICE)
-            normalize, scale = normalize_func(model)
-            x_scaled = scale(x)
-            x = normalize(x_scaled)
-            y = samp_mask.to(MODEL_DEVICE)
+            # add extra channels, scale and normalize in one pass on device
+            x_raw = samp_image.to(MODEL_DEVICE)
+            x = input_transform(x_raw)
+            # masks stay uint8 until on device; the loss needs int64
+            y = samp_mask.to(MODEL_DEVICE).type(torch.int64)
             if y.size(0) == 1:
                 y_squeezed = y
             else:
@@ -658,6 +805,13 @@ def test(
 
             # compute prediction error
             outputs = model(x)
+            if num_windows is not None and seen + len(x) > num_windows:
+                keep = max(num_windows - seen, 0)
+                outputs, y_squeezed = outputs[:keep], y_squeezed[:keep]
+            seen += len(x)
+            if len(outputs) == 0:
+                num_batches -= 1
+                continue
             loss = loss_fn(outputs, y_squeezed)
 
             # update metric
@@ -671,19 +825,22 @@ def test(
             test_loss += loss.item()
 
             # plot first batch
-            if batch == 0 or (
-                plateau_count == config.PATIENCE - 1 and batch < 10
+            if is_main_process() and (
+                batch == 0
+                or (plateau_count == config.PATIENCE - 1 and batch < 10)
             ):
                 epoch_dir = os.path.join(test_image_root, f"epoch-{epoch}")
                 if not os.path.exists(epoch_dir):
                     os.mkdir(epoch_dir)
-                for i in range(config.BATCH_SIZE):
+                x_scaled = input_transform.scale(x_raw)
+                # the last batches hold fewer windows once padding is trimmed
+                for i in range(len(preds)):
                     plot_tensors = {
                         "RGB Image": x_scaled[i].cpu(),
-                        "ground_truth": samp_mask[i],
+                        "ground_truth": samp_mask[i].cpu(),
                         "prediction": preds[i].cpu(),
                     }
-                    ground_truth = samp_mask[i]
+                    ground_truth = samp_mask[i].cpu()
                     label_ids = find_labels_in_ground_truth(ground_truth)
 
                     for label_id in label_ids:
@@ -701,11 +858,25 @@ def test(
                             kc.labels_inverse,
                             sample["bbox"][i],
                         )
+    # every rank takes the plateau and early stopping decisions alike
+    if dist.is_available() and dist.is_initialized():
+        totals = torch.tensor(
+            [test_loss, num_batches], dtype=torch.float64, device=MODEL_DEVICE
+        )
+        dist.all_reduce(totals)
+        test_loss, num_batches = totals.tolist()
     test_loss /= num_batches
     final_jaccard = jaccard.compute()
     final_jaccard_per_class = jaccard_per_class.compute()
     writer.add_scalar("loss/test", test_loss, epoch)
     writer.add_scalar("IoU/test", final_jaccard, epoch)
+    if isinstance(dataloader, DevicePrefetcher):
+        data_wait = dataloader.mean_wait * 1000
+        writer.add_scalar("data_wait_ms/test", data_wait, epoch)
+        logging.info("Test data wait: %.2f ms per step", data_wait)
+    if cache_hits + cache_misses > 0:
+        writer.add_scalar("chip_cache/hits", cache_hits, epoch)
+        writer.add_scalar("chip_cache/misses", cache_misses, epoch)
     logging.info(
         "\nTest error: \n Jaccard index: %4f, \nTest avg loss: %4f \n",
         final_jaccard,
@@ -730,17 +901,20 @@ def test(
 
 def train(
     model: Module,
+    input_transform: Module,
     train_test_config,
-    aug_config,
+    augment,
     path_config: Tuple[str, str, str],
     writer: SummaryWriter,
     wandb_t,
+    progress,
 ) -> Tuple[float, float]:
     """
     Train a deep learning model using the specified configuration and parameters.
 
     Args:
         model: The deep learning model to be trained.
+        input_transform: The InputTransform preparing the model input.
         train_test_config: A tuple containing:
                 - train_dataloader: DataLoader for training dataset.
                 - train_jaccard: Function to calculate Jaccard index for training.
@@ -749,14 +923,18 @@ def train(
                 - loss_fn: Loss function used for training and testing.
                 - optimizer: Optimization algorithm used for training.
                 - jaccard_per_class: Function to calculate Jaccard index per class.
-        aug_config: A tuple containing:
-                - spatial_augs: Spatial augmentations applied during training.
-                - color_augs: Color augmentations applied during training.
+        augment: The AugmentationEngine applying spatial and color
+                augmentations during training, or None if the DataLoader
+                workers applied them.
         path_config: A tuple containing:
                 - out_root: Root directory for saving the trained model.
                 - train_images_root: Root directory for training images.
                 - test_image_root: Root directory for test images.
         writer: The writer object for logging training progress.
+        progress: A dictionary with the split seed, the epoch and batch to
+                start training at, the best test loss, the plateau count, the
+                train and test Jaccard indexes of the last epoch and whether
+                training stopped on a plateau, as recorded by a checkpoint.
 
     Returns:
         Tuple[float, float]: A tuple containing the Jaccard index for the last
@@ -776,10 +954,6 @@ def train(
         train_images_root,
         test_image_root,
     ) = path_config
-    (
-        spatial_augs,
-        color_augs,
-    ) = aug_config
 
     # How much the loss needs to drop to reset a plateau
     threshold = config.THRESHOLD
@@ -788,10 +962,10 @@ def train(
     patience = config.PATIENCE
 
     # Beginning loss
-    best_loss = None
+    best_loss = progress["best_loss"]
 
     # How long it's been plateauing
-    plateau_count = 0
+    plateau_count = progress["plateau_count"]
 
     # How many classes we're predicting
     num_classes = config.NUM_CLASSES
@@ -803,8 +977,51 @@ def train(
     else:
         epoch_config = config.EPOCHS
 
-    for t in range(epoch_config):
-        if t == 0:
+    # one checkpoint per rank, as each rank draws its own batches
+    num_replicas, rank = get_shard({})
+    checkpoint_name = (
+        "checkpoint.pth" if num_replicas == 1 else f"checkpoint-{rank}.pth"
+    )
+    checkpoint_path = os.path.join(out_root, checkpoint_name)
+
+    # the metrics of the last epoch, trained before a resumed checkpoint
+    epoch_jaccard = progress["train_jaccard"]
+    t_jaccard = progress["test_jaccard"]
+    first_epoch = progress["epoch"]
+    if progress["stopped"] or first_epoch >= epoch_config:
+        logging.info(
+            "Checkpoint finished training after %d epochs, nothing to resume",
+            first_epoch,
+        )
+        first_epoch = epoch_config
+
+    start_batch = progress["batch"]
+    for t in range(first_epoch, epoch_config):
+        # record the progress a checkpoint resumes from
+        epoch_progress = {
+            "seed": progress["seed"],
+            "epoch": t,
+            "best_loss": best_loss,
+            "plateau_count": plateau_count,
+            "train_jaccard": epoch_jaccard,
+            "test_jaccard": t_jaccard,
+            "stopped": False,
+        }
+        # within an epoch, only a sampler with a state can be resumed
+        checkpoint = None
+        if config.CHECKPOINT_BATCHES and hasattr(
+            training_sampler(train_dataloader), "state_dict"
+        ):
+            checkpoint = functools.partial(
+                save_checkpoint,
+                checkpoint_path,
+                model,
+                optimizer,
+                train_dataloader,
+                epoch_progress,
+            )
+
+        if t == 0 and start_batch == 0:
             test_config = (
                 loss_fn,
                 test_jaccard,
@@ -818,6 +1035,7 @@ def train(
             test_loss, t_jaccard = test(
                 test_dataloader,
                 model,
+                input_transform,
                 test_config,
                 writer,
             )
@@ -831,19 +1049,17 @@ def train(
             t + 1,
             train_images_root,
         )
-        aug_config = (
-            spatial_augs,
-            color_augs,
-            config.SPATIAL_AUG_MODE,
-            config.COLOR_AUG_MODE,
-        )
         epoch_jaccard = train_epoch(
             train_dataloader,
             model,
+            input_transform,
             train_config,
-            aug_config,
+            augment,
             writer,
+            start_batch,
+            checkpoint,
         )
+        start_batch = 0
 
         test_config = (
             loss_fn,
@@ -858,10 +1074,12 @@ def train(
         test_loss, t_jaccard = test(
             test_dataloader,
             model,
+            input_transform,
             test_config,
             writer,
         )
         # Checks for plateau
+        stopped = False
         if best_loss is None:
             best_loss = test_loss
         elif test_loss < best_loss - threshold:
@@ -875,12 +1093,41 @@ def train(
                     t,
                     patience,
                 )
-                break
+                stopped = True
+
+        # a run stopped on a plateau is saved as finished, not resumed
+        if config.CHECKPOINT_BATCHES:
+            epoch_progress = {
+                "seed": progress["seed"],
+                "epoch": t + 1,
+                "best_loss": best_loss,
+                "plateau_count": plateau_count,
+                "train_jaccard": epoch_jaccard,
+                "test_jaccard": t_jaccard,
+                "stopped": stopped,
+            }
+            save_checkpoint(
+                checkpoint_path,
+                model,
+                optimizer,
+                train_dataloader,
+                epoch_progress,
+            )
+        if stopped:
+            break
 
     print("Done!")
 
-    torch.save(model.state_dict(), os.path.join(out_root, "model.pth"))
-    logging.info("Saved PyTorch Model State to %s", out_root)
+    # the ranks hold the same weights, the first one saves them
+    if is_main_process():
+        model = getattr(model, "module", model)
+        torch.save(model.state_dict(), os.path.join(out_root, "model.pth"))
+        # the input transform is needed to run the model on raw images
+        torch.save(
+            input_transform.state_dict(),
+            os.path.join(out_root, "input_transform.pth"),
+        )
+        logging.info("Saved PyTorch Model State to %s", out_root)
 
     return epoch_jaccard, t_jaccard
 
@@ -900,21 +1147,74 @@ def one_trial(exp_n, num, wandb_t, naip_set, split_rate):
         writer,
         logger,
     ) = writer_prep(exp_n, num, wandb_t)
+    if config.AUG_LOCATION not in ("device", "workers"):
+        raise ValueError(
+            "AUG_LOCATION must be 'device' or 'workers', "
+            f"not {config.AUG_LOCATION!r}"
+        )
+    spatial_augs, color_augs = create_augmentation_pipelines(
+        config,
+        config.SPATIAL_AUG_INDICES,
+        config.IMAGE_AUG_INDICES,
+    )
+    # build the augmentation pipelines once rather than on every batch
+    augment = AugmentationEngine(
+        spatial_augs,
+        color_augs,
+        config.SPATIAL_AUG_MODE,
+        config.COLOR_AUG_MODE,
+    )
+    worker_augment = None
+    if config.AUG_LOCATION == "workers":
+        worker_augment, augment = augment, None
+
+    # a resumed trial repeats the split of its checkpoint
+    checkpoint = None
+    if config.RESUME_CHECKPOINT is not None and num == 0:
+        # each rank resumes the checkpoint it wrote
+        num_replicas, rank = get_shard({})
+        if num_replicas > 1 and "{rank}" not in config.RESUME_CHECKPOINT:
+            raise ValueError(
+                "RESUME_CHECKPOINT must hold {rank} to resume several ranks"
+            )
+        checkpoint = torch.load(
+            config.RESUME_CHECKPOINT.format(rank=rank), map_location="cpu"
+        )
+
     # randomly splitting the data at every trial
-    train_dataloader, test_dataloader = build_dataset(naip_set, split_rate)
+    train_dataloader, test_dataloader, seed = build_dataset(
+        naip_set,
+        split_rate,
+        worker_augment,
+        checkpoint["seed"] if checkpoint is not None else None,
+    )
     (
         model,
+        input_transform,
         loss_fn,
         train_jaccard,
         test_jaccard,
         jaccard_per_class,
         optimizer,
-    ) = create_model()
-    spatial_augs, color_augs = create_augmentation_pipelines(
-        config,
-        config.SPATIAL_AUG_INDICES,
-        config.IMAGE_AUG_INDICES,
-    )
+    ) = create_model(count_bands(naip_set))
+    progress = {
+        "seed": seed,
+        "epoch": 0,
+        "batch": 0,
+        "best_loss": None,
+        "plateau_count": 0,
+        "train_jaccard": None,
+        "test_jaccard": None,
+        "stopped": False,
+    }
+    if checkpoint is not None:
+        load_checkpoint(checkpoint, model, optimizer, train_dataloader)
+        progress = {key: checkpoint[key] for key in progress}
+        logging.info(
+            "Resuming epoch %d at batch %d",
+            progress["epoch"] + 1,
+            progress["batch"],
+        )
     logging.info("Trial %d\n====================================", num + 1)
     train_test_config = (
         train_dataloader,
@@ -925,10 +1225,6 @@ def one_trial(exp_n, num, wandb_t, naip_set, split_rate):
         optimizer,
         jaccard_per_class,
     )
-    aug_config = (
-        spatial_augs,
-        color_augs,
-    )
     path_config = (
         out_root,
         train_images_root,
@@ -936,11 +1232,13 @@ def one_trial(exp_n, num, wandb_t, naip_set, split_rate):
     )
     train_iou, test_iou = train(
         model,
+        input_transform,
         train_test_config,
-        aug_config,
+        augment,
         path_config,
         writer,
         wandb_tune,
+        progress,
     )
     writer.close()
     logger.handlers.clear()
@@ -985,6 +1283,15 @@ if __name__ == "__main__":
     config = importlib.import_module(args.config)
     exp_name, split, wandb_tune, num_trials = arg_parsing(args)
 
+    # when started by torchrun, join the other ranks and train on their name
+    MODEL_DEVICE = init_distributed()
+    if dist.is_available() and dist.is_initialized():
+        if wandb_tune:
+            raise ValueError("Tuning with wandb runs on a single process")
+        names = [exp_name]
+        dist.broadcast_object_list(names)
+        exp_name = names[0]
+
     logging.info("Using %s device", MODEL_DEVICE)
 
     naip, kc = initialize_dataset()
@@ -1033,3 +1340,6 @@ if __name__ == "__main__":
             wandb.finish()
 
     run_trials()
+
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
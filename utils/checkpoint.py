@@ -0,0 +1,94 @@
+"""
+This module saves and restores training checkpoints. Besides the model and
+optimizer, a checkpoint holds the state of the training sampler, of the torch
+RNGs and of Python's RNG, which picks the augmentations, so a run interrupted
+within an epoch resumes at the batch after the last one it trained on,
+drawing the same batches and augmentations it would have. Augmentations
+applied in the DataLoader workers (AUG_LOCATION = "workers") are drawn anew.
+"""
+
+import os
+import random
+
+import torch
+
+from data.prefetch import DevicePrefetcher
+
+
+def training_sampler(dataloader):
+    """
+    Return the batch sampler of the training DataLoader.
+
+    Args:
+        dataloader: The training DataLoader, possibly in a DevicePrefetcher.
+
+    Returns:
+        The batch sampler drawing the training batches.
+    """
+    if isinstance(dataloader, DevicePrefetcher):
+        dataloader = dataloader.dataloader
+    return dataloader.batch_sampler
+
+
+def save_checkpoint(path, model, optimizer, dataloader, progress, batch=0):
+    """
+    Save the state needed to resume training at the next unseen batch.
+
+    Args:
+        path: The file to write the checkpoint to.
+        model: The model being trained.
+        optimizer: The optimizer updating the model parameters.
+        dataloader: The training DataLoader.
+        progress: A dictionary with the split seed, the epoch being trained,
+            the best test loss, the plateau count, the Jaccard indexes of the
+            last epoch and whether training stopped on a plateau.
+        batch: The number of batches of the epoch the training loop has
+            consumed; 0 once the previous epoch is done.
+    """
+    sampler = training_sampler(dataloader)
+    sampler_state = None
+    if hasattr(sampler, "state_dict"):
+        # workers fetch ahead of the loop, so pass the batches it consumed;
+        # after a whole epoch the sampler records the next one instead
+        sampler_state = sampler.state_dict(position=batch or None)
+    checkpoint = {
+        **progress,
+        "batch": batch,
+        # a DistributedDataParallel model saves the model it wraps
+        "model": getattr(model, "module", model).state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "sampler": sampler_state,
+        "rng_state": torch.get_rng_state(),
+        "python_rng_state": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        checkpoint["cuda_rng_state"] = torch.cuda.get_rng_state_all()
+    tmp_path = f"{path}.tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(checkpoint, model, optimizer, dataloader):
+    """
+    Restore a checkpoint written by save_checkpoint.
+
+    Args:
+        checkpoint: The loaded checkpoint dictionary.
+        model: The model to restore the parameters of.
+        optimizer: The optimizer to restore the state of.
+        dataloader: The training DataLoader, built with the checkpoint's seed.
+    """
+    getattr(model, "module", model).load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    sampler = training_sampler(dataloader)
+    if checkpoint["sampler"] is not None:
+        sampler.load_state_dict(checkpoint["sampler"])
+    elif checkpoint["batch"]:
+        raise ValueError(
+            "The training sampler cannot resume within an epoch, "
+            "use a checkpoint written after a whole epoch"
+        )
+    torch.set_rng_state(checkpoint["rng_state"])
+    random.setstate(checkpoint["python_rng_state"])
+    if "cuda_rng_state" in checkpoint and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(checkpoint["cuda_rng_state"])
@@ -0,0 +1,286 @@
+"""
+The `cog.py` module rewrites downloaded NAIP tiles as Cloud Optimized GeoTIFFs.
+
+Training reads random PATCH_SIZE x PATCH_SIZE windows from the NAIP tiles. When
+a tile is strip-organized or uses large blocks, every chip decodes far more
+data than it uses. Converting the tiles to COGs with an internal tiling that
+matches the patch size bounds the data decoded per chip to a few blocks.
+
+Key functionalities:
+- Convert a directory of GeoTIFFs to COGs in parallel, in place.
+- Verify that the converted tiles are pixel-identical to the originals.
+- Estimate the compressed bytes read per chip before and after conversion.
+"""
+
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Interleaving
+from rasterio.windows import Window
+
+
+def chip_read_bytes(
+    fpath: str, chip_size: int, num_chips: int = 100, seed: int = 0
+) -> float:
+    """
+    Estimate the mean compressed bytes read for a random chip of a GeoTIFF.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to the GeoTIFF
+
+    chip_size : int
+        Height and width of a chip in pixels
+
+    num_chips : int
+        Number of random chip windows to average over
+
+    seed : int
+        Seed of the random chip windows
+
+    Returns
+    -------
+    float
+        Mean number of bytes in the blocks intersecting a chip
+    """
+    rng = np.random.default_rng(seed)
+    with rasterio.open(fpath) as src:
+        block_height, block_width = src.block_shapes[0]
+        # pixel-interleaved blocks hold every band, so count them once
+        bands = src.indexes if src.interleaving == Interleaving.band else [1]
+        rows = rng.integers(0, max(src.height - chip_size, 0) + 1, num_chips)
+        cols = rng.integers(0, max(src.width - chip_size, 0) + 1, num_chips)
+
+        sizes = {}
+        total = 0
+        for row, col in zip(rows, cols):
+            last_row = min(row + chip_size, src.height) - 1
+            last_col = min(col + chip_size, src.width) - 1
+            for i in range(row // block_height, last_row // block_height + 1):
+                for j in range(col // block_width, last_col // block_width + 1):
+                    for band in bands:
+                        if (band, i, j) not in sizes:
+                            sizes[band, i, j] = src.block_size(band, i, j)
+                        total += sizes[band, i, j]
+    return total / num_chips
+
+
+def is_cog(fpath: str, block_size: int) -> bool:
+    """
+    Check whether a GeoTIFF is already tiled with the given block size and
+    has overviews.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to the GeoTIFF
+
+    block_size : int
+        Expected height and width of the internal tiles
+
+    Returns
+    -------
+    bool
+        True if the file does not need to be converted
+    """
+    with rasterio.open(fpath) as src:
+        return (
+            src.profile.get("tiled", False)
+            and src.block_shapes[0] == (block_size, block_size)
+            and len(src.overviews(1)) > 0
+        )
+
+
+def pixels_equal(fpath: str, other_fpath: str, rows: int = 1024) -> bool:
+    """
+    Compare the full resolution pixels of two rasters, a band of rows at a
+    time.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to the first raster
+
+    other_fpath : str
+        Path to the second raster
+
+    rows : int
+        Number of rows compared at once
+
+    Returns
+    -------
+    bool
+        True if the rasters have the same shape, dtype and pixel values
+    """
+    with rasterio.open(fpath) as src, rasterio.open(other_fpath) as other:
+        if (src.count, src.height, src.width) != (
+            other.count,
+            other.height,
+            other.width,
+        ) or src.dtypes != other.dtypes:
+            return False
+        for row in range(0, src.height, rows):
+            window = Window(0, row, src.width, min(rows, src.height - row))
+            if not np.array_equal(
+                src.read(window=window), other.read(window=window)
+            ):
+                return False
+    return True
+
+
+def convert_to_cog(
+    fpath: str,
+    block_size: int,
+    compress: str = "ZSTD",
+    level: int = 1,
+    chip_size: int = None,
+) -> Dict[str, float]:
+    """
+    Rewrite a GeoTIFF in place as a COG, after verifying the pixels.
+
+    The COG is written next to the original and only replaces it once its
+    pixels are found to be identical; otherwise it is removed and the
+    original is kept.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to the GeoTIFF
+
+    block_size : int
+        Height and width of the internal tiles, usually PATCH_SIZE
+
+    compress : str
+        Lossless GDAL codec, e.g. "ZSTD", "LZW" or "DEFLATE"
+
+    level : int
+        Compression level, low values favour decoding speed
+
+    chip_size : int
+        Chip size used to estimate the bytes read per chip, defaults to
+        block_size
+
+    Returns
+    -------
+    dict
+        File name, status, file sizes and bytes read per chip before and
+        after conversion
+    """
+    chip_size = chip_size or block_size
+    result = {
+        "file": os.path.basename(fpath),
+        "size_before": os.path.getsize(fpath),
+        "chip_bytes_before": chip_read_bytes(fpath, chip_size),
+    }
+    if is_cog(fpath, block_size):
+        result.update(
+            status="skipped",
+            size_after=result["size_before"],
+            chip_bytes_after=result["chip_bytes_before"],
+        )
+        return result
+
+    options = {
+        "BLOCKSIZE": block_size,
+        "COMPRESS": compress,
+        "PREDICTOR": "YES",
+        "OVERVIEWS": "AUTO",
+        "RESAMPLING": "AVERAGE",
+        "BIGTIFF": "IF_SAFER",
+    }
+    if compress.upper() in ("ZSTD", "DEFLATE"):
+        options["LEVEL"] = level
+
+    tmp_fpath = f"{fpath}.cog.tmp"
+    with rasterio.open(fpath) as src:
+        rasterio.shutil.copy(src, tmp_fpath, driver="COG", **options)
+
+    if not pixels_equal(fpath, tmp_fpath):
+        os.remove(tmp_fpath)
+        result.update(
+            status="mismatch",
+            size_after=result["size_before"],
+            chip_bytes_after=result["chip_bytes_before"],
+        )
+        return result
+
+    os.replace(tmp_fpath, fpath)
+    result.update(
+        status="converted",
+        size_after=os.path.getsize(fpath),
+        chip_bytes_after=chip_read_bytes(fpath, chip_size),
+    )
+    return result
+
+
+def _convert_to_cog(args) -> Dict[str, float]:
+    """Unpack the arguments of convert_to_cog for a process pool."""
+    return convert_to_cog(*args)
+
+
+def convert_dir_to_cog(
+    img_dir: str,
+    block_size: int,
+    compress: str = "ZSTD",
+    level: int = 1,
+    num_workers: int = None,
+) -> List[Dict[str, float]]:
+    """
+    Convert every GeoTIFF in a directory to a COG in parallel and print the
+    bytes read per chip before and after.
+
+    Parameters
+    ----------
+    img_dir : str
+        Directory containing the GeoTIFFs
+
+    block_size : int
+        Height and width of the internal tiles, usually PATCH_SIZE
+
+    compress : str
+        Lossless GDAL codec, e.g. "ZSTD", "LZW" or "DEFLATE"
+
+    level : int
+        Compression level, low values favour decoding speed
+
+    num_workers : int
+        Number of worker processes, defaults to the number of CPUs
+
+    Returns
+    -------
+    list
+        One result dictionary per file, as returned by convert_to_cog
+    """
+    fpaths = sorted(glob.glob(os.path.join(img_dir, "*.tif")))
+    if not fpaths:
+        print(f"No GeoTIFFs found in {img_dir}")
+        return []
+
+    tasks = [(fpath, block_size, compress, level) for fpath in fpaths]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        results = list(executor.map(_convert_to_cog, tasks))
+
+    for result in results:
+        print(
+            f"{result['file']}: {result['status']}, "
+            f"{result['size_before'] / 2**20:.1f} -> "
+            f"{result['size_after'] / 2**20:.1f} MB, "
+            f"{result['chip_bytes_before'] / 2**10:.1f} -> "
+            f"{result['chip_bytes_after'] / 2**10:.1f} KiB read per chip"
+        )
+    before = np.mean([result["chip_bytes_before"] for result in results])
+    after = np.mean([result["chip_bytes_after"] for result in results])
+    mismatches = [r["file"] for r in results if r["status"] == "mismatch"]
+    print(
+        f"{len(results)} files, mean bytes read per chip: "
+        f"{before / 2**10:.1f} KiB before, {after / 2**10:.1f} KiB after"
+    )
+    if mismatches:
+        print(f"Pixel mismatch, originals kept: {', '.join(mismatches)}")
+    return results
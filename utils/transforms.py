@@ -12,6 +12,14 @@ and parameters.
 - apply_augs(spatial_transforms, color_transforms, image, mask, spatial_mode,
 color_mode, rgb_channels=None): Applies spatial and color augmentations to an image
 and its corresponding mask.
+- apply_color(color_fn, augmented_image, rgb_channels): Applies a color
+augmentation in place to the RGB channels of a spatially augmented image.
+- AugmentationEngine: Spatial and color pipelines built once and applied to
+every batch.
+- SampleAugmentation: AugmentationEngine applied to single samples, as a
+dataset transform run in DataLoader workers.
+- InputTransform: Scaling, normalization and channel expansion of model input,
+precomputed once per model.
 
 Parameters:
 - image (torch.Tensor): The input image tensor.
@@ -26,6 +34,7 @@ Parameters:
 """
 
 import random
+from typing import Optional
 
 import kornia.augmentation as K
 import torch
@@ -143,37 +152,77 @@ def apply_augs(
     if rgb_channels is None:
         rgb_channels = [0, 1, 2]
 
-    # Create a boolean mask for identifying RGB channels
-    rgb_mask = torch.zeros(
-        image.shape[1], dtype=torch.bool, device=image.device
-    )
-    rgb_mask[rgb_channels] = True
-
     spatial_transforms, color_transforms, spatial_mode, color_mode = aug_config
 
     # Apply spatial augmentations to the image and mask
     augmented_image, augmented_mask = get_spatial_augmentation(
         spatial_transforms, spatial_mode, image, mask
     )
-
-    # Separate RGB channels for color augmentation
-    rgb_only, non_rgb = separate_channels(augmented_image, rgb_channels)
+    augmented_image = owned_output(augmented_image, image)
 
     # Apply color augmentations only to the RGB channels
-    augmented_rgb = get_augmented_rgb(color_transforms, color_mode, rgb_only)
-
-    # Recombine RGB and non-RGB channels
-    fully_augmented_image = combine_channels(
-        augmented_rgb, non_rgb, rgb_mask, image.shape
+    fully_augmented_image = apply_color(
+        lambda rgb: get_augmented_rgb(color_transforms, color_mode, rgb),
+        augmented_image,
+        rgb_channels,
     )
 
-    # Generate a mask of non-padded areas in the augmented image
-    # and ensure color augmentations do not affect zero-padded areas
-    fully_augmented_image *= augmented_image.any(dim=1, keepdim=True)
-
     return fully_augmented_image, augmented_mask
 
 
+def apply_color(color_fn, augmented_image, rgb_channels):
+    """
+    Apply a color augmentation to the RGB channels of an augmented image.
+
+    The result is written back into augmented_image. Consecutive RGB channels
+    are passed to color_fn as a view, so the other channels are never copied.
+
+    Parameters:
+        color_fn (callable): Color augmentation taking and returning the RGB
+                             channels.
+        augmented_image (torch.Tensor): The spatially augmented image, which
+                                        is modified in place.
+        rgb_channels (list): Indices of RGB channels in the image tensor.
+
+    Returns:
+        torch.Tensor: augmented_image, with color augmented RGB channels.
+    """
+    # Pixels zero in every channel were padded by the spatial augmentations;
+    # the other channels are already zero there
+    valid = augmented_image.any(dim=1, keepdim=True)
+
+    first = min(rgb_channels)
+    if list(rgb_channels) == list(range(first, first + len(rgb_channels))):
+        rgb = augmented_image[:, first : first + len(rgb_channels)]
+        rgb.copy_(color_fn(rgb))
+        rgb.mul_(valid)
+    else:
+        index = torch.as_tensor(rgb_channels, device=augmented_image.device)
+        rgb = color_fn(augmented_image.index_select(1, index)) * valid
+        augmented_image.index_copy_(1, index, rgb)
+
+    return augmented_image
+
+
+def owned_output(augmented_image, image):
+    """
+    Return a spatial augmentation output that can be modified in place.
+
+    Pipelines whose transforms all skip a batch return their input itself,
+    which apply_color must not write into.
+
+    Parameters:
+        augmented_image (torch.Tensor): The spatially augmented image.
+        image (torch.Tensor): The input image tensor.
+
+    Returns:
+        torch.Tensor: augmented_image, or a copy if it shares the input memory.
+    """
+    if augmented_image.data_ptr() == image.data_ptr():
+        return augmented_image.clone()
+    return augmented_image
+
+
 def get_spatial_augmentation(spatial_transforms, mode, image, mask):
     """
     Return the image and mask after spatial augmentation
@@ -225,3 +274,260 @@ def get_augmented_rgb(color_transforms, mode, rgb_only):
     )
 
     return color_aug_pipeline(rgb_only)
+
+
+class CachedPipelines:
+    """
+    AugmentationSequential pipelines over subsets of a list of transforms.
+
+    In random mode each call selects a random subset, as get_spatial_augmentation
+    and get_augmented_rgb do, and the pipeline of each subset is built the first
+    time it is selected. Subsets are applied in the order of the list, so there
+    are at most 2**len(transforms) - 1 pipelines. Otherwise the pipeline of
+    every transform is built once.
+    """
+
+    def __init__(self, transforms, mode, data_keys):
+        """
+        Parameters:
+            transforms (list): Augmentations to choose from.
+            mode (str): Augmentation mode - 'random' for random augmentations
+                        or 'all' for all.
+            data_keys (list): Data keys of the pipelines.
+        """
+        self.transforms = list(transforms)
+        self.mode = mode
+        self.data_keys = data_keys
+        self.pipelines = {}
+
+    def select(self):
+        """
+        Return the pipeline to apply to the next batch.
+
+        Returns:
+            K.AugmentationSequential: The pipeline of the selected transforms.
+        """
+        indices = range(len(self.transforms))
+        # as in get_spatial_augmentation, any mode selects a random subset
+        if self.mode:
+            indices = sorted(
+                random.sample(indices, k=random.randint(1, len(indices)))
+            )
+        key = tuple(indices)
+        if key not in self.pipelines:
+            self.pipelines[key] = K.AugmentationSequential(
+                *[self.transforms[i] for i in key],
+                data_keys=self.data_keys,
+                same_on_batch=False,
+            )
+        return self.pipelines[key]
+
+
+class AugmentationEngine:
+    """
+    Spatial and color augmentation applied with pipelines built once.
+
+    Created once per trial, it replaces calling apply_augs on every batch, which
+    builds two new AugmentationSequential pipelines per call. Parameters are
+    still drawn per sample, in one batched call per pipeline.
+    """
+
+    def __init__(
+        self,
+        spatial_transforms,
+        color_transforms,
+        spatial_mode,
+        color_mode,
+        rgb_channels=None,
+    ):
+        """
+        Parameters:
+            spatial_transforms (list): List of spatial augmentations to apply.
+            color_transforms (list): List of color augmentations for RGB
+                                     channels.
+            spatial_mode (str): Augmentation mode for spatial augmentations.
+            color_mode (str): Augmentation mode for color augmentations.
+            rgb_channels (list): Indices of RGB channels in the image tensor.
+        """
+        self.spatial = CachedPipelines(
+            spatial_transforms, spatial_mode, ["image", "mask"]
+        )
+        self.color = CachedPipelines(color_transforms, color_mode, ["image"])
+        self.rgb_channels = rgb_channels or [0, 1, 2]
+
+    def __call__(self, image, mask):
+        """
+        Apply spatial and color augs to an image and its corresponding mask.
+
+        Parameters:
+            image (torch.Tensor): The input image tensor.
+            mask (torch.Tensor): The corresponding mask tensor.
+
+        Returns:
+            torch.Tensor: The augmented image.
+            torch.Tensor: The augmented mask, spatially transformed
+                          in sync with the image.
+        """
+        augmented_image, augmented_mask = self.spatial.select()(image, mask)
+        augmented_image = owned_output(augmented_image, image)
+        fully_augmented_image = apply_color(
+            self.color.select(), augmented_image, self.rgb_channels
+        )
+        return fully_augmented_image, augmented_mask
+
+
+class SampleAugmentation:
+    """
+    Spatial and color augmentation of single samples, as a dataset transform.
+
+    Used to augment in the DataLoader workers rather than on the model device.
+    Each image is scaled to 0-1 pixel values, as InputTransform.scale does,
+    and augmented as a batch of one with its mask, so parameters are still
+    drawn per sample.
+    """
+
+    def __init__(self, augment, scale=255.0):
+        """
+        Parameters:
+            augment (AugmentationEngine): Spatial and color augmentations.
+            scale (float): Pixel value mapped to 1 by scaling.
+        """
+        self.augment = augment
+        self.scale = scale
+
+    def __call__(self, sample):
+        """
+        Augment the image and mask of a sample.
+
+        Parameters:
+            sample (dict): Sample with an image of shape (bands, h, w) and a
+                           mask of shape (h, w).
+
+        Returns:
+            dict: The sample, with the scaled and augmented image and the
+                  augmented mask.
+        """
+        image = sample["image"].unsqueeze(0) / self.scale
+        mask = sample["mask"]
+        augmented_image, augmented_mask = self.augment(
+            image, mask.view(1, 1, *mask.shape[-2:]).float()
+        )
+        sample["image"] = augmented_image[0]
+        sample["mask"] = augmented_mask.reshape(mask.shape).to(mask.dtype)
+        return sample
+
+
+class InputTransform(torch.nn.Module):
+    """
+    Scaling, normalization and channel expansion of model input as one module.
+
+    The model takes in_channels channels; missing ones are filled with copies
+    of a source channel, and every channel is normalized with the dataset mean
+    and standard deviation of its band, those of the source band for copies.
+    Scaling pixel values from 0-255 to 0-1 and normalizing are folded into one
+    per-channel multiply-add, with weights precomputed once per model. The
+    transform holds only buffers, so it moves to the model device and can be
+    exported in front of the model, e.g. torch.nn.Sequential(transform, model).
+    """
+
+    bands: Optional[int]
+
+    def __init__(
+        self,
+        mean,
+        std,
+        in_channels,
+        bands=None,
+        source_channel=0,
+        scale=255.0,
+    ):
+        """
+        Parameters:
+            mean (list): Dataset mean of each band, in 0-1 pixel values.
+            std (list): Dataset standard deviation of each band.
+            in_channels (int): Number of channels the model takes.
+            bands (int): Number of bands of the images, checked on every call
+                         if given.
+            source_channel (int): Band copied into missing channels.
+            scale (float): Pixel value mapped to 1 by scaling.
+        """
+        super().__init__()
+        # pad the statistics with those of the source band, without modifying
+        # the lists passed in
+        extra = max(in_channels - len(mean), 0)
+        mean = torch.tensor(
+            list(mean) + [mean[source_channel]] * extra, dtype=torch.float32
+        )
+        std = torch.tensor(
+            list(std) + [std[source_channel]] * extra, dtype=torch.float32
+        )
+        shape = (1, in_channels, 1, 1)
+        self.bands = bands
+        self.source_channel = source_channel
+        self.register_buffer("channels", torch.arange(in_channels))
+        self.register_buffer("scale_weight", torch.tensor(1.0 / scale))
+        self.register_buffer("norm_weight", (1.0 / std).view(shape))
+        self.register_buffer("weight", (1.0 / (scale * std)).view(shape))
+        self.register_buffer("bias", (-mean / std).view(shape))
+
+    def expand(self, image):
+        """
+        Fill the channels missing from an image with copies of the source band.
+
+        Parameters:
+            image (torch.Tensor): Image of shape (batch, bands, h, w).
+
+        Returns:
+            torch.Tensor: Image of shape (batch, in_channels, h, w).
+
+        Raises:
+            ValueError: If the image does not have the given number of bands.
+        """
+        bands = self.bands
+        if bands is not None and image.size(1) != bands:
+            raise ValueError(
+                f"Expected images with {bands} bands, got {image.size(1)}"
+            )
+        if image.size(1) == self.channels.numel():
+            return image
+        index = torch.where(
+            self.channels < image.size(1), self.channels, self.source_channel
+        )
+        return image.index_select(1, index)
+
+    def scale(self, image):
+        """
+        Expand an image and scale its pixel values to 0-1, for augmentation.
+
+        Parameters:
+            image (torch.Tensor): Image of shape (batch, bands, h, w).
+
+        Returns:
+            torch.Tensor: Scaled image of shape (batch, in_channels, h, w).
+        """
+        return self.expand(image) * self.scale_weight
+
+    def normalize(self, scaled_image):
+        """
+        Normalize an image returned by scale, once it has been augmented.
+
+        Parameters:
+            scaled_image (torch.Tensor): Image of shape
+                                         (batch, in_channels, h, w).
+
+        Returns:
+            torch.Tensor: The normalized image.
+        """
+        return torch.addcmul(self.bias, scaled_image, self.norm_weight)
+
+    def forward(self, image):
+        """
+        Expand, scale and normalize an image in one multiply-add.
+
+        Parameters:
+            image (torch.Tensor): Image of shape (batch, bands, h, w).
+
+        Returns:
+            torch.Tensor: Model input of shape (batch, in_channels, h, w).
+        """
+        return torch.addcmul(self.bias, self.expand(image), self.weight)